@@ -6,26 +6,19 @@ import os
 import struct as st
 import argparse as ap
 import datetime
+import asyncio
+import itertools
+import numpy as np
 
 from utils.pyGeneralClass import *
-
-# convenience function reused for header, length, and checksum
-def __nextLittleEndianUnsignedShort(file):
-   """Get next little endian unsigned short from file"""
-   raw = file.read(2)
-   return (raw, st.unpack('<H', raw)[0])
-
-# factored for readability
-def __computeChecksum(header, length, ensemble):
-   """Compute a checksum from header, length, and ensemble"""
-   cs = 0
-   for byte in header:
-      cs += byte
-   for byte in length:
-      cs += byte
-   for byte in ensemble:
-      cs += byte
-   return cs & 0xffff
+from utils.pyReaderClass import WHMappedFile, getStartOffset, verifyPath, isLiveSource, openLiveSource, iterLiveEnsembles
+from utils.pyScanClass import WHEnsembleScanner, WHStreamFramer
+from utils.pyArrayClass import BLOCKSIZE, WHEnsembleArrays, joinRawEnsembles
+from utils.pyExportClass import WHSegmentedWriter, WHTextWriter
+from utils.pyParallelClass import WHBlockConverter
+from utils.pyAverageClass import WHEnsembleAverager, WHAverageTextWriter
+from utils.pyQualityClass import QCTESTS, QCREQUIREDVALUES, QCDATATYPES, WHQualityControl
+from utils.pyAsyncClass import WHAsyncPipeline
 
 #----------------------------------------
 #-  Date validation for input parameter -
@@ -38,6 +31,246 @@ def valid_datetime_type(arg_datetime_str):
       msg = "Given Datetime ({0}) not valid! Expected format, 'dd-mm-YYYY hh:mm:ss.ss'!".format(arg_datetime_str)
       raise ap.ArgumentTypeError(msg)
 
+#----------------------------------------
+#- Cell range validation for input parameter
+#----------------------------------------
+def valid_cell_range(arg_cells_str):
+   """custom argparse type for cell range given from the command line, return the slice of the cells"""
+   try:
+      first, last = arg_cells_str.split(':')
+      first = int(first) if first.strip() != '' else 1
+      last = int(last) if last.strip() != '' else None
+      if first < 1 or (last != None and last < first):
+         raise ValueError
+      return slice(first-1, last)
+   except ValueError:
+      msg = "Given cell range ({0}) not valid! Expected format, 'first:last' (from 1, included)!".format(arg_cells_str)
+      raise ap.ArgumentTypeError(msg)
+
+#----------------------------------------
+#- Averaging validation for input parameter
+#----------------------------------------
+# Seconds of the units of the averaging interval
+AVERAGETIMEUNITS = {'s': 1, 'min': 60, 'h': 3600}
+
+def valid_average(arg_average_str):
+   """custom argparse type for the averaging given from the command line, return (interval in seconds, number of ensembles)"""
+   try:
+      for unit in sorted(AVERAGETIMEUNITS, key=len, reverse=True):
+         if arg_average_str.endswith(unit):
+            interval = float(arg_average_str[:-len(unit)]) * AVERAGETIMEUNITS[unit]
+            if not interval > 0:
+               raise ValueError
+            return (interval, None)
+      size = int(arg_average_str)
+      if size < 1:
+         raise ValueError
+      return (None, size)
+   except ValueError:
+      msg = "Given averaging ({0}) not valid! Expected a number of ensembles or an interval ending with s, min or h!".format(arg_average_str)
+      raise ap.ArgumentTypeError(msg)
+
+#----------------------------------------
+#- Quality control validation for input parameter
+#----------------------------------------
+def valid_quality_control(arg_qc_str):
+   """custom argparse type for the quality control tests given from the command line, return the dict test -> value"""
+   tests = {}
+   try:
+      for item in arg_qc_str.split(','):
+         test, sep, value = item.strip().upper().partition('=')
+         if test not in QCTESTS or (sep == '' and test in QCREQUIREDVALUES):
+            raise ValueError
+         tests[test] = float(value) if sep != '' else None
+      return tests
+   except ValueError:
+      msg = "Given quality control ({0}) not valid! Expected tests separated by a comma among {1}, with their value as TEST=value ({2} need one)!".format(
+                arg_qc_str, ', '.join(QCTESTS), ', '.join(QCREQUIREDVALUES))
+      raise ap.ArgumentTypeError(msg)
+
+# Actions on an ensemble
+WRITE = 0
+SKIP = 1
+STOP = 2
+
+#----------------------------------------
+#---     Selection of the ensembles   ---
+#----------------------------------------
+def getActions(args, leaders, elementCount):
+   """Return WRITE, SKIP or STOP for each ensemble of leaders (WHEnsembleArrays, leaders decoded)"""
+   nbEnsembles = leaders.getNumberOfEnsembles()
+   number = leaders.getElementNumber()
+   stop = np.zeros(nbEnsembles, dtype=bool)
+   skip = np.zeros(nbEnsembles, dtype=bool)
+   badTime = np.zeros(nbEnsembles, dtype=bool)
+
+   # Ensemble number window
+   if args.last_ensemble != None:
+      stop |= number > args.last_ensemble
+   if args.first_ensemble != None:
+      skip |= number < args.first_ensemble
+
+   # Time window, compared at the microsecond as the datetime arguments
+   if args.start_datetime != None:
+      ensembleDateTime = leaders.getStartDateTime().astype('M8[us]')
+      badTime = np.isnat(ensembleDateTime) & ~stop
+      # Stop just after end date
+      if args.end_datetime != None:
+         endDateTime = np.datetime64(args.end_datetime, 'us')
+         stop |= ensembleDateTime > endDateTime
+         skip |= ~(ensembleDateTime < endDateTime)
+      skip |= ~(ensembleDateTime > np.datetime64(args.start_datetime, 'us'))
+
+   # Number of element written, counted on the ensembles to write
+   if args.count != -1:
+      candidates = ~stop & ~skip
+      written = elementCount + np.cumsum(candidates) - candidates
+      stop |= candidates & (written >= args.count)
+
+   actions = np.full(nbEnsembles, WRITE, dtype=np.int8)
+   actions[skip] = SKIP
+   actions[stop] = STOP
+
+   # Errors of the ensembles read (up to the first STOP)
+   end = getStopPosition(actions)
+   badTypes = leaders.nbDataTypes[:end+1] > 100
+   if badTypes.any():
+      raise IOError('Incorrect number of data types ({})'.format(leaders.nbDataTypes[np.argmax(badTypes)]))
+   if badTime[:end+1].any():
+      raise IOError('Invalid date time of the ensemble {}'.format(number[np.argmax(badTime)]))
+   return(actions)
+
+# Return the position of the first STOP of <actions>, their length if none
+def getStopPosition(actions):
+   stops = np.flatnonzero(actions == STOP)
+   return(int(stops[0]) if len(stops) > 0 else len(actions))
+
+def selectEnsembles(args, leaders, elementCount, fixedLeaders):
+   """Return the positions of the ensembles of leaders to write, in blocks of a single
+   configuration (changes recorded by fixedLeaders), and True to stop the reading"""
+   actions = getActions(args, leaders, elementCount)
+   end = getStopPosition(actions)
+   # A block holds the ensembles of a single configuration
+   changes = fixedLeaders.checkConfigurationArrays(leaders.getEnsembles(slice(0, end+1)))
+   bounds = [0] + changes + [end]
+   blocks = [np.flatnonzero(actions[first:last] == WRITE) + first for first, last in zip(bounds[:-1], bounds[1:])]
+   return(blocks, end < len(actions))
+
+#----------------------------------------
+#---     Conversion of a file         ---
+#----------------------------------------
+def convertFile(args, infile, outfile, decodedTypes, fixedLeaders):
+   """Convert the selected ensembles of infile (WHMappedFile), return the scanner"""
+   # Number of element written
+   elementCount = 0
+
+   # Selected ensembles are decoded and written by blocks, in a pool of
+   # processes with more than one job
+   converter = WHBlockConverter(args.infile, outfile, decodedTypes, args.jobs, args.cells)
+
+   # Ensembles are located and checked (length and checksum) by the scanner,
+   # corrupted spans are skipped and reported at the end
+   scanner = WHEnsembleScanner()
+   startOffset = 0
+
+   # Jump to the first ensemble of the time or ensemble number window
+   # through the ensemble index (built once, then reused)
+   if args.useindex and (args.start_datetime != None or args.first_ensemble != None):
+      startOffset = getStartOffset(args.infile, infile.getBuffer(), args.start_datetime, args.first_ensemble)
+
+   # loop through raw data by blocks of ensembles, their leaders are decoded
+   # at once to select the ensembles to write
+   ensembles = scanner.iterEnsembles(infile.getBuffer(), startOffset)
+   while True:
+      offsets = [offset for offset, length in itertools.islice(ensembles, BLOCKSIZE)]
+      if len(offsets) == 0:
+         break
+      leaders = WHEnsembleArrays()
+      leaders.readLeaderArrays(infile.getBuffer(), offsets)
+      blocks, stop = selectEnsembles(args, leaders, elementCount, fixedLeaders)
+      for positions in blocks:
+         converter.convert(leaders.offsets[positions])
+         elementCount = elementCount + len(positions)
+      if stop:
+         break
+
+   converter.close()
+   return(scanner)
+
+#----------------------------------------
+#---     Conversion of a live source  ---
+#----------------------------------------
+def convertLive(args, source, outfile, decodedTypes, fixedLeaders):
+   """Convert the selected ensembles of a live source as soon as they are received, return the scanner"""
+   # Number of element written
+   elementCount = 0
+   framer = WHStreamFramer()
+   for ensembles in iterLiveEnsembles(source, framer):
+      buffer, offsets = joinRawEnsembles([rawEnsemble for offset, rawEnsemble in ensembles])
+      leaders = WHEnsembleArrays()
+      leaders.readLeaderArrays(buffer, offsets)
+      blocks, stop = selectEnsembles(args, leaders, elementCount, fixedLeaders)
+      for positions in blocks:
+         if len(positions) > 0:
+            arrays = WHEnsembleArrays()
+            arrays.readEnsembleArrays(buffer, offsets[positions], decodedTypes, args.cells)
+            outfile.writeArrays(arrays)
+         elementCount = elementCount + len(positions)
+      outfile.flush()
+      if stop:
+         break
+   return(framer.scanner)
+
+#----------------------------------------
+#---     Opening of the output        ---
+#----------------------------------------
+def openWriter(args, filename, coordSystem, outputTypes):
+   """Open the writer of filename, behind the averaging and quality control stages if any, return (writer, averager, quality)"""
+   # Test and open output file
+   try:
+      if args.binary:
+            outfile = WHSegmentedWriter(filename, coordSystem)
+      elif args.average != None:
+            outfile = WHAverageTextWriter(filename, coordSystem, outputTypes, args.size)
+      else:
+            outfile = WHTextWriter(filename, coordSystem, outputTypes, args.size)
+   except ImportError as error:
+      # Missing optional dependency of the output format (h5py, pyarrow)
+      raise ImportError('Unable to create file {}: {}'.format(filename, error))
+   except (IOError, OSError):
+      raise IOError('Unable to create file {}'.format(filename))
+   # Ensembles tested then averaged between their decoding and their writing
+   averager = quality = None
+   if args.average != None:
+      interval, size = args.average
+      outfile = averager = WHEnsembleAverager(outfile, coordSystem, interval, size, outputTypes)
+   if args.quality_control != None:
+      outfile = quality = WHQualityControl(outfile, args.quality_control, coordSystem)
+   return(outfile, averager, quality)
+
+#----------------------------------------
+#---     Conversion of live sources   ---
+#----------------------------------------
+def convertLiveSources(args, coordSystem, outputTypes, decodedTypes):
+   """Convert several live sources at once, each one to its own output numbered after outfile"""
+   pipeline = WHAsyncPipeline()
+   stages = []
+   root, extension = os.path.splitext(args.outfile)
+   for number, name in enumerate(args.live):
+      outfile, averager, quality = openWriter(args, '{}-{}{}'.format(root, number+1, extension), coordSystem, outputTypes)
+      pipeline.addSource(name, outfile, decodedTypes)
+      stages.append((averager, quality))
+   asyncio.run(pipeline.run())
+
+   pipeline.printReport()
+   for stats, (averager, quality) in zip(pipeline.getStats(), stages):
+      print('{}:'.format(stats.name))
+      stats.scanner.printReport()
+      if quality != None:
+         quality.printReport()
+      if averager != None:
+         averager.printReport()
+
 #----------------------------------------
 #---           MAIN                   ---
 #----------------------------------------
@@ -46,8 +279,18 @@ def main():
    parser = ap.ArgumentParser()
    parser.add_argument('-i', '-infile',
                         dest='infile', 
-                        required=True,
-                        help="ADCP file to read")
+                        required=False,
+                        help="ADCP file to read. Live sources are read as the data arrive: - (stdin), \
+                        tcp://host:port, a named pipe or a serial line (set up beforehand)")
+   parser.add_argument("-live", "--live",
+                        dest='live',
+                        nargs='+',
+                        default=None,
+                        metavar='SOURCE',
+                        help="live sources (see <infile>) converted at once in one process instead of infile, each \
+                        one written to <outfile> with its number before the extension (<outfile>-1, <outfile>-2, ...). \
+                        The ensembles are not selected: the time, ensemble number, count and cells options are not \
+                        available with live sources")
    parser.add_argument('-o', '-outfile',
                         dest='outfile', 
                         required=False,
@@ -65,17 +308,67 @@ def main():
                         default=None,
                         required=False,
                         help='end datetime in format "dd-mm-YYYY hh:mm:ss.ss"')
+   parser.add_argument("-first", "--first-ensemble",
+                        dest='first_ensemble',
+                        type=int,
+                        default=None,
+                        required=False,
+                        help='number of the first ensemble to read')
+   parser.add_argument("-last", "--last-ensemble",
+                        dest='last_ensemble',
+                        type=int,
+                        default=None,
+                        required=False,
+                        help='number of the last ensemble to read')
+   parser.add_argument("-noindex", "--no-index",
+                        dest='useindex',
+                        action='store_false',
+                        help='do not use (nor build) the <infile>.idx ensemble index to reach the first ensemble')
    parser.add_argument("-c", "--count",
                         dest='count',
                         type=int,
                         default=-1,
                         help="Number of element to read")
+   parser.add_argument("-cells", "--cells",
+                        dest='cells',
+                        type=valid_cell_range,
+                        default=None,
+                        required=False,
+                        help='range of the cells to decode and write, in format "first:last" (from 1, included, \
+                        one of them can be omitted). Default: all the cells')
+   parser.add_argument("-avg", "--average",
+                        dest='average',
+                        type=valid_average,
+                        default=None,
+                        required=False,
+                        help='average the ensembles by <N> ensembles or by time intervals (from the ensemble start \
+                        time, e.g. 30s, 10min, 1h). Each bin is written with its number of ensembles, the mean \
+                        leaders (circular mean of the heading) and the mean, standard deviation and number of \
+                        valid values of the velocities (vector average in EARTH coordinates). A bin ends when the \
+                        configuration changes. Default: not averaged')
+   parser.add_argument("-qc", "--quality-control",
+                        dest='quality_control',
+                        type=valid_quality_control,
+                        default=None,
+                        required=False,
+                        help='quality control tests rejecting the beam velocities, separated by a comma: CORR[=count] \
+                        (correlation below the threshold), PG[=percent] (percent good below the minimum), INT=dB \
+                        (echo intensity below the minimum), TILT=degree (tilt above the limit), 4BEAM (cells without \
+                        four valid beams), EV[=mm/s] (error velocity above the threshold). Without value, the \
+                        threshold of the fixed leader is used. The number of velocities rejected by each test is \
+                        reported. Default: no test')
    parser.add_argument("-size", "--size",
                         dest='size',
                         type=int,
                         default=0,
                         required=False,
                         help='split output file every <size> kilo bytes. Default=0 (not split)')
+   parser.add_argument("-j", "--jobs",
+                        dest='jobs',
+                        type=int,
+                        default=1,
+                        required=False,
+                        help='number of processes decoding and formatting the ensembles. Default=1')
    parser.add_argument("-sys", "--system",
                         dest='coordinatesystem',
                         default='BEAM',
@@ -83,15 +376,35 @@ def main():
                         help='Coordinate system for velocities. Default: BEAM. Valid values: BEAM, INSTRUMENT, EARTH')
    parser.add_argument("-b", "--binary",
                         dest='binary',
-                        type=bool,
-                        default=False,
-                        help="Outputs in binary format for numpy use")
+                        action='store_true',
+                        help="Outputs in binary format for numpy use: one .npy file per field and a header.json \
+                        in the <outfile> directory, or bundled in <outfile> if it ends with .npz. \
+                        <outfile> ending with .nc, .h5 or .hdf5 is written as a compressed HDF5/NetCDF-4 \
+                        file (needs h5py), with .parquet, .arrow or .feather as a columnar file, one row \
+                        group per block of ensembles (needs pyarrow). Velocities are in m.s-1, intensity in dB. \
+                        When the number of cells, of beams or the cell length changes, each configuration is \
+                        written in its own output, numbered after the first one (<outfile>-2, ...).")
+   parser.add_argument("-verify", "--verify",
+                        dest='verify',
+                        action='store_true',
+                        help="Only check the framing and checksums of the ensembles of infile (a file or a directory), \
+                        nothing is converted. Exit status is 1 if bad ensembles are found.")
    parser.add_argument("-d", "--data",
                         dest='data',
                         default='VEL,INT,PG,CORR',
                         help="Data output: Default: VEL,INT,PG,CORR. VEL: velocity, INT: intensity, PG: percent good, \
                         CORR: correlation. Choose a combination of data separated by a comma.")
    args = parser.parse_args()
+   if (args.infile == None) == (args.live == None):
+      parser.error('one of the arguments -i/-infile or -live/--live is required (not both)')
+   if args.live != None and args.verify:
+      parser.error('-verify/--verify checks the ensembles of -i/-infile only')
+
+   # Verification only: report bad ensembles of a file or a directory
+   if args.verify:
+      if not os.path.exists(args.infile):
+         raise IOError('%s is not a valid file or directory name' % args.infile)
+      sys.exit(1 if verifyPath(args.infile) > 0 else 0)
    
    # Test validity of date time if given
    if args.start_datetime != None and args.end_datetime != None:
@@ -102,159 +415,94 @@ def main():
    if args.start_datetime == None and args.end_datetime != None:
       msg = "End date is given but start date is not given\n\tYou should provide both dates"
       raise ap.ArgumentTypeError(msg)
+
+   if args.first_ensemble != None and args.last_ensemble != None:
+      if args.first_ensemble > args.last_ensemble:
+         msg = "First ensemble can not be after last ensemble !"
+         raise ap.ArgumentTypeError(msg)
+      
+   if args.jobs < 1:
+      msg = "Number of jobs must be at least 1 !"
+      raise ap.ArgumentTypeError(msg)
       
+   if args.live != None:
+      if args.start_datetime != None or args.first_ensemble != None or args.last_ensemble != None \
+         or args.count != -1 or args.cells != None:
+         msg = "Ensembles of the live sources can not be selected (time, ensemble number, count or cells) !"
+         raise ap.ArgumentTypeError(msg)
+
+   # Live source (stdin, TCP, named pipe or serial line): read as the data arrive
+   live = args.live != None or isLiveSource(args.infile)
    # Test validity of ADCP file name
-   if not os.path.isfile(args.infile):
+   if not live and not os.path.isfile(args.infile):
       raise IOError('%s is not a valid file ADCP file name' % args.infile)
-   # Opening the ADCP file
-   try:
-      infile = open(args.infile,'rb')
-   except:
-      raise IOError('Unable to open file {}'.format(args.infile))
-   # Set default name of output file if needed
-   if args.outfile == './export-ADCP.txt':
-            args.outfile = './export-{}.{}'.format(args.infile.split('.')[0],'txt')
-   # Test and open output file
+   # Opening the ADCP file, ensembles are read as windows into the mapped file
+   # (the live sources of the pipeline are opened by it)
+   infile = None
    try:
-      if args.binary:
-            outfile = open(args.outfile, 'wb')
+      if args.live != None:
+            pass
+      elif live:
+            infile = openLiveSource(args.infile)
       else:
-            outfile = open(args.outfile,'w')
+            infile = WHMappedFile(args.infile)
    except:
-      raise IOError('Unable to create file {}'.format(args.outfile))
-
+      raise IOError('Unable to open file {}'.format(args.infile))
    # Test validity of coordinate system
    if (args.coordinatesystem != 'BEAM') & (args.coordinatesystem != 'INSTRUMENT') & (args.coordinatesystem != 'EARTH'):
       msg = 'Invalid coordinate system ({}). Valid value: BEAM, INSTRUMENT, EARTH'.format(args.coordinatesystem)
       raise ap.ArgumentTypeError(msg)
    coordSystem = args.coordinatesystem
 
+   # Set default name of output file if needed
+   if args.outfile == './export-ADCP.txt':
+      name = 'live' if live else args.infile.split('.')[0]
+      if args.binary:
+            args.outfile = './export-{}'.format(name)
+      else:
+            args.outfile = './export-{}.{}'.format(name,'txt')
+   # Test validity of the data output, only these profiles are decoded
+   # (plus the correlation used by the correlation test of transformed velocities)
+   outputTypes = []
+   for data in args.data.split(','):
+      if data.strip().upper() not in DATATYPES:
+         msg = 'Invalid data output ({}). Valid values: VEL, INT, PG, CORR'.format(data)
+         raise ap.ArgumentTypeError(msg)
+      outputTypes.append(DATATYPES[data.strip().upper()])
+   decodedTypes = list(outputTypes)
+   if VELOCITYPROFILE in outputTypes and coordSystem != COORDSYSTEM[0]:
+      decodedTypes.append(CORRELATIONPROFILE)
+   # (and the profiles used by the quality control tests)
+   if args.quality_control != None:
+      if VELOCITYPROFILE not in outputTypes:
+         msg = 'Quality control needs the velocity data output (VEL)'
+         raise ap.ArgumentTypeError(msg)
+      for test in args.quality_control:
+         if test in QCDATATYPES and QCDATATYPES[test] not in decodedTypes:
+            decodedTypes.append(QCDATATYPES[test])
+
    # End of argument management
 
-   # Variable initiatilization
-   # Number of element written
-   elementCount = 0
-   # Control of the file size
-   outfileSize = 0
-   # Control of the file number (in case of multiple files)
-   fileCount = 0
+   # Several live sources: converted at once by the asyncio pipeline
+   if args.live != None:
+      convertLiveSources(args, coordSystem, outputTypes, decodedTypes)
+      return
 
-   # Retreive first element of interest, i.e. wave or current
-   firstCurrents, firstWaves = getFirstWavesCurrentsID(infile)
-   
-   # get the starting point by throwing out unfound headers
-   # and selecting the minumum
-   firstEnsemble = min(filter(lambda x: x >= 0,(firstWaves,firstCurrents)))
-
-   #seeks to the first occurence of a waves or currents data
-   infile.seek(firstEnsemble-2)
-
-   # Get file information: file size
-   #fileSize = os.stat(args.infile).st_size
-
-   # Read header ID
-   rawHeader, header = __nextLittleEndianUnsignedShort(infile)
-   # loop through raw data
-   while (header == WAVESID) or (header == PD0HEADERID):
-      # print statistics
-      #sys.stdout.write("{:2.1}%\r".format(str((infile.tell()/fileSize)*100.0)))
-      #sys.stdout.flush()
-
-      # get ensemble length
-      rawLength, length = __nextLittleEndianUnsignedShort(infile)
-
-      # TODO: deal with wave data also
-      # actually just jump to next ensemble
-      if header == WAVESID:
-         print("Wave data found\n")
-         infile.seek(length+2,1)
-         continue
-
-      # read up to the checksum
-      rawEnsemble = infile.read(length-4)
-
-      # Read the current ensemble and get the data
-      re = readEnsemble(rawEnsemble)
-      re.readEnsembleData()
-     
-      nbDataTypes = re.getEnsembleItem(0).GetNbDataTypes()
-      if nbDataTypes > 100:
-         raise IOError('Incorrect number of data types ({})'.format(nbDataTypes))
-
-      # Manage actions
-      if args.end_datetime != None and args.start_datetime != None:
-         if re.getEnsembleItem(2).getStartDateTime() > args.start_datetime and re.getEnsembleItem(2).getStartDateTime() < args.end_datetime :
-            if args.count != -1:
-               if elementCount < args.count:
-                  # both dates and a count
-                  outfile.write('{}'.format(re.write(coordSystem)))
-                  elementCount = elementCount + 1
-                  if args.size > 0:
-                     outfileSize = outfile.tell()
-               else:
-                  break
-            else:
-               # both dates only
-               outfile.write('{}'.format(re.write(coordSystem)))
-         # Stop just after end date
-         if re.getEnsembleItem(2).getStartDateTime() > args.end_datetime:
-            break
-      else:
-         if args.start_datetime != None:
-            if re.getEnsembleItem(2).getStartDateTime() > args.start_datetime:
-               if args.count != -1:
-                  if elementCount < args.count:
-                     # only start date and a count
-                     outfile.write('{}'.format(re.write(coordSystem)))
-                     elementCount = elementCount + 1
-                     if args.size > 0:
-                        outfileSize = outfile.tell()
-                  else:
-                     break
-               else:
-                  # only start date
-                  outfile.write('{}'.format(re.write(coordSystem)))
-         else:
-            if args.count != -1:
-                  if elementCount < args.count:
-                     # only count
-                     outfile.write('{}'.format(re.write(coordSystem)))
-                     elementCount = elementCount + 1
-                     if args.size > 0:
-                        outfileSize = outfile.tell()
-                  else:
-                     break
-            else:
-               # Total file
-               outfile.write('{}'.format(re.write(coordSystem)))
-               if args.size > 0:
-                  outfileSize = outfile.tell()
-
-      # get checksum
-      rawChecksum, checksum = __nextLittleEndianUnsignedShort(infile)
-
-      computedChecksum = __computeChecksum(rawHeader, rawLength, rawEnsemble)
-
-      if checksum != computedChecksum:
-         print('Position:{}\tSize to read:{}'.format(hex(infile.tell()),length))
-         print('Checksum error\nChecksum:{}\tComputed:{}'.format(checksum,computedChecksum))
-         outfile.write('Checksum error::{}'.format(checksum))
-         #raise IOError('Checksum error\nChecksum:{}\tComputed:{}'.format(checksum,computedChecksum))
- 	
-      # TODO: Manage output file size here
-      if outfileSize >= (args.size*1000) and args.size > 0:
-        outfile.close()
-        try:
-           outfile = open('{}{}.{}'.format(args.outfile.split('.')[0],fileCount+1,args.outfile.split('.')[1]),'w')
-           fileCount += 1
-        except:
-           raise IOError('Unable to create file {}{}'.format(args.outfile,fileCount+1)) 
-      
-      try:
-         rawHeader, header = __nextLittleEndianUnsignedShort(infile)
-      except st.error:
-         break
-         
+   outfile, averager, quality = openWriter(args, args.outfile, coordSystem, outputTypes)
+
+   # Fixed leaders decoded once per configuration, changes reported at the end
+   fixedLeaders = WHFixedLeaderCache()
+   if live:
+      scanner = convertLive(args, infile, outfile, decodedTypes, fixedLeaders)
+   else:
+      scanner = convertFile(args, infile, outfile, decodedTypes, fixedLeaders)
+
+   scanner.printReport()
+   fixedLeaders.printReport()
+   if quality != None:
+      quality.printReport()
+   if averager != None:
+      averager.printReport()
    infile.close()
    outfile.close()
 
@@ -0,0 +1,116 @@
+#!/usr/bin/python
+#-*- coding: utf-8 -*-
+
+import datetime
+import struct as st
+import numpy as np
+
+from utils.pyGeneralClass import *
+
+# Start time of the first ensemble and seconds between two ensembles
+STARTDATETIME = datetime.datetime(2020, 5, 17, 12, 0, 0)
+INTERVAL = 7
+# Profiles of the synthetic ensembles, in their order
+PROFILETYPES = (VELOCITYPROFILE, CORRELATIONPROFILE, INTENSITYPROFILE, PERCENTGOODPROFILE)
+# Share of bad beam velocities
+BADVELOCITYRATIO = 0.05
+
+#----------------------------------------
+#---  Synthetic PD0 ensembles         ---
+#----------------------------------------
+# Return the raw fixed leader of a 30 degree, 4 beams configuration,
+# facing up (180) or down (0)
+def makeFixedLeader(nbCells=20, nbBeams=4, cellLength=100, facing=180):
+   fl = np.zeros(1, dtype=FIXEDLEADERDTYPE)
+   fl['FixedLeaderID'] = FIXEDLEADER
+   fl['CPUVersion'] = 50
+   fl['CPURevision'] = 40
+   fl['SystemConfiguration'] = 0b11001010 | ((0b01000001 if facing == 180 else 0b01000000) << 8)
+   fl['NumberOfBeams'] = nbBeams
+   fl['NumberOfCells'] = nbCells
+   fl['PingsPerEnsemble'] = 60
+   fl['DepthCellLength'] = cellLength
+   fl['BlanckAfterTransmit'] = 176
+   fl['LowCorrThreshold'] = 64
+   fl['PercentMinimumGood'] = 25
+   fl['ErrorVelocityThreshold'] = 2000
+   fl['SensorSource'] = 0b01111101
+   fl['SensorAvailable'] = 0b00111101
+   fl['Bin1Distance'] = 317
+   fl['BeamAngle'] = 20
+   return(fl.tobytes())
+
+# Return the raw variable leader of the ensemble <number>, started <number>
+# intervals after <start>, with a heading, pitch and roll from <rng>
+def makeVariableLeader(number, rng, start=STARTDATETIME, interval=INTERVAL):
+   dt = start + datetime.timedelta(seconds=number*interval)
+   vl = np.zeros(1, dtype=VARIABLELEADERDTYPE)
+   vl['VariableLeaderID'] = VARIABLELEADER
+   vl['EnsembleNumber'] = number % 65535
+   vl['EnsembleMSB'] = number // 65535
+   for prefix in ('RTC', 'Y2KRTC'):
+      vl[prefix + 'Year'] = dt.year % 100
+      vl[prefix + 'Month'] = dt.month
+      vl[prefix + 'Day'] = dt.day
+      vl[prefix + 'Hundreds'] = dt.microsecond // 10000
+   vl['RTCHour'], vl['Y2KRTCHour'] = dt.hour, dt.hour
+   vl['RTCMinute'], vl['Y2KRTCMinute'] = dt.minute, dt.minute
+   vl['RTCSecond'], vl['Y2KRTCSecond'] = dt.second, dt.second
+   vl['Y2KRTCentury'] = dt.year // 100
+   vl['SpeedOfSound'] = 1500
+   vl['DepthOfTransducer'] = 120
+   vl['Heading'] = rng.integers(0, 36000)
+   vl['Pitch'] = rng.integers(-500, 500)
+   vl['Roll'] = rng.integers(-500, 500)
+   vl['Salinity'] = 35
+   vl['Temperature'] = 1234
+   vl['Pressure'] = 123456
+   return(vl.tobytes())
+
+# Return the raw profile <dataType> [cell, beam] of random values
+def makeProfile(dataType, nbCells, nbBeams, rng):
+   shape = (nbCells, nbBeams)
+   if dataType == VELOCITYPROFILE:
+      values = rng.integers(-2000, 2000, shape).astype('<i2')
+      values[rng.random(shape) < BADVELOCITYRATIO] = BADVELOCITY
+   elif dataType == CORRELATIONPROFILE:
+      values = rng.integers(40, 256, shape).astype('u1')
+   elif dataType == PERCENTGOODPROFILE:
+      values = rng.integers(0, 101, shape).astype('u1')
+   else:
+      values = rng.integers(0, 256, shape).astype('u1')
+   return(st.pack('<H', dataType) + values.tobytes())
+
+# Return the ensemble <number> from its header ID to its checksum, the
+# values are drawn from <seed> and <number>. The checksum is wrong with
+# <badChecksum>.
+def makeEnsemble(number, nbCells=20, nbBeams=4, cellLength=100, facing=180, dataTypes=PROFILETYPES,
+                 seed=0, start=STARTDATETIME, interval=INTERVAL, badChecksum=False):
+   rng = np.random.default_rng([seed, number])
+   parts = [makeFixedLeader(nbCells, nbBeams, cellLength, facing), makeVariableLeader(number, rng, start, interval)]
+   parts.extend(makeProfile(dataType, nbCells, nbBeams, rng) for dataType in dataTypes)
+   offset = 6 + 2*len(parts)
+   offsets = []
+   for part in parts:
+      offsets.append(offset)
+      offset = offset + len(part)
+   ensemble = st.pack('<HHBB', PD0HEADERID, offset, 0, len(parts)) + st.pack('<{}H'.format(len(parts)), *offsets) + b''.join(parts)
+   checksum = sum(ensemble) & 0xffff
+   if badChecksum:
+      checksum = checksum ^ 1
+   return(ensemble + st.pack('<H', checksum))
+
+# Return a waves ensemble (skipped by the scanner) of <size> bytes of data
+def makeWaves(size=16):
+   waves = st.pack('<HH', WAVESID, 4 + size) + bytes(size)
+   return(waves + st.pack('<H', sum(waves) & 0xffff))
+
+# Return the ensembles <numbers> joined (see makeEnsemble)
+def makeEnsembles(numbers, **options):
+   return(b''.join(makeEnsemble(number, **options) for number in numbers))
+
+# Write <data> in the file <filename>, return its name
+def writePD0(filename, data):
+   with open(filename, 'wb') as pd0:
+      pd0.write(data)
+   return(str(filename))
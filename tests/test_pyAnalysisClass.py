@@ -0,0 +1,67 @@
+#!/usr/bin/python
+#-*- coding: utf-8 -*-
+
+import numpy as np
+
+from utils.pyArrayClass import *
+from pd0Generator import makeEnsembles
+
+# Return the arrays and the readEnsemble of the ensembles of <data>
+def decode(data):
+   arrays = WHEnsembleArrays()
+   arrays.readEnsembleArrays(data)
+   ensembles = []
+   for offset in arrays.offsets:
+      length = int(data[offset+2]) | (int(data[offset+3]) << 8)
+      re = readEnsemble(data[offset+4:offset+length])
+      re.readEnsembleData()
+      ensembles.append(re)
+   return(arrays, ensembles)
+
+# XYZ velocities [cell, 4] of <re> computed cell by cell with the 4 and 3 beams solutions
+def getCellByCellXYZ(re):
+   a, b, c, d = [x[0] for x in getBeamConstants([re.fh.getBeamAngle()], re.fh.getConcaveOrConvex())]
+   xyz = np.zeros((re.fh.getNumberOfCells(), 4))
+   for cell in range(re.fh.getNumberOfCells()):
+      nbValid, vels = re.correlationTest(cell)
+      if nbValid == 4:
+         xyz[cell] = re.getFourBeamSolution(a, b, c, d, vels)
+      elif nbValid == 3:
+         xyz[cell] = re.getThreeBeamSolution(a, b, c, d, vels)
+   return(xyz)
+
+# Rotation matrix from instrument to earth coordinates of <re>
+def getRotationMatrix(re):
+   pitch, roll = re.vh.getPitch(), re.vh.getRoll()
+   if re.fh.getUsePitchSensor():
+      pitch = np.arctan(np.tan(pitch)*np.cos(roll))
+   SH = np.sin(np.radians(re.vh.getHeading()+re.fh.getHeadingAlignment()))
+   CH = np.cos(np.radians(re.vh.getHeading()+re.fh.getHeadingAlignment()))
+   SP, CP = np.sin(np.radians(pitch)), np.cos(np.radians(pitch))
+   SR = np.sin(np.radians(roll+re.fh.getFacingBeam()))
+   CR = np.cos(np.radians(roll+re.fh.getFacingBeam()))
+   return(np.array([[(CH*CR)+(SH*SP*SR),  SH*CP, (CH*SR)-(SH*SP*CR), 0],
+                    [(-SH*CR)+(CH*SP*SR), CH*CP, (-SH*SR)-(CH*SP*CR), 0],
+                    [-CP*SR,              SP,    CP*CR,               0],
+                    [0,                   0,     0,                   1]]))
+
+# The batched transformation gives the cell by cell one, with 3 beams cells
+def test_beam_to_xyz():
+   arrays, ensembles = decode(makeEnsembles(range(1, 21)))
+   nbValid = arrays.correlationTestArray()[1].sum(axis=-1)
+   assert (nbValid == 3).any() and (nbValid < 3).any()
+   xyz = arrays.BeamToXYZ()
+   for n, re in enumerate(ensembles):
+      expected = getCellByCellXYZ(re)
+      assert np.allclose(xyz[n], expected)
+      assert np.allclose(re.BeamToXYZ().transpose(), expected)
+
+# The batched rotation gives the matrix product of each ensemble, facing up and down
+def test_beam_to_enu():
+   for facing in (0, 180):
+      arrays, ensembles = decode(makeEnsembles(range(1, 11), facing=facing))
+      enu = arrays.BeamToENU()
+      for n, re in enumerate(ensembles):
+         expected = np.dot(getCellByCellXYZ(re), getRotationMatrix(re))
+         assert np.allclose(enu[n], expected)
+         assert np.allclose(re.BeamToENU().transpose(), expected)
@@ -0,0 +1,201 @@
+#!/usr/bin/python
+#-*- coding: utf-8 -*-
+
+import datetime
+import numpy as np
+import pytest
+
+import utils.pyArrayClass as pyArrayClass
+from utils.pyArrayClass import *
+from pd0Generator import makeEnsemble, makeEnsembles
+
+# Decoded by readEnsemble, one ensemble at a time
+def readEnsembles(data, offsets):
+   ensembles = []
+   for offset in offsets:
+      length = int(data[offset+2]) | (int(data[offset+3]) << 8)
+      re = readEnsemble(data[offset+4:offset+length])
+      re.readEnsembleData()
+      ensembles.append(re)
+   return(ensembles)
+
+# The columnar decoder gives the values of readEnsemble
+def test_ensemble_arrays_match_read_ensemble():
+   data = b'\x00garbage' + makeEnsembles(range(1, 31))
+   arrays = WHEnsembleArrays()
+   assert arrays.readEnsembleArrays(data) == 30
+   assert arrays.getNumberOfCells() == 20 and arrays.getNumberOfBeams() == 4
+   assert arrays.dataTypes == [FIXEDLEADER, VARIABLELEADER] + list(DATATYPES.values())
+   ensembles = readEnsembles(data, arrays.offsets)
+   assert arrays.getElementNumber().tolist() == [re.vh.getElementNumber() for re in ensembles]
+   assert np.allclose(arrays.getHeading(), [re.vh.getHeading() for re in ensembles])
+   assert np.allclose(arrays.getPitch(), [re.vh.getPitch() for re in ensembles])
+   for n, re in enumerate(ensembles):
+      assert np.array_equal(arrays.velocity[n], re.v.getVelocityArray())
+      assert np.array_equal(arrays.correlation[n], re.corr.getCorrelationArray())
+      assert np.array_equal(arrays.intensity[n], re.inty.getIntensityArray())
+      assert np.array_equal(arrays.percentGood[n], re.pg.getPercentGoodArray())
+
+# The ensembles are found after the garbage, the bad ones are skipped
+def test_ensemble_offsets():
+   good = makeEnsemble(1)
+   data = b'\x7f\x7fjunk' + good + makeEnsemble(2, badChecksum=True) + good
+   assert getEnsembleOffsets(data).tolist() == [6, 6 + 2*len(good)]
+
+# The profiles have one shape, a change of the number of cells is an error
+def test_ensemble_arrays_cells_change():
+   data = makeEnsembles(range(1, 4)) + makeEnsembles(range(4, 6), nbCells=30)
+   with pytest.raises(IOError):
+      WHEnsembleArrays().readEnsembleArrays(data)
+
+# Only the selected profiles are decoded, the other ones are None
+def test_ensemble_arrays_data_types():
+   data = makeEnsembles(range(1, 11))
+   arrays = WHEnsembleArrays()
+   arrays.readEnsembleArrays(data)
+   selected = WHEnsembleArrays()
+   selected.readEnsembleArrays(data, dataTypes=[INTENSITYPROFILE, PERCENTGOODPROFILE])
+   assert selected.velocity is None and selected.correlation is None
+   assert np.array_equal(selected.intensity, arrays.intensity)
+   assert np.array_equal(selected.percentGood, arrays.percentGood)
+   leaders = WHEnsembleArrays()
+   leaders.readEnsembleArrays(data, dataTypes=[])
+   assert np.array_equal(leaders.variableLeader, arrays.variableLeader)
+   assert leaders.velocity is None and leaders.intensity is None
+
+# readEnsemble decodes and writes only the selected profiles
+def test_read_ensemble_data_types():
+   data = makeEnsemble(1)
+   re = readEnsemble(data[4:])
+   re.readEnsembleData([VELOCITYPROFILE])
+   assert [item.getType() for item in re.ensembleList[1:]] == [FIXEDLEADER, VARIABLELEADER, VELOCITYPROFILE]
+   full = readEnsemble(data[4:])
+   full.readEnsembleData()
+   assert re.write() == full.write(dataTypes=[VELOCITYPROFILE])
+
+# The segments split the ensembles at each change of the shape or of the cell length
+def test_configuration_segments():
+   data = makeEnsembles(range(1, 6)) + makeEnsembles(range(6, 9), facing=0) + makeEnsembles(range(9, 13), nbCells=30) \
+          + makeEnsembles(range(13, 15), nbCells=30, cellLength=50) + makeEnsembles(range(15, 17))
+   leaders = WHEnsembleArrays()
+   leaders.readLeaderArrays(data)
+   assert getConfigurationSegments(leaders.fixedLeader) == [slice(0, 8), slice(8, 12), slice(12, 14), slice(14, 16)]
+   assert getConfigurationSegments(leaders.fixedLeader[:0]) == []
+   segments = readSegmentArrays(data, dataTypes=[VELOCITYPROFILE], cells=slice(0, 25))
+   assert [arrays.getElementNumber().tolist() for arrays in segments] == [list(range(1, 9)), list(range(9, 13)),
+                                                                          [13, 14], [15, 16]]
+   assert [arrays.getConfiguration() for arrays in segments[1:3]] == [
+      {'NumberOfCells': 30, 'NumberOfBeams': 4, 'DepthCellLength': 100},
+      {'NumberOfCells': 30, 'NumberOfBeams': 4, 'DepthCellLength': 50}]
+   for arrays in segments:
+      ensembles = readEnsembles(data, arrays.offsets)
+      for n, re in enumerate(ensembles):
+         assert np.array_equal(arrays.velocity[n], re.v.getVelocityArray()[:25])
+
+# The ensembles of a slice are views of the arrays
+def test_ensemble_arrays_get_ensembles():
+   arrays = WHEnsembleArrays()
+   arrays.readEnsembleArrays(makeEnsembles(range(1, 11)))
+   part = arrays.getEnsembles(slice(2, 5))
+   assert part.getElementNumber().tolist() == [3, 4, 5]
+   assert np.shares_memory(part.velocity, arrays.velocity)
+   assert part.getConfiguration() == arrays.getConfiguration()
+   assert arrays.getEnsembles(slice(0, 0)).getConfiguration() is None
+
+# The datetime64 of valid fields are the datetime ones, the invalid fields are NaT
+def test_date_time_array():
+   fields = [(2020, 2, 29, 23, 59, 59, 99), (1999, 12, 31, 0, 0, 0, 0), (2068, 1, 1, 12, 30, 5, 50),
+             (1969, 7, 20, 20, 17, 40, 1)]
+   invalid = [(2021, 2, 29, 0, 0, 0, 0), (2020, 0, 1, 0, 0, 0, 0), (2020, 13, 1, 0, 0, 0, 0), (2020, 4, 31, 0, 0, 0, 0),
+              (2020, 1, 0, 0, 0, 0, 0), (2020, 1, 1, 24, 0, 0, 0), (2020, 1, 1, 0, 60, 0, 0), (2020, 1, 1, 0, 0, 0, 100)]
+   times = getDateTimeArray(*np.array(fields + invalid).T)
+   expected = [datetime.datetime(*x[:6], microsecond=x[6]*10000) for x in fields]
+   assert times[:len(fields)].tolist() == expected
+   assert np.isnat(times[len(fields):]).all()
+   years = np.arange(0, 256)
+   expected = [datetime.datetime.strptime('{:02d}'.format(year), '%y').year if year <= 99 else -1 for year in years]
+   assert getFullYears(years).tolist() == expected
+
+# The times of the arrays are the ones of the variable leaders, NaT when not valid
+def test_ensemble_arrays_date_time():
+   data = makeEnsembles(range(1, 11), start=datetime.datetime(2068, 12, 31, 23, 59, 0))
+   arrays = WHEnsembleArrays()
+   arrays.readLeaderArrays(data)
+   ensembles = readEnsembles(data, arrays.offsets)
+   assert arrays.getStartDateTime().tolist() == [re.vh.getStartDateTime() for re in ensembles]
+   assert arrays.getDateTime().tolist() == [re.vh.getDateTime() for re in ensembles]
+   arrays.variableLeader = arrays.variableLeader.copy()
+   arrays.variableLeader['RTCMonth'][3] = 13
+   arrays.variableLeader['Y2KRTCHundreds'][4] = 100
+   assert np.isnat(arrays.getStartDateTime()).tolist() == [n == 3 for n in range(10)]
+   assert np.isnat(arrays.getDateTime()).tolist() == [n == 4 for n in range(10)]
+
+# The range of cells decoded is the one of all the cells, in every coordinate system
+def test_ensemble_arrays_cells():
+   data = makeEnsembles(range(1, 11))
+   arrays, selected = WHEnsembleArrays(), WHEnsembleArrays()
+   arrays.readEnsembleArrays(data)
+   selected.readEnsembleArrays(data, cells=slice(2, 7))
+   assert selected.getNumberOfCells() == 5 and selected.firstCell == 2
+   for name in ('velocity', 'correlation', 'intensity', 'percentGood'):
+      assert np.array_equal(getattr(selected, name), getattr(arrays, name)[:,2:7])
+   for coordinates in ('BEAM', 'INSTRUMENT', 'EARTH'):
+      assert np.allclose(selected.getVelocity(coordinates), arrays.getVelocity(coordinates)[:,2:7], equal_nan=True)
+   assert np.allclose(selected.getBinDepths(), arrays.getBinDepths()[:,2:7])
+   for n, re in enumerate(readEnsembles(data, arrays.offsets)):
+      part = readEnsemble(makeEnsemble(n+1)[4:])
+      part.readEnsembleData(cells=slice(2, 7))
+      assert np.array_equal(part.v.getVelocityArray(), re.v.getVelocityArray()[2:7])
+      assert np.array_equal(part.pg.getPercentGoodArray(), re.pg.getPercentGoodArray()[2:7])
+
+# The corrected depths of the cells are the ones of readEnsemble, facing up
+# and down, from the first cell decoded
+def test_corrected_cell_depth():
+   for facing in (0, 180):
+      data = makeEnsembles(range(1, 6), facing=facing)
+      arrays, selected = WHEnsembleArrays(), WHEnsembleArrays()
+      arrays.readEnsembleArrays(data)
+      selected.readEnsembleArrays(data, cells=slice(4, 9))
+      for n, re in enumerate(readEnsembles(data, arrays.offsets)):
+         assert np.allclose(arrays.getCorrectedCellDepth()[n], re.getCorrectedCellDepth())
+         assert np.allclose(selected.getCorrectedCellDepth()[n], re.getCorrectedCellDepth()[4:9])
+
+# The DataFrame holds the leaders, indexed by the start time of the ensembles
+def test_ensemble_arrays_data_frame():
+   pytest.importorskip('pandas')
+   arrays = WHEnsembleArrays()
+   arrays.readEnsembleArrays(makeEnsembles(range(1, 11)))
+   frame = arrays.toDataFrame()
+   assert list(frame.columns) == list(VARIABLELEADERDTYPE.names)
+   assert np.array_equal(frame.index.values, arrays.getStartDateTime().astype('M8[ns]'))
+   assert frame['EnsembleNumber'].tolist() == list(range(1, 11))
+   assert np.array_equal(frame['Heading'].values, arrays.variableLeader['Heading'])
+   frame = arrays.toDataFrame(fixedLeader=True)
+   assert frame['NumberOfCells'].tolist() == [20]*10
+
+# The Dataset holds the profiles [time, cell, beam] with the cell depths
+def test_ensemble_arrays_xarray():
+   pytest.importorskip('xarray')
+   arrays = WHEnsembleArrays()
+   arrays.readEnsembleArrays(makeEnsembles(range(1, 11)), cells=slice(2, 7))
+   dataset = arrays.toXarray()
+   assert dataset['velocity'].dims == PROFILEDIMS and dataset['velocity'].shape == (10, 5, 4)
+   assert np.array_equal(dataset['velocity'].values, arrays.velocity)
+   assert dataset['cell'].values.tolist() == [3, 4, 5, 6, 7]
+   assert dataset['ensemble'].values.tolist() == list(range(1, 11))
+   assert np.allclose(dataset['depth'].values, arrays.getCorrectedCellDepth())
+   assert np.array_equal(dataset['percentGood'].values, arrays.percentGood.view(np.int8))
+   assert dataset.attrs['orientation'] == 'up' and dataset.attrs['nbCells'] == 5
+   earth = arrays.toXarray('EARTH')
+   assert np.allclose(earth['velocity'].values, arrays.getVelocity('EARTH'), equal_nan=True)
+
+# Without pandas or xarray the views are an ImportError
+def test_ensemble_arrays_views_missing(monkeypatch):
+   arrays = WHEnsembleArrays()
+   arrays.readEnsembleArrays(makeEnsembles(range(1, 4)))
+   monkeypatch.setattr(pyArrayClass, 'pd', None)
+   monkeypatch.setattr(pyArrayClass, 'xr', None)
+   with pytest.raises(ImportError, match='pandas'):
+      arrays.toDataFrame()
+   with pytest.raises(ImportError, match='xarray'):
+      arrays.toXarray()
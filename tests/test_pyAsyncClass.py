@@ -0,0 +1,72 @@
+#!/usr/bin/python
+#-*- coding: utf-8 -*-
+
+import asyncio
+import pytest
+
+from utils.pyAsyncClass import *
+from pd0Generator import makeEnsembles, writePD0
+
+# Writer keeping the arrays written, closed at the end of its source
+class ArraysWriter():
+   def __init__(self):
+      self.blocks = []
+      self.closed = False
+
+   def writeArrays(self, arrays):
+      self.blocks.append(arrays)
+
+   def flush(self):
+      pass
+
+   def close(self):
+      self.closed = True
+
+   def getElementNumbers(self):
+      return([number for arrays in self.blocks for number in arrays.getElementNumber().tolist()])
+
+# Every source is written by its own writer, by configuration segment
+def test_pipeline_files(tmp_path):
+   first = writePD0(tmp_path / 'first.000', makeEnsembles(range(1, 41)))
+   second = writePD0(tmp_path / 'second.000', makeEnsembles(range(1, 11)) + makeEnsembles(range(11, 21), nbCells=30))
+   pipeline = WHAsyncPipeline(queueSize=2, reportInterval=0, chunkSize=1000)
+   writers = [ArraysWriter(), ArraysWriter()]
+   pipeline.addSource(first, writers[0])
+   pipeline.addSource(second, writers[1], [VELOCITYPROFILE])
+   asyncio.run(pipeline.run())
+   assert writers[0].getElementNumbers() == list(range(1, 41))
+   assert writers[1].getElementNumbers() == list(range(1, 21))
+   assert set(arrays.getNumberOfCells() for arrays in writers[1].blocks) == {20, 30}
+   assert all(arrays.intensity is None for arrays in writers[1].blocks)
+   assert [(stats.nbReceived, stats.nbWritten) for stats in pipeline.getStats()] == [(40, 40), (20, 20)]
+   assert writers[0].closed and writers[1].closed
+
+# A TCP source is read up to the closing of the connection
+def test_pipeline_tcp():
+   data = makeEnsembles(range(1, 31))
+   writer = ArraysWriter()
+
+   async def send(reader, connection):
+      connection.write(data)
+      await connection.drain()
+      connection.close()
+
+   async def run():
+      server = await asyncio.start_server(send, '127.0.0.1', 0)
+      pipeline = WHAsyncPipeline(reportInterval=0)
+      pipeline.addSource('{}127.0.0.1:{}'.format(TCPPREFIX, server.sockets[0].getsockname()[1]), writer)
+      await pipeline.run()
+      server.close()
+      await server.wait_closed()
+
+   asyncio.run(run())
+   assert writer.getElementNumbers() == list(range(1, 31))
+
+# A source that cannot be opened ends its sink, the writer is closed
+def test_pipeline_missing_source(tmp_path):
+   writer = ArraysWriter()
+   pipeline = WHAsyncPipeline(reportInterval=0)
+   pipeline.addSource(str(tmp_path / 'missing'), writer)
+   with pytest.raises(FileNotFoundError):
+      asyncio.run(asyncio.wait_for(pipeline.run(), 10))
+   assert writer.closed and writer.blocks == []
@@ -0,0 +1,88 @@
+#!/usr/bin/python
+#-*- coding: utf-8 -*-
+
+import numpy as np
+import pytest
+
+from utils.pyAverageClass import *
+from pd0Generator import STARTDATETIME, makeEnsembles
+
+# Writer keeping the bins written
+class BinsWriter():
+   def __init__(self):
+      self.bins = []
+
+   def writeArrays(self, arrays):
+      self.bins.extend(arrays.getEnsembles(slice(n, n+1)) for n in range(arrays.getNumberOfEnsembles()))
+
+   def flush(self):
+      pass
+
+   def close(self):
+      pass
+
+# Average the ensembles of <data> decoded by blocks of <blockSize> ensembles, return the bins
+def average(data, blockSize, **options):
+   writer = BinsWriter()
+   averager = WHEnsembleAverager(writer, **options)
+   offsets = getEnsembleOffsets(data)
+   for first in range(0, len(offsets), blockSize):
+      for arrays in readSegmentArrays(data, offsets[first:first+blockSize]):
+         averager.writeArrays(arrays)
+   averager.close()
+   return(writer.bins)
+
+# Check the averages of <bins> against the ensembles <groups> (position
+# slices of the WHEnsembleArrays <arrays>) averaged one by one
+def checkAverages(bins, arrays, groups, coordinates='BEAM'):
+   assert len(bins) == len(groups)
+   vels = arrays.getVelocity(coordinates)
+   if coordinates != 'BEAM':
+      vels, nbValid = vels.copy(), arrays.correlationTestArray()[1].sum(axis=-1)
+      vels[nbValid < 3] = np.nan
+      vels[...,3][nbValid < 4] = np.nan
+   for bin, group in zip(bins, groups):
+      assert bin.getElementNumber()[0] == arrays.getElementNumber()[group][0]
+      assert bin.fields['nbEnsembles'][0][0] == len(arrays.getElementNumber()[group])
+      assert np.isclose(bin.fields['pitch'][0][0], arrays.getPitch()[group].mean())
+      headings = np.radians(arrays.getHeading()[group])
+      assert np.isclose(bin.fields['heading'][0][0], np.degrees(np.arctan2(np.sin(headings).sum(), np.cos(headings).sum())) % 360)
+      count = (~np.isnan(vels[group])).sum(axis=0)
+      with np.errstate(invalid='ignore'):
+         mean = np.nansum(vels[group], axis=0) / count
+      assert np.allclose(bin.fields['velocity'][0][0], mean, equal_nan=True, atol=1e-6)
+      assert np.array_equal(bin.fields['velocityCount'][0][0], count)
+      assert np.allclose(bin.fields['intensity'][0][0], INTENSITYDB[arrays.intensity[group]].mean(axis=0))
+
+# The bins of a number of ensembles are counted from the start of each
+# configuration, whatever the block boundaries
+def test_averager_size_segments():
+   data = makeEnsembles(range(1, 11)) + makeEnsembles(range(11, 18), nbCells=30) + makeEnsembles(range(18, 23))
+   segments = readSegmentArrays(data)
+   groups = [[slice(0, 4), slice(4, 8), slice(8, 10)], [slice(0, 4), slice(4, 7)], [slice(0, 4), slice(4, 5)]]
+   for blockSize in (3, 4, 100):
+      bins = average(data, blockSize, size=4)
+      assert [bin.fields['nbEnsembles'][0][0] for bin in bins] == [4, 4, 2, 4, 3, 4, 1]
+      checkAverages(bins[:3], segments[0], groups[0])
+      checkAverages(bins[3:5], segments[1], groups[1])
+      checkAverages(bins[5:], segments[2], groups[2])
+
+# The bins of an interval hold the ensembles started in the same interval
+# from midnight, their vector averages skip the cells with too few beams
+def test_averager_interval():
+   data = makeEnsembles(range(1, 41))
+   arrays = readSegmentArrays(data)[0]
+   ms = arrays.getStartDateTime().astype(np.int64)
+   ids = ms // 30000
+   starts = np.concatenate([[0], np.flatnonzero(ids[1:] != ids[:-1]) + 1, [len(ids)]])
+   groups = [slice(start, stop) for start, stop in zip(starts[:-1], starts[1:])]
+   for coordinates in ('BEAM', 'EARTH'):
+      bins = average(data, 6, interval=30, coordinates=coordinates)
+      checkAverages(bins, arrays, groups, coordinates)
+      assert [bin.fields['dateTime'][0][0] for bin in bins] == [np.datetime64(int(ids[group][0])*30000, 'ms') for group in groups]
+
+# The averager needs either an interval or a number of ensembles, positive
+def test_averager_arguments():
+   for options in ({}, {'interval': 30, 'size': 4}, {'interval': 0}, {'size': 0}):
+      with pytest.raises(ValueError):
+         WHEnsembleAverager(BinsWriter(), **options)
@@ -0,0 +1,150 @@
+#!/usr/bin/python
+#-*- coding: utf-8 -*-
+
+import os
+import json
+import zipfile
+import numpy as np
+import pytest
+
+import utils.pyExportClass as pyExportClass
+from utils.pyArrayClass import WHEnsembleArrays, readSegmentArrays
+from utils.pyExportClass import *
+from pd0Generator import makeEnsemble, makeEnsembles
+
+# Return the arrays of the ensembles <numbers>
+def decode(numbers, **options):
+   arrays = WHEnsembleArrays()
+   arrays.readEnsembleArrays(makeEnsembles(numbers, **options))
+   return(arrays)
+
+# The header is rewritten on each flush, it must keep its first size
+def test_npy_file_structured_dtype(tmp_path):
+   dtype = np.dtype([('field{:02d}'.format(i), '<i4') for i in range(3)])
+   values = np.arange(15, dtype='<i4').view(dtype)
+   filename = os.path.join(str(tmp_path), 'structured.npy')
+   npyFile = WHNpyFile(filename, dtype, ())
+   npyFile.append(values[:2])
+   npyFile.flush()
+   npyFile.append(values[2:])
+   npyFile.close()
+   loaded = np.load(filename)
+   assert loaded.dtype == dtype
+   assert np.array_equal(loaded, values)
+
+# The fields appended block by block are loaded as the whole arrays, from
+# the directory or from the .npz bundle
+def test_npy_writer(tmp_path):
+   arrays = decode(range(1, 21))
+   for name in ('ensembles', 'ensembles.npz'):
+      filename = os.path.join(str(tmp_path), name)
+      writer = WHNpyWriter(filename, 'EARTH')
+      writer.writeArrays(arrays.getEnsembles(slice(0, 8)))
+      writer.flush()
+      writer.writeArrays(arrays.getEnsembles(slice(8, 20)))
+      writer.close()
+      if writer.bundle:
+         assert not os.path.exists(writer.directory)
+         with zipfile.ZipFile(filename) as npz:
+            header = json.loads(npz.read('header.json'))
+         fields = np.load(filename)
+      else:
+         with open(os.path.join(filename, 'header.json')) as headerFile:
+            header = json.load(headerFile)
+         fields = dict((field, np.load(os.path.join(filename, field + '.npy'), mmap_mode='r')) for field in header['fields'])
+      assert header['nbEnsembles'] == 20 and header['nbCells'] == 20
+      assert header['fields']['velocity']['units'] == 'm s-1'
+      assert np.allclose(fields['velocity'], arrays.getVelocity('EARTH'))
+      assert fields['ensembleNumber'].tolist() == list(range(1, 21))
+      assert np.array_equal(fields['fixedLeader'], arrays.fixedLeader)
+
+# The ensembles appended by blocks are read back from the chunked HDF5 file
+def test_hdf5_writer(tmp_path):
+   h5py = pytest.importorskip('h5py')
+   arrays = decode(range(1, 21))
+   filename = os.path.join(str(tmp_path), 'ensembles.nc')
+   writer = WHHdf5Writer(filename, 'BEAM', chunkSize=8)
+   writer.writeArrays(arrays.getEnsembles(slice(0, 5)))
+   writer.writeArrays(arrays.getEnsembles(slice(5, 20)))
+   writer.close()
+   with h5py.File(filename, 'r') as h5:
+      assert h5['velocity'].shape == (20, 20, 4)
+      assert h5['velocity'].chunks == (8, 20, 4)
+      assert np.allclose(h5['velocity'][...], arrays.getVelocity('BEAM'), equal_nan=True)
+      assert np.array_equal(h5['time'][...], arrays.getStartDateTime().astype(np.int64))
+      assert np.allclose(h5['cell'][...], arrays.getBinDepths()[0])
+      assert h5.attrs['nbCells'] == 20 and h5.attrs['orientation'] == 'up'
+
+# A missing h5py is reported when the writer is opened
+def test_hdf5_writer_missing_h5py(tmp_path, monkeypatch):
+   monkeypatch.setattr(pyExportClass, 'h5py', None)
+   with pytest.raises(ImportError, match='h5py'):
+      openBinaryWriter(os.path.join(str(tmp_path), 'ensembles.h5'))
+
+# One row per ensemble, the profiles flattened cell major, in Parquet and Arrow files
+def test_parquet_writer(tmp_path):
+   pa = pytest.importorskip('pyarrow')
+   import pyarrow.parquet as pq
+   arrays = decode(range(1, 21))
+   for name in ('ensembles.parquet', 'ensembles.arrow'):
+      filename = os.path.join(str(tmp_path), name)
+      writer = WHParquetWriter(filename, 'INSTRUMENT')
+      writer.writeArrays(arrays.getEnsembles(slice(0, 5)))
+      writer.writeArrays(arrays.getEnsembles(slice(5, 20)))
+      writer.close()
+      if writer.arrow:
+         with pa.memory_map(filename) as source:
+            table = pa.ipc.open_file(source).read_all()
+      else:
+         assert pq.ParquetFile(filename).metadata.num_row_groups == 2
+         table = pq.read_table(filename)
+      assert table.num_rows == 20
+      assert table.schema.metadata[b'coordinateSystem'] == b'INSTRUMENT'
+      velocity = np.array(table.column('velocity').to_pylist())
+      assert np.allclose(velocity, arrays.getVelocity('INSTRUMENT').reshape(20, -1))
+      assert table.column('fixedLeader.NumberOfCells').to_pylist() == [20]*20
+
+# A missing pyarrow is reported when the writer is opened
+def test_parquet_writer_missing_pyarrow(tmp_path, monkeypatch):
+   monkeypatch.setattr(pyExportClass, 'pa', None)
+   with pytest.raises(ImportError, match='pyarrow'):
+      openBinaryWriter(os.path.join(str(tmp_path), 'ensembles.parquet'))
+
+# The lines formatted by block are the lines of readEnsemble.write
+def test_text_formatter():
+   data = makeEnsembles(range(1, 11))
+   arrays = WHEnsembleArrays()
+   arrays.readEnsembleArrays(data)
+   for coordinates in ('BEAM', 'INSTRUMENT', 'EARTH'):
+      for dataTypes in (None, [VELOCITYPROFILE, INTENSITYPROFILE]):
+         lines = WHTextFormatter(coordinates, dataTypes).formatArrays(arrays)
+         for offset, line in zip(arrays.offsets, lines):
+            length = int(data[offset+2]) | (int(data[offset+3]) << 8)
+            re = readEnsemble(data[offset+4:offset+length], coordinates)
+            re.readEnsembleData()
+            assert line == re.write(dataTypes=dataTypes)
+
+# The text file is split every <size> kilo bytes, in ensembles1.txt, ...
+def test_text_writer_size(tmp_path, monkeypatch):
+   monkeypatch.chdir(tmp_path)
+   arrays = decode(range(1, 21))
+   writer = WHTextWriter('ensembles.txt', size=5)
+   lines = writer.formatArrays(arrays)
+   writer.writeArrays(arrays)
+   writer.close()
+   names = ['ensembles.txt'] + ['ensembles{}.txt'.format(n+1) for n in range(writer.fileCount)]
+   assert writer.fileCount > 1
+   assert ''.join(open(name).read() for name in names) == ''.join(lines)
+
+# Each configuration segment is written in its own file, numbered after the first
+def test_segmented_writer(tmp_path):
+   data = makeEnsembles(range(1, 6)) + makeEnsembles(range(6, 9), cellLength=50) + makeEnsembles(range(9, 13), nbCells=30)
+   filename = os.path.join(str(tmp_path), 'export.npz')
+   writer = WHSegmentedWriter(filename, 'EARTH')
+   for arrays in readSegmentArrays(data[:2*len(makeEnsemble(1))]) + readSegmentArrays(data[2*len(makeEnsemble(1)):]):
+      writer.writeArrays(arrays)
+   writer.close()
+   assert writer.filenames == [filename] + [os.path.join(str(tmp_path), 'export-{}.npz'.format(n)) for n in (2, 3)]
+   numbers = [np.load(name)['ensembleNumber'].tolist() for name in writer.filenames]
+   assert numbers == [list(range(1, 6)), list(range(6, 9)), list(range(9, 13))]
+   assert np.load(writer.filenames[2])['velocity'].shape == (4, 30, 4)
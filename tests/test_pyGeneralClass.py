@@ -0,0 +1,98 @@
+#!/usr/bin/python
+#-*- coding: utf-8 -*-
+
+import datetime
+import struct as st
+import numpy as np
+import pytest
+
+from utils.pyGeneralClass import *
+from utils.pyArrayClass import WHEnsembleArrays
+from pd0Generator import STARTDATETIME, INTERVAL, makeEnsemble, makeEnsembles, makeFixedLeader, makeVariableLeader
+
+# The tables hold the text and dB of each of the 256 one byte values
+def test_lookup_tables():
+   for value in range(256):
+      raw = bytes([value])
+      dB = 10 * np.log10(10**(0.045*st.unpack('B', raw)[0]/10))
+      assert INTENSITYDB[value] == dB
+      assert INTENSITYTEXT[value] == '{:.2f},'.format(dB)
+      assert CORRELATIONTEXT[value] == '{:.2f},'.format(st.unpack('B', raw)[0])
+      assert PERCENTGOODTEXT[value] == '{:3.1f},'.format(st.unpack('b', raw)[0])
+
+# The profiles are written value by value from the tables
+def test_profiles_write():
+   re = readEnsemble(makeEnsemble(1)[4:])
+   re.readEnsembleData()
+   intensity = re.inty.getIntensityArray().ravel().tolist()
+   percentGood = re.pg.getPercentGoodArray().ravel().tolist()
+   assert re.inty.write() == ''.join('{:.2f},'.format(10 * np.log10(10**(0.045*x/10))) for x in intensity)
+   assert re.corr.write() == ''.join('{:.2f},'.format(x) for x in re.corr.getCorrelationArray().ravel().tolist())
+   assert re.pg.write() == ''.join('{:3.1f},'.format(x - 256 if x > 127 else x) for x in percentGood)
+
+# The records hold the fields of the leaders decoded by their dtype
+def test_leader_records():
+   re = readEnsemble(makeEnsemble(3, nbCells=25)[4:])
+   re.readEnsembleData()
+   for raw, record, dtype in ((makeFixedLeader(25), re.fh.whFixedLeader, FIXEDLEADERDTYPE),
+                              (makeVariableLeader(3, np.random.default_rng([0, 3])), re.vh.whVariableLeader, VARIABLELEADERDTYPE)):
+      decoded = np.frombuffer(raw, dtype=dtype)[0]
+      assert record._fields == dtype.names
+      assert tuple(record) == decoded.tolist()
+   assert re.fh.getNumberOfCells() == 25
+   assert re.vh.getElementNumber() == 3
+   assert re.vh.getStartDateTime() == STARTDATETIME + datetime.timedelta(seconds=3*INTERVAL)
+
+# A leader shorter than its layout is an error
+def test_leader_truncated():
+   with pytest.raises(IOError, match='fixed leader'):
+      WHFixedLeader().readWHFixedLeader(0, makeFixedLeader()[:-1])
+   with pytest.raises(IOError, match='variable leader'):
+      WHVariableLeader().readWHVariableLeader(2, makeVariableLeader(1, np.random.default_rng(0)))
+
+# Return the ensembles <numbers> read through <fixedLeaders>, checked one by one
+def readChecked(fixedLeaders, numbers, **options):
+   ensembles = []
+   for number in numbers:
+      re = readEnsemble(makeEnsemble(number, **options)[4:], fixedLeaders=fixedLeaders)
+      re.readEnsembleData()
+      fixedLeaders.checkConfiguration(re)
+      ensembles.append(re)
+   return(ensembles)
+
+# The ensembles of a configuration share one fixed leader, the changes are recorded
+def test_fixed_leader_cache(capsys):
+   fixedLeaders = WHFixedLeaderCache()
+   ensembles = readChecked(fixedLeaders, range(1, 4)) + readChecked(fixedLeaders, range(4, 6), nbCells=30) \
+               + readChecked(fixedLeaders, range(6, 8))
+   assert ensembles[0].fh is ensembles[2].fh and ensembles[0].fh is ensembles[6].fh
+   assert ensembles[3].fh is ensembles[4].fh and ensembles[3].fh is not ensembles[2].fh
+   assert ensembles[0].fh.getBeamConstants() is ensembles[1].fh.getBeamConstants()
+   assert [(number, previous.getNumberOfCells(), fh.getNumberOfCells()) for number, previous, fh in fixedLeaders.changes] \
+          == [(4, 20, 30), (6, 30, 20)]
+   fixedLeaders.printReport()
+   lines = capsys.readouterr().out.splitlines()
+   assert lines[0] == 'Configuration changes: 2'
+   assert lines[1].startswith('\tEnsemble:4\t')
+
+# The changes of the arrays decoded by batches are the ones of the ensembles
+def test_fixed_leader_cache_arrays():
+   data = makeEnsembles(range(1, 6)) + makeEnsembles(range(6, 9), nbCells=30) + makeEnsembles(range(9, 13))
+   fixedLeaders, positions = WHFixedLeaderCache(), []
+   for batch in (data[:3*len(makeEnsemble(1))], data[3*len(makeEnsemble(1)):]):
+      leaders = WHEnsembleArrays()
+      leaders.readLeaderArrays(batch)
+      positions.append(fixedLeaders.checkConfigurationArrays(leaders))
+   assert positions == [[], [2, 5]]
+   assert [number for number, previous, fh in fixedLeaders.changes] == [6, 9]
+   assert fixedLeaders.changes[0][2].getRawEnsemble() == makeFixedLeader(30)
+
+# The cell range is a contiguous range among the cells
+def test_get_cell_range():
+   assert getCellRange(None, 20) == (0, 20)
+   assert getCellRange(slice(2, 7), 20) == (2, 7)
+   assert getCellRange(slice(5, None), 20) == (5, 20)
+   assert getCellRange(slice(15, 30), 20) == (15, 20)
+   assert getCellRange(slice(25, 30), 20) == (20, 20)
+   with pytest.raises(ValueError):
+      getCellRange(slice(0, 10, 2), 20)
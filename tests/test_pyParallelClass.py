@@ -0,0 +1,51 @@
+#!/usr/bin/python
+#-*- coding: utf-8 -*-
+
+import os
+import numpy as np
+
+from utils.pyParallelClass import *
+from utils.pyExportClass import WHTextWriter
+from pd0Generator import makeEnsembles, writePD0
+
+# Writer keeping the blocks of arrays
+class ArraysWriter():
+   def __init__(self):
+      self.blocks = []
+
+   def writeArrays(self, arrays):
+      self.blocks.append(arrays)
+
+# Convert the blocks of 7 ensembles of <filename> with <jobs> processes
+def convert(filename, outfile, jobs, cells=None):
+   with open(filename, 'rb') as pd0:
+      offsets = getEnsembleOffsets(pd0.read())
+   converter = WHBlockConverter(filename, outfile, None, jobs, cells)
+   for first in range(0, len(offsets), 7):
+      converter.convert(offsets[first:first+7])
+   converter.close()
+
+# The blocks converted by a pool of processes are written in their order
+def test_block_converter_text(tmp_path):
+   filename = writePD0(tmp_path / 'ensembles.000', makeEnsembles(range(1, 51)))
+   outputs = []
+   for jobs in (1, 2):
+      outfile = WHTextWriter(os.path.join(str(tmp_path), 'jobs{}.txt'.format(jobs)), 'EARTH')
+      convert(filename, outfile, jobs)
+      outfile.close()
+      with open(outfile.filename) as text:
+         outputs.append(text.read())
+   assert outputs[0] == outputs[1]
+   assert len(outputs[0].splitlines()) == 50
+
+# The arrays of the blocks are returned by the processes, with the range of cells
+def test_block_converter_arrays(tmp_path):
+   filename = writePD0(tmp_path / 'ensembles.000', makeEnsembles(range(1, 51)))
+   single, pool = ArraysWriter(), ArraysWriter()
+   convert(filename, single, 1, slice(2, 5))
+   convert(filename, pool, 2, slice(2, 5))
+   assert len(pool.blocks) == 8
+   for arrays, other in zip(single.blocks, pool.blocks):
+      assert arrays.getNumberOfCells() == 3 and other.firstCell == 2
+      assert np.array_equal(arrays.offsets, other.offsets)
+      assert np.array_equal(arrays.velocity, other.velocity)
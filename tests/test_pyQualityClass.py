@@ -0,0 +1,107 @@
+#!/usr/bin/python
+#-*- coding: utf-8 -*-
+
+import numpy as np
+import pytest
+
+from utils.pyQualityClass import *
+from pd0Generator import makeEnsemble, makeEnsembles
+
+# Masks [cell, beam] of the tests <tests> of the ensemble <re> (readEnsemble)
+# computed value by value
+def getReferenceMasks(re, tests, coordinates):
+   velocity, correlation = re.v.getVelocityArray(), re.corr.getCorrelationArray()
+   percentGood, intensity = re.pg.getPercentGoodArray(), re.inty.getIntensityArray()
+   nbCells, nbBeams = velocity.shape
+   a, b, c, d = [x[0] for x in re.fh.getBeamConstants()]
+   tilt = np.degrees(np.arccos(np.cos(np.radians(re.vh.getPitch()))*np.cos(np.radians(re.vh.getRoll()))))
+   masks = dict((test, np.zeros((nbCells, nbBeams), dtype=bool)) for test in tests)
+   for cell in range(nbCells):
+      if coordinates == 'BEAM':
+         vels = [velocity[cell,beam]*0.001 for beam in range(nbBeams)]
+         valid = [velocity[cell,beam] != BADVELOCITY for beam in range(nbBeams)]
+      else:
+         nbValid, vels = re.correlationTest(cell)
+         valid = [vel != BADVELOCITY for vel in vels]
+      for beam in range(nbBeams):
+         rejected = False
+         if 'CORR' in tests:
+            masks['CORR'][cell,beam] = correlation[cell,beam] < (tests['CORR'] or re.fh.getCorrelationThrehold())
+         if 'PG' in tests:
+            value = int(percentGood[cell,beam]) - (256 if percentGood[cell,beam] > 127 else 0)
+            masks['PG'][cell,beam] = value < (tests['PG'] or re.fh.whFixedLeader.PercentMinimumGood)
+         if 'INT' in tests:
+            masks['INT'][cell,beam] = 0.045*intensity[cell,beam] < tests['INT']
+         if 'TILT' in tests:
+            masks['TILT'][cell,beam] = tilt > tests['TILT']
+         for test in ('CORR', 'PG', 'INT', 'TILT'):
+            if test in tests and masks[test][cell,beam]:
+               valid[beam] = False
+      if sum(valid) < 4 and '4BEAM' in tests:
+         masks['4BEAM'][cell,:] = True
+      if sum(valid) == 4 and 'EV' in tests:
+         error = re.getFourBeamSolution(a, b, c, d, vels)[3]
+         masks['EV'][cell,:] = abs(error)*1000 > (tests['EV'] or re.fh.whFixedLeader.ErrorVelocityThreshold)
+   return(masks)
+
+# Tests with their fixed leader or given values
+TESTS = [{'CORR': None, 'PG': 5, 'INT': 1, 'TILT': 6, '4BEAM': None, 'EV': None},
+         {'CORR': 100, 'PG': 50, 'EV': 1500},
+         {'4BEAM': None},
+         {'EV': None}]
+
+# The masks of each test are the ones computed value by value, the counts
+# are the valid velocities rejected
+def test_quality_control_masks():
+   data = makeEnsembles(range(1, 21))
+   arrays = WHEnsembleArrays()
+   arrays.readEnsembleArrays(data)
+   ensembles = [readEnsemble(makeEnsemble(number)[4:]) for number in range(1, 21)]
+   for re in ensembles:
+      re.readEnsembleData()
+   for coordinates in ('BEAM', 'EARTH'):
+      for tests in TESTS:
+         qc = WHQualityControl(None, tests, coordinates)
+         masks = qc.getMasks(arrays)
+         assert sorted(masks) == sorted(tests)
+         for n, re in enumerate(ensembles):
+            for test, mask in getReferenceMasks(re, tests, coordinates).items():
+               assert np.array_equal(masks[test][n], mask), (coordinates, test, n)
+         for test, mask in masks.items():
+            assert 0 < np.count_nonzero(mask) < mask.size
+         tested = qc.applyTests(arrays)
+         valid = arrays.velocity != BADVELOCITY
+         rejected = np.logical_or.reduce(list(masks.values())) & valid
+         assert qc.counts == dict((test, int(np.count_nonzero(mask & valid))) for test, mask in masks.items())
+         assert qc.nbValues == np.count_nonzero(valid) and qc.nbRejected == np.count_nonzero(rejected)
+         assert np.array_equal(tested.velocity == BADVELOCITY, rejected | ~valid)
+         assert np.array_equal(tested.velocity[~rejected], arrays.velocity[~rejected])
+
+# Unknown tests and tests without their needed value are errors
+def test_quality_control_arguments():
+   for tests in ({'SNR': 10}, {'INT': None}, {'TILT': None}):
+      with pytest.raises(ValueError):
+         WHQualityControl(None, tests)
+
+# Writer keeping the arrays written
+class ArraysWriter():
+   def __init__(self):
+      self.blocks = []
+
+   def writeArrays(self, arrays):
+      self.blocks.append(arrays)
+
+# The tested ensembles are written, the counts are reported by test
+def test_quality_control_report(capsys):
+   arrays = WHEnsembleArrays()
+   arrays.readEnsembleArrays(makeEnsembles(range(1, 11)))
+   writer = ArraysWriter()
+   qc = WHQualityControl(writer, {'CORR': None, 'EV': None})
+   qc.writeArrays(arrays.getEnsembles(slice(0, 4)))
+   qc.writeArrays(arrays.getEnsembles(slice(4, 10)))
+   assert [block.getNumberOfEnsembles() for block in writer.blocks] == [4, 6]
+   qc.printReport()
+   lines = capsys.readouterr().out.splitlines()
+   assert lines == ['Quality control: {} of {} velocities rejected'.format(qc.nbRejected, qc.nbValues),
+                    '\tCORR: {} rejected'.format(qc.counts['CORR']), '\tEV: {} rejected'.format(qc.counts['EV'])]
+   assert qc.nbValues == np.count_nonzero(arrays.velocity != BADVELOCITY)
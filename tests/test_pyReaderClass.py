@@ -0,0 +1,224 @@
+#!/usr/bin/python
+#-*- coding: utf-8 -*-
+
+import os
+import datetime
+import numpy as np
+import pytest
+
+import utils.pyReaderClass as pyReaderClass
+from utils.pyReaderClass import *
+from pd0Generator import STARTDATETIME, INTERVAL, makeEnsemble, makeEnsembles, writePD0
+
+# The buffer is a read only view of the whole file
+def test_mapped_file_buffer(tmp_path):
+   data = makeEnsembles(range(1, 11))
+   filename = writePD0(tmp_path / 'mapped.000', data)
+   with WHMappedFile(filename) as infile:
+      buffer = infile.getBuffer()
+      assert len(infile) == len(data)
+      assert buffer.readonly
+      assert bytes(buffer) == data
+      arrays = WHEnsembleArrays()
+      assert arrays.readEnsembleArrays(buffer) == 10
+
+# An empty file has an empty buffer
+def test_mapped_file_empty(tmp_path):
+   filename = writePD0(tmp_path / 'empty.000', b'')
+   with WHMappedFile(filename) as infile:
+      assert len(infile.getBuffer()) == 0
+
+# The index is saved next to the file and reused while the file is the same
+def test_index_sidecar(tmp_path):
+   filename = writePD0(tmp_path / 'index.000', makeEnsembles(range(1, 21)))
+   index = WHEnsembleIndex(filename)
+   index.getIndex()
+   assert os.path.isfile(filename + INDEXEXTENSION)
+   assert index.index['EnsembleNumber'].tolist() == list(range(1, 21))
+   assert index.index['Offset'][0] == 0
+   assert index.index['DateTime'][0] == np.datetime64(STARTDATETIME + datetime.timedelta(seconds=INTERVAL), 'ms')
+   reloaded = WHEnsembleIndex(filename)
+   assert reloaded.loadIndex()
+   assert np.array_equal(reloaded.index, index.index)
+
+# The index is rebuilt when the size or the modification time of the file changes
+def test_index_sidecar_invalidation(tmp_path):
+   filename = writePD0(tmp_path / 'index.000', makeEnsembles(range(1, 21)))
+   WHEnsembleIndex(filename).getIndex()
+   with open(filename, 'ab') as pd0:
+      pd0.write(makeEnsembles(range(21, 31)))
+   index = WHEnsembleIndex(filename)
+   assert not index.loadIndex()
+   assert len(index.getIndex()) == 30
+   assert WHEnsembleIndex(filename).loadIndex()
+   info = os.stat(filename)
+   os.utime(filename, ns=(info.st_atime_ns, info.st_mtime_ns + 10**9))
+   assert not WHEnsembleIndex(filename).loadIndex()
+
+# Binary search of the first ensemble of a time or number window
+def test_index_search(tmp_path):
+   data = makeEnsembles(range(1, 21))
+   filename = writePD0(tmp_path / 'index.000', data)
+   index = WHEnsembleIndex(filename)
+   index.getIndex()
+   fifth = STARTDATETIME + datetime.timedelta(seconds=5*INTERVAL)
+   assert index.findDateTime(fifth) == 5
+   assert index.findDateTime(fifth, strict=False) == 4
+   assert index.findElementNumber(8) == 7
+   assert index.getOffset(index.findElementNumber(100)) == -1
+   assert getStartOffset(filename, data, fifth, 8) == index.getOffset(7)
+   assert getStartOffset(filename, data, first=100) == len(data)
+
+# Ensembles not sorted (counter reset) are read from the start
+def test_index_not_sorted(tmp_path):
+   data = makeEnsembles(range(10, 21)) + makeEnsembles(range(1, 10))
+   filename = writePD0(tmp_path / 'reset.000', data)
+   assert getStartOffset(filename, data, first=5) == 0
+
+# Verification of the files of a directory, the index sidecars are not verified
+def test_verify_path(tmp_path, capsys):
+   writePD0(tmp_path / 'good.000', makeEnsembles(range(1, 11)))
+   writePD0(tmp_path / 'bad.000', makeEnsembles(range(1, 4)) + makeEnsemble(4, badChecksum=True) + makeEnsembles(range(5, 8)))
+   WHEnsembleIndex(str(tmp_path / 'good.000')).getIndex()
+   scanner = verifyFile(str(tmp_path / 'bad.000'))
+   assert scanner.nbEnsembles == 6 and len(scanner.badEnsembles) == 1
+   assert verifyPath(str(tmp_path / 'good.000')) == 0
+   assert verifyPath(str(tmp_path)) == 1
+   lines = capsys.readouterr().out.splitlines()
+   assert lines[-3].endswith('bad.000: 6 ensembles, 1 bad ensembles, {} bytes skipped'.format(len(makeEnsemble(4))))
+   assert lines[-2] == '\tBad ensemble at {}'.format(hex(3*len(makeEnsemble(4))))
+   assert lines[-1].endswith('good.000: 10 ensembles, 0 bad ensembles, 0 bytes skipped')
+
+# Ensemble number and time windows, from the index or by reading from the start
+def test_iter_pd0_ensembles_windows(tmp_path):
+   filename = writePD0(tmp_path / 'ensembles.000', makeEnsembles(range(1, 31)))
+   for useIndex in (True, False):
+      numbers = [re.vh.getElementNumber() for re in iterPD0Ensembles(filename, first=5, last=12, useIndex=useIndex)]
+      assert numbers == list(range(5, 13))
+      start = STARTDATETIME + datetime.timedelta(seconds=10*INTERVAL)
+      end = STARTDATETIME + datetime.timedelta(seconds=15*INTERVAL)
+      numbers = [re.vh.getElementNumber() for re in iterPD0Ensembles(filename, start, end, useIndex=useIndex)]
+      assert numbers == list(range(11, 15))
+
+# A binary file-like object is read forward, only the selected fields are decoded
+def test_iter_pd0_ensembles_stream(tmp_path):
+   data = makeEnsembles(range(1, 11))
+   filename = writePD0(tmp_path / 'ensembles.000', data)
+   with open(filename, 'rb') as stream:
+      ensembles = list(iterPD0Ensembles(stream, fields=['INT'], coordinates='EARTH', cells=slice(0, 5)))
+   assert [re.vh.getElementNumber() for re in ensembles] == list(range(1, 11))
+   assert [item.getType() for item in ensembles[0].ensembleList[1:]] == [FIXEDLEADER, VARIABLELEADER, INTENSITYPROFILE]
+   assert ensembles[0].inty.getIntensityArray().shape == (5, 4)
+   with pytest.raises(ValueError):
+      next(iterPD0Ensembles(filename, fields=['VELOCITY']))
+
+# The configuration changes are recorded by the fixed leader cache
+def test_iter_pd0_ensembles_changes(tmp_path):
+   filename = writePD0(tmp_path / 'ensembles.000', makeEnsembles(range(1, 6)) + makeEnsembles(range(6, 11), nbCells=30))
+   fixedLeaders = WHFixedLeaderCache()
+   ensembles = list(iterPD0Ensembles(filename, fixedLeaders=fixedLeaders))
+   assert len(ensembles) == 10
+   assert [number for number, previous, fh in fixedLeaders.changes] == [6]
+   assert ensembles[0].fh is ensembles[4].fh
+
+# Ensembles by position, the last ones read are kept decoded
+def test_pd0_file_index(tmp_path):
+   filename = writePD0(tmp_path / 'file.000', makeEnsembles(range(1, 21)))
+   with PD0File(filename, cacheSize=2) as pd0:
+      assert len(pd0) == 20
+      ensemble = pd0[3]
+      assert ensemble.vh.getElementNumber() == 4
+      assert pd0[3] is ensemble
+      assert pd0[-1].vh.getElementNumber() == 20
+      pd0[0]
+      assert pd0[3] is not ensemble
+      assert np.array_equal(pd0[3].v.getVelocityArray(), ensemble.v.getVelocityArray())
+      for position in (20, -21):
+         with pytest.raises(IndexError):
+            pd0[position]
+
+# A slice is decoded in arrays, within a configuration segment only
+def test_pd0_file_slice(tmp_path):
+   filename = writePD0(tmp_path / 'file.000', makeEnsembles(range(1, 11)) + makeEnsembles(range(11, 21), nbCells=30))
+   with PD0File(filename) as pd0:
+      arrays = pd0[2:8]
+      assert arrays.getElementNumber().tolist() == list(range(3, 9))
+      assert np.array_equal(arrays.velocity[1], pd0[3].v.getVelocityArray())
+      assert pd0[12:20].velocity.shape == (8, 30, 4)
+      with pytest.raises(ValueError, match='getSegments'):
+         pd0[8:12]
+
+# The ensemble in progress at a time, the ensemble of a number
+def test_pd0_file_at(tmp_path):
+   filename = writePD0(tmp_path / 'file.000', makeEnsembles(range(1, 21)))
+   with PD0File(filename) as pd0:
+      fifth = STARTDATETIME + datetime.timedelta(seconds=5*INTERVAL)
+      assert pd0.atTime(fifth).vh.getElementNumber() == 5
+      assert pd0.atTime(fifth + datetime.timedelta(seconds=1)).vh.getElementNumber() == 5
+      assert pd0.atNumber(12).vh.getElementNumber() == 12
+      with pytest.raises(KeyError):
+         pd0.atTime(STARTDATETIME)
+      with pytest.raises(KeyError):
+         pd0.atNumber(21)
+
+# The ensembles of a stream are the ones of the file, read by blocks of any size
+def test_iter_stream_ensembles(tmp_path):
+   data = b'garbage' + makeEnsembles(range(1, 51))
+   filename = writePD0(tmp_path / 'stream.000', data)
+   offsets, lengths = WHEnsembleScanner().scanEnsembles(data)
+   for blockSize in (1, 100, STREAMBLOCKSIZE):
+      with open(filename, 'rb') as stream:
+         ensembles = list(iterStreamEnsembles(stream, blockSize=blockSize))
+      assert [offset for offset, ensemble in ensembles] == offsets.tolist()
+      assert [len(ensemble) for offset, ensemble in ensembles] == lengths.tolist()
+
+# Standard input, TCP, named pipes and character devices are live sources, files are not
+def test_is_live_source(tmp_path):
+   filename = writePD0(tmp_path / 'file.000', makeEnsemble(1))
+   os.mkfifo(str(tmp_path / 'fifo'))
+   assert isLiveSource('-') and isLiveSource('tcp://localhost:2000')
+   assert isLiveSource(str(tmp_path / 'fifo')) and isLiveSource('/dev/null')
+   assert not isLiveSource(filename) and not isLiveSource(str(tmp_path / 'missing'))
+
+# Each segment of the file is decoded in arrays of its own shape
+def test_pd0_file_segments(tmp_path):
+   filename = writePD0(tmp_path / 'file.000', makeEnsembles(range(1, 11)) + makeEnsembles(range(11, 16), nbCells=30))
+   with PD0File(filename) as pd0:
+      assert pd0.getSegments() == [slice(0, 10), slice(10, 15)]
+      assert [pd0[segment].velocity.shape for segment in pd0.getSegments()] == [(10, 20, 4), (5, 30, 4)]
+
+# The leaders of the whole file in a DataFrame
+def test_pd0_file_data_frame(tmp_path):
+   pytest.importorskip('pandas')
+   filename = writePD0(tmp_path / 'file.000', makeEnsembles(range(1, 11)) + makeEnsembles(range(11, 16), nbCells=30))
+   with PD0File(filename) as pd0:
+      frame = pd0.toDataFrame(fixedLeader=True)
+   assert frame['EnsembleNumber'].tolist() == list(range(1, 16))
+   assert frame['NumberOfCells'].tolist() == [20]*10 + [30]*5
+
+# The profiles of a segment are read from the file by selection, lazily or
+# at once with an xarray without lazy backend arrays
+def test_pd0_file_xarray(tmp_path, monkeypatch):
+   pytest.importorskip('xarray')
+   filename = writePD0(tmp_path / 'file.000', makeEnsembles(range(1, 11)) + makeEnsembles(range(11, 21), nbCells=30))
+   for lazy in (True, False):
+      monkeypatch.setattr(pyReaderClass, 'LAZYXARRAY', LAZYXARRAY and lazy)
+      with PD0File(filename, coordinates='EARTH', cells=slice(1, 25)) as pd0:
+         arrays = pd0[pd0.getSegments()[1]]
+         dataset = pd0.toXarray(segment=1)
+         assert dataset['velocity'].shape == (10, 24, 4)
+         assert dataset['ensemble'].values.tolist() == list(range(11, 21))
+         velocity = arrays.getVelocity('EARTH')
+         assert np.allclose(dataset['velocity'][2:5].values, velocity[2:5], equal_nan=True)
+         assert np.allclose(dataset['velocity'][7,3:6,1].values, velocity[7,3:6,1], equal_nan=True)
+         assert np.array_equal(dataset['intensity'].isel(time=[0, 9]).values, arrays.intensity[[0, 9]])
+         assert np.array_equal(dataset['intensity'].values, arrays.intensity)
+         assert np.allclose(dataset['depth'].values, arrays.getCorrectedCellDepth())
+
+# Without xarray the Dataset of a file is an ImportError
+def test_pd0_file_xarray_missing(tmp_path, monkeypatch):
+   filename = writePD0(tmp_path / 'file.000', makeEnsembles(range(1, 4)))
+   monkeypatch.setattr(pyReaderClass, 'xr', None)
+   with PD0File(filename) as pd0:
+      with pytest.raises(ImportError, match='xarray'):
+         pd0.toXarray()
@@ -0,0 +1,84 @@
+#!/usr/bin/python
+#-*- coding: utf-8 -*-
+
+import struct as st
+import numpy as np
+
+from utils.pyScanClass import *
+from pd0Generator import makeEnsemble, makeEnsembles, makeWaves
+
+# Return the offsets of the ensembles found by a new scanner, and the scanner
+def scan(data):
+   scanner = WHEnsembleScanner()
+   offsets, lengths = scanner.scanEnsembles(data)
+   return(offsets.tolist(), scanner)
+
+# An ensemble with a wrong checksum is skipped, the next one is found
+def test_scanner_resync_checksum():
+   first, bad, last = makeEnsemble(1), makeEnsemble(2, badChecksum=True), makeEnsemble(3)
+   offsets, scanner = scan(first + bad + last)
+   assert offsets == [0, len(first) + len(bad)]
+   assert scanner.badEnsembles == [len(first)]
+   assert scanner.dropped == [(len(first), len(bad))]
+   assert scanner.nbEnsembles == 2
+
+# An ensemble with a wrong length is skipped, the next one is found
+def test_scanner_resync_length():
+   first, last = makeEnsemble(1), makeEnsemble(3)
+   for length in (2, 100, 0xfff0):
+      bad = bytearray(makeEnsemble(2))
+      st.pack_into('<H', bad, 2, length)
+      offsets, scanner = scan(first + bytes(bad) + last)
+      assert offsets == [0, len(first) + len(bad)]
+      assert scanner.badEnsembles == [len(first)]
+      assert scanner.getDroppedSize() == len(bad)
+
+# Garbage, with false headers, is skipped between and before the ensembles
+def test_scanner_resync_garbage():
+   ensemble = makeEnsemble(1)
+   garbage = b'\x7f\x7f\x10\x00garbage\x7f\x79\x7f'
+   offsets, scanner = scan(garbage + ensemble + garbage + ensemble + ensemble[:100])
+   assert offsets == [len(garbage), 2*len(garbage) + len(ensemble)]
+   assert scanner.dropped == [(0, len(garbage)), (len(garbage) + len(ensemble), len(garbage)),
+                              (2*len(garbage) + 2*len(ensemble), 100)]
+
+# The waves ensembles are counted but not returned
+def test_scanner_waves():
+   ensemble, waves = makeEnsemble(1), makeWaves()
+   offsets, scanner = scan(ensemble + waves + ensemble)
+   assert offsets == [0, len(ensemble) + len(waves)]
+   assert scanner.waves == [len(ensemble)]
+   assert scanner.dropped == [] and scanner.badEnsembles == []
+
+# The checksums computed at once are the sums of the bytes of each ensemble
+def test_compute_checksums():
+   data = makeEnsembles(range(1, 6)) + makeEnsemble(6, badChecksum=True)
+   offsets, lengths = [], []
+   while sum(lengths) + 2*len(lengths) < len(data):
+      offsets.append(sum(lengths) + 2*len(lengths))
+      lengths.append(st.unpack_from('<H', data, offsets[-1] + 2)[0])
+   values = np.frombuffer(data, dtype=np.uint8)
+   expected = [sum(data[o:o+n]) & 0xffff for o, n in zip(offsets, lengths)]
+   assert computeChecksums(values, offsets, lengths).tolist() == expected
+   assert (computeChecksums(values, offsets, lengths) == readChecksums(values, offsets, lengths)).tolist() == [True]*5 + [False]
+
+# Return the (offset, raw ensemble) framed from <data> received by chunks of <sizes> (cycled)
+def frame(data, sizes):
+   framer, ensembles, position, n = WHStreamFramer(), [], 0, 0
+   while position < len(data):
+      ensembles.extend(framer.feed(data[position:position+sizes[n % len(sizes)]]))
+      position, n = position + sizes[n % len(sizes)], n + 1
+   return(ensembles + framer.close())
+
+# The ensembles framed do not depend on the chunk boundaries, they are the scanned ones
+def test_stream_framer_chunks():
+   bad, garbage = makeEnsemble(2, badChecksum=True), b'\x7f\x7f\x10\x00garbage\x7f\x79\x7f'
+   data = garbage + makeEnsembles(range(1, 201)) + bad + makeWaves() + makeEnsembles(range(201, 401)) + bad[:100]
+   offsets, lengths = WHEnsembleScanner().scanEnsembles(data)
+   expected = [(offset, data[offset:offset+length]) for offset, length in zip(offsets.tolist(), lengths.tolist())]
+   assert len(expected) == 400 and len(data) > 2*MAXENSEMBLESIZE
+   for sizes in ([13], [len(data)], [4096], [3, 500, 65536, 1, 2]):
+      assert frame(data, sizes) == expected
+   # Byte by byte
+   size = len(garbage) + 10*len(bad)
+   assert frame(data[:size], [1]) == [ensemble for ensemble in expected if ensemble[0] + len(ensemble[1]) + 2 <= size]
@@ -0,0 +1,97 @@
+#!/usr/bin/python
+#-*- coding: utf-8 -*-
+
+import os
+import sys
+import datetime
+import subprocess
+import argparse as ap
+import pytest
+
+import utils.pyExportClass as pyExportClass
+from utils.pyArrayClass import WHEnsembleArrays
+from utils.pyReaderClass import iterPD0Ensembles
+from pyWorkHorse import *
+from pd0Generator import STARTDATETIME, INTERVAL, makeEnsembles, writePD0
+
+# Command line script
+WORKHORSE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'pyWorkHorse.py')
+
+# Arguments of the conversion of <infile> to <outfile>, with <options>
+def getArgs(infile, outfile, **options):
+   args = ap.Namespace(infile=infile, outfile=outfile, binary=False, average=None, quality_control=None,
+                       size=0, start_datetime=None, end_datetime=None, first_ensemble=None,
+                       last_ensemble=None, count=-1, cells=None, jobs=1, useindex=True)
+   for name, value in options.items():
+      setattr(args, name, value)
+   return(args)
+
+# A missing optional dependency is an ImportError naming the output file,
+# the other errors are reported as a file which can not be created
+def test_open_writer_errors(tmp_path, monkeypatch):
+   monkeypatch.setattr(pyExportClass, 'h5py', None)
+   filename = os.path.join(str(tmp_path), 'ensembles.nc')
+   with pytest.raises(ImportError, match='ensembles.nc.*h5py'):
+      openWriter(getArgs(None, filename, binary=True), filename, 'BEAM', list(DATATYPES.values()))
+   filename = os.path.join(str(tmp_path), 'missing', 'ensembles.txt')
+   with pytest.raises(IOError, match='Unable to create file'):
+      openWriter(getArgs(None, filename), filename, 'BEAM', list(DATATYPES.values()))
+
+# Return the lines written by pyWorkHorse.py run with <options>
+def runWorkHorse(tmp_path, *options):
+   outfile = os.path.join(str(tmp_path), 'out.txt')
+   subprocess.run([sys.executable, WORKHORSE, '-o', outfile] + list(options), check=True, stdout=subprocess.DEVNULL)
+   with open(outfile) as text:
+      return(text.readlines())
+
+# The ensemble number window of the command line is the one of iterPD0Ensembles
+def test_first_last(tmp_path):
+   filename = writePD0(tmp_path / 'ensembles.000', makeEnsembles(range(1, 31)))
+   lines = runWorkHorse(tmp_path, '-i', filename, '-first', '5', '-last', '12', '-sys', 'EARTH')
+   assert lines == [re.write() for re in iterPD0Ensembles(filename, first=5, last=12, coordinates='EARTH')]
+
+# Return the leaders of the ensembles <numbers>
+def readLeaders(numbers):
+   leaders = WHEnsembleArrays()
+   leaders.readLeaderArrays(makeEnsembles(numbers))
+   return(leaders)
+
+# The actions of a block follow the number and time windows and the count
+def test_get_actions():
+   leaders = readLeaders(range(1, 21))
+   actions = getActions(getArgs(None, None, first_ensemble=5, last_ensemble=12), leaders, 0)
+   assert actions.tolist() == [SKIP]*4 + [WRITE]*8 + [STOP]*8
+   start = STARTDATETIME + datetime.timedelta(seconds=3*INTERVAL)
+   end = STARTDATETIME + datetime.timedelta(seconds=9*INTERVAL)
+   actions = getActions(getArgs(None, None, start_datetime=start, end_datetime=end), leaders, 0)
+   assert actions.tolist() == [SKIP]*3 + [WRITE]*5 + [SKIP] + [STOP]*11
+   actions = getActions(getArgs(None, None, first_ensemble=3, count=10), leaders, 6)
+   assert actions.tolist() == [SKIP]*2 + [WRITE]*4 + [STOP]*14
+   assert getStopPosition(actions) == 6
+
+# An invalid time is an error up to the first ensemble stopping the conversion
+def test_get_actions_invalid_time():
+   leaders = readLeaders(range(1, 21))
+   leaders.variableLeader = leaders.variableLeader.copy()
+   leaders.variableLeader['RTCDay'][15] = 0
+   args = getArgs(None, None, start_datetime=STARTDATETIME, last_ensemble=10)
+   assert getActions(args, leaders, 0).tolist() == [WRITE]*10 + [STOP]*10
+   args.last_ensemble = None
+   with pytest.raises(IOError, match='ensemble 16'):
+      getActions(args, leaders, 0)
+
+# The cell range of the command line, from 1 and included, is a slice
+def test_valid_cell_range():
+   assert valid_cell_range('3:7') == slice(2, 7)
+   assert valid_cell_range(':7') == slice(0, 7)
+   assert valid_cell_range('3:') == slice(2, None)
+   for value in ('0:7', '7:3', '3', 'a:b'):
+      with pytest.raises(ap.ArgumentTypeError):
+         valid_cell_range(value)
+
+# The cells written by the command line are the ones of iterPD0Ensembles
+def test_cells(tmp_path):
+   filename = writePD0(tmp_path / 'ensembles.000', makeEnsembles(range(1, 21)))
+   lines = runWorkHorse(tmp_path, '-i', filename, '-cells', '3:7', '-sys', 'EARTH')
+   assert lines == [re.write() for re in iterPD0Ensembles(filename, coordinates='EARTH', cells=slice(2, 7))]
+   assert lines != [re.write() for re in iterPD0Ensembles(filename, coordinates='EARTH')]
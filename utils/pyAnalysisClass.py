@@ -1,3 +1,92 @@
 #!/usr/bin/python
 #-*- coding: utf-8 -*-
 
+import numpy as np
+
+# Arrays are [ensemble, cell, beam]; per ensemble values are 1-D [ensemble]
+
+# Return true speed of sound corrected from temperature, salinity and depth from Urick (1983)
+def getSpeedOfSound(T,S,D):
+   return(1449.2+4.6*T-0.055*(T*T)+0.00029*(T*T*T)+(1.34-0.01*T)*(S-35)+0.016*D)
+
+#----------------------------------------
+#--- Batched coordinate transformation --
+#----------------------------------------
+# Return the transformation constants a, b, c, d for beam angles <theta>
+# (degrees) and beams convexity <c> (1: convex beams; -1: concave beams)
+def getBeamConstants(theta, c):
+   theta = np.asarray(theta, dtype=np.float64)
+   a = 1.0 / (2.0*np.sin(np.radians(theta)))
+   b = 1.0 / (4.0*np.cos(np.radians(theta)))
+   d = a / np.sqrt(2)
+   return(a, b, c*np.ones_like(a), d)
+
+# Compute de 4 beams solution of the velocities
+def getFourBeamSolution(a,b,c,d,vels):
+   newVels = np.zeros(vels.shape[:-1] + (4,))
+   newVels[...,0] = c*a*(vels[...,0]-vels[...,1])
+   newVels[...,1] = c*a*(vels[...,3]-vels[...,2])
+   newVels[...,2] = b*(vels[...,0]+vels[...,1]+vels[...,2]+vels[...,3])
+   newVels[...,3] = d*(vels[...,0]+vels[...,1]-vels[...,2]-vels[...,3])
+   return(newVels)
+
+# Compute de 3 beams solution of the velocities, <badBeam> is the beam off (0 to 3)
+def getThreeBeamSolution(a,b,c,d,vels,badBeam):
+   newVels = np.zeros(vels.shape[:-1] + (4,))
+   v1, v2, v3, v4 = vels[...,0], vels[...,1], vels[...,2], vels[...,3]
+   newVels[...,0] = np.select([badBeam == 0, badBeam == 1],
+                              [c*a*(v4+v4-2*v2), -1*c*a*(v4+v4)],
+                              c*a*(v1-v2))
+   newVels[...,1] = np.select([badBeam == 2, badBeam == 3],
+                              [c*a*(2*v4-v1-v2), c*a*(-2*v3+v1+v2)],
+                              c*a*(v4-v3))
+   newVels[...,2] = np.where(badBeam <= 1, 2*b*(v4+v3), 2*b*(v1+v2))
+   return(newVels)
+
+# Transform beam velocities [ensemble, cell, beam] to XYZ coordinates [ensemble, cell, 4]
+# Cells with 4 <valid> beams use the 4 beams solution, cells with 3 <valid>
+# beams the 3 beams solution, other cells are set to 0. The <constants>
+# already computed by getBeamConstants can be given instead of <theta> and <c>
+def beamToXYZ(vels, valid, theta=None, c=1, constants=None):
+   if constants is None:
+      constants = getBeamConstants(theta, c)
+   a, b, c, d = [x[:,None] for x in constants]
+   vels = np.where(valid, vels, 0.0)[...,:4]
+   nbValid = valid.sum(axis=-1)
+   badBeam = np.argmin(valid[...,:4], axis=-1)
+   xyz = np.zeros(vels.shape[:-1] + (4,))
+   four = nbValid == 4
+   three = nbValid == 3
+   xyz[four] = getFourBeamSolution(a,b,c,d,vels)[four]
+   xyz[three] = getThreeBeamSolution(a,b,c,d,vels,badBeam)[three]
+   return(xyz)
+
+# Return the stacked rotation matrices [ensemble, 4, 4] from instrument to earth coordinates
+# Angles are in degrees, <facing> is 180 for upward beams and 0 for downward beams
+def getRotationMatrices(heading, pitch, roll, headingAlignment, facing, usePitchSensor):
+   pitch = np.asarray(pitch, dtype=np.float64)
+   roll = np.asarray(roll, dtype=np.float64)
+   # Internal sensors
+   P = np.where(usePitchSensor, np.arctan(np.tan(pitch)*np.cos(roll)), pitch)
+   SH = np.sin(np.radians(heading+headingAlignment))
+   CH = np.cos(np.radians(heading+headingAlignment))
+   SP = np.sin(np.radians(P))
+   CP = np.cos(np.radians(P))
+   SR = np.sin(np.radians(roll+facing))
+   CR = np.cos(np.radians(roll+facing))
+   M = np.zeros(np.shape(SH) + (4,4))
+   M[...,0,0] = (CH*CR)+(SH*SP*SR)
+   M[...,0,1] = SH*CP
+   M[...,0,2] = (CH*SR)-(SH*SP*CR)
+   M[...,1,0] = (-SH*CR)+(CH*SP*SR)
+   M[...,1,1] = CH*CP
+   M[...,1,2] = (-SH*SR)-(CH*SP*CR)
+   M[...,2,0] = -CP*SR
+   M[...,2,1] = SP
+   M[...,2,2] = CP*CR
+   M[...,3,3] = 1
+   return(M)
+
+# Transform XYZ velocities [ensemble, cell, 4] to East, North, Up (and error) velocities
+def XYZToENU(xyz, M):
+   return(np.einsum('eci,eij->ecj', xyz, M))
@@ -0,0 +1,449 @@
+#!/usr/bin/python
+#-*- coding: utf-8 -*-
+
+import struct as st
+import numpy as np
+try:
+   import pandas as pd
+except ImportError:
+   pd = None
+try:
+   import xarray as xr
+except ImportError:
+   xr = None
+
+from utils.pyGeneralClass import *
+from utils.pyScanClass import WHEnsembleScanner
+
+# Number of ensembles gathered at once, bound the size of the index arrays
+BLOCKSIZE = 4096
+# Fixed leader fields constant within a configuration segment
+SEGMENTFIELDS = ('NumberOfCells', 'NumberOfBeams', 'DepthCellLength')
+# Profiles wrapped by WHEnsembleArrays.toXarray and their data type
+PROFILEDATATYPES = {
+      'velocity': VELOCITYPROFILE,
+      'correlation': CORRELATIONPROFILE,
+      'intensity': INTENSITYPROFILE,
+      'percentGood': PERCENTGOODPROFILE,
+      }
+# Dimensions of the profiles
+PROFILEDIMS = ('time', 'cell', 'beam')
+
+#----------------------------------------
+#---   Locate ensembles in a buffer   ---
+#----------------------------------------
+def getEnsembleOffsets(buffer):
+   """Return the byte offsets of the valid current ensembles stored in buffer"""
+   offsets, lengths = WHEnsembleScanner().scanEnsembles(buffer)
+   return(offsets)
+
+# Gather <width> consecutive bytes after each position
+def _gatherBytes(data, positions, width):
+   idx = positions[:,None] + np.arange(width, dtype=np.int64)
+   np.minimum(idx, len(data)-1, out=idx)
+   return(data[idx])
+
+# Return the absolute position of the <dataType> data in each ensemble, -1 when missing
+def getDataTypePositions(data, starts, dataType):
+   positions = np.full(len(starts), -1, dtype=np.int64)
+   if len(starts) == 0:
+      return(positions)
+   nbDataTypes = data[starts + 5].astype(np.int64)
+   maxDataTypes = int(nbDataTypes.max())
+   if maxDataTypes == 0:
+      return(positions)
+   table = _gatherBytes(data, starts + 6, 2*maxDataTypes).view('<u2').astype(np.int64)
+   ids = _gatherBytes(data, (starts[:,None] + table).ravel(), 2).view('<u2').reshape(table.shape)
+   found = (ids == dataType) & (np.arange(maxDataTypes) < nbDataTypes[:,None])
+   column = found.argmax(axis=1)
+   rows = found.any(axis=1)
+   positions[rows] = starts[rows] + table[rows, column[rows]]
+   return(positions)
+
+# Return the data types of the ensemble starting at <start>, in their order in the ensemble
+def getDataTypes(data, start):
+   nbDataTypes = int(data[start + 5])
+   table = _gatherBytes(data, np.array([start + 6]), 2*nbDataTypes).view('<u2').astype(np.int64)[0]
+   return([int(dataType) for dataType in _gatherBytes(data, start + table, 2).view('<u2').ravel()])
+
+# Return the raw ensembles joined in one buffer and their offsets in it
+def joinRawEnsembles(rawEnsembles):
+   lengths = np.array([len(rawEnsemble) for rawEnsemble in rawEnsembles], dtype=np.int64)
+   offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]]).astype(np.int64)
+   return(b''.join(rawEnsembles), offsets[:len(rawEnsembles)])
+
+# Return the arrays (WHEnsembleArrays) of the raw ensembles <rawEnsembles>
+# (from the header ID to the last data byte, see WHStreamFramer.feed), one
+# per configuration segment (see getConfigurationSegments)
+def decodeRawSegments(rawEnsembles, dataTypes=None, cells=None):
+   if len(rawEnsembles) == 0:
+      return([])
+   return(readSegmentArrays(*joinRawEnsembles(rawEnsembles), dataTypes, cells))
+
+#----------------------------------------
+#---  Date and time of the ensembles  ---
+#----------------------------------------
+# Return the datetime64[ms] of the date and time fields (integer arrays),
+# NaT where they are not a valid date and time
+def getDateTimeArray(years, months, days, hours, minutes, seconds, hundredths):
+   years, months, days = [np.asarray(x, dtype=np.int64) for x in (years, months, days)]
+   hours, minutes, seconds, hundredths = [np.asarray(x, dtype=np.int64) for x in (hours, minutes, seconds, hundredths)]
+   valid = (months >= 1) & (months <= 12) & (days >= 1)
+   firstDays = (years - 1970).astype('M8[Y]') + (np.clip(months, 1, 12) - 1).astype('m8[M]')
+   dates = firstDays.astype('M8[D]') + (days - 1).astype('m8[D]')
+   valid &= dates.astype('M8[M]') == firstDays
+   valid &= (hours < 24) & (minutes < 60) & (seconds < 60) & (hundredths < 100)
+   ms = ((hours*60 + minutes)*60 + seconds)*1000 + hundredths*10
+   times = dates.astype('M8[ms]') + ms.astype('m8[ms]')
+   times[~valid] = np.datetime64('NaT')
+   return(times)
+
+# Return the four digits years of two digits years as read by strptime('%y'),
+# -1 for the values above 99
+def getFullYears(years):
+   years = np.asarray(years, dtype=np.int64)
+   return(np.where(years > 99, -1, np.where(years < 69, years + 2000, years + 1900)))
+
+#----------------------------------------
+#---  Configuration segments          ---
+#----------------------------------------
+# Return the slices of the runs of consecutive ensembles of <fixedLeader>
+# (array of FIXEDLEADERDTYPE) with the same number of cells, number of
+# beams and cell length: the profiles of a segment have a fixed shape
+def getConfigurationSegments(fixedLeader):
+   if len(fixedLeader) == 0:
+      return([])
+   changed = np.zeros(len(fixedLeader)-1, dtype=bool)
+   for name in SEGMENTFIELDS:
+      changed |= fixedLeader[name][1:] != fixedLeader[name][:-1]
+   bounds = np.concatenate([[0], np.flatnonzero(changed) + 1, [len(fixedLeader)]])
+   return([slice(int(start), int(stop)) for start, stop in zip(bounds[:-1], bounds[1:])])
+
+# Decode the ensembles starting at <offsets> in <buffer> (default: all the
+# ensembles) in one WHEnsembleArrays per configuration segment
+def readSegmentArrays(buffer, offsets=None, dataTypes=None, cells=None):
+   leaders = WHEnsembleArrays()
+   leaders.readLeaderArrays(buffer, offsets)
+   segments = []
+   for segment in getConfigurationSegments(leaders.fixedLeader):
+      arrays = WHEnsembleArrays()
+      arrays.readEnsembleArrays(buffer, leaders.offsets[segment], dataTypes, cells)
+      segments.append(arrays)
+   return(segments)
+
+#----------------------------------------
+#---  Class columnar ensemble arrays  ---
+#----------------------------------------
+class WHEnsembleArrays():
+   def __init__(self):
+      self.offsets = np.zeros(0, dtype=np.int64)
+      self.nbCells = 0         # number of cells decoded
+      self.firstCell = 0       # first cell decoded
+      self.nbBeams = 0
+      self.dataTypes = []      # data types of the first ensemble, in their order
+      self.nbDataTypes = np.zeros(0, dtype=np.uint8) # number of data types of each ensemble
+      self.fixedLeader = np.zeros(0, dtype=FIXEDLEADERDTYPE)
+      self.variableLeader = np.zeros(0, dtype=VARIABLELEADERDTYPE)
+      self.velocity = None     # int16 [ensemble, cell, beam]
+      self.correlation = None  # uint8 [ensemble, cell, beam]
+      self.intensity = None    # uint8 [ensemble, cell, beam]
+      self.percentGood = None  # uint8 [ensemble, cell, beam]
+
+   # Decode the leaders of the ensembles starting at <offsets> in <buffer>
+   def readLeaderArrays(self, buffer, offsets=None):
+      data = np.frombuffer(buffer, dtype=np.uint8)
+      if offsets is None:
+         offsets = getEnsembleOffsets(buffer)
+      self.offsets = np.asarray(offsets, dtype=np.int64)
+      nbEnsembles = len(self.offsets)
+      self.nbDataTypes = data[self.offsets + 5]
+      self.fixedLeader = np.zeros(nbEnsembles, dtype=FIXEDLEADERDTYPE)
+      self.variableLeader = np.zeros(nbEnsembles, dtype=VARIABLELEADERDTYPE)
+      self._readLeader(data, FIXEDLEADER, self.fixedLeader)
+      self._readLeader(data, VARIABLELEADER, self.variableLeader)
+      return(nbEnsembles)
+
+   # Decode all the ensembles starting at <offsets> in <buffer> (bytes, mmap, ...)
+   # Only the profiles listed in <dataTypes> are decoded (default: all), the other ones are None
+   # Only the cells of the range <cells> (slice, default: all) are decoded
+   def readEnsembleArrays(self, buffer, offsets=None, dataTypes=None, cells=None):
+      data = np.frombuffer(buffer, dtype=np.uint8)
+      nbEnsembles = self.readLeaderArrays(buffer, offsets)
+
+      # Size of the profiles
+      if nbEnsembles > 0:
+         nbCells = np.unique(self.fixedLeader['NumberOfCells'])
+         nbBeams = np.unique(self.fixedLeader['NumberOfBeams'])
+         if len(nbCells) > 1 or len(nbBeams) > 1:
+            raise IOError('Number of cells or beams changes within the data ({} cells, {} beams), see readSegmentArrays'.format(nbCells, nbBeams))
+         self.firstCell, lastCell = getCellRange(cells, int(nbCells[0]))
+         self.nbCells = lastCell - self.firstCell
+         self.nbBeams = int(nbBeams[0])
+         self.dataTypes = getDataTypes(data, self.offsets[0])
+
+      # Profiles
+      if dataTypes == None:
+         dataTypes = list(DATATYPES.values())
+      self.velocity = self.correlation = self.intensity = self.percentGood = None
+      if VELOCITYPROFILE in dataTypes:
+         self.velocity = self._readProfile(data, VELOCITYPROFILE, '<i2', BADVELOCITY)
+      if CORRELATIONPROFILE in dataTypes:
+         self.correlation = self._readProfile(data, CORRELATIONPROFILE, 'u1', 0)
+      if INTENSITYPROFILE in dataTypes:
+         self.intensity = self._readProfile(data, INTENSITYPROFILE, 'u1', 0)
+      if PERCENTGOODPROFILE in dataTypes:
+         self.percentGood = self._readProfile(data, PERCENTGOODPROFILE, 'u1', 0)
+      return(nbEnsembles)
+
+   def _readLeader(self, data, dataType, out):
+      for first in range(0, len(self.offsets), BLOCKSIZE):
+         positions = getDataTypePositions(data, self.offsets[first:first+BLOCKSIZE], dataType)
+         found = positions >= 0
+         raw = _gatherBytes(data, positions[found], out.dtype.itemsize)
+         out[first:first+BLOCKSIZE][found] = raw.view(out.dtype).reshape(-1)
+
+   def _readProfile(self, data, dataType, dtype, fillValue):
+      dtype = np.dtype(dtype)
+      out = np.full((len(self.offsets), self.nbCells, self.nbBeams), fillValue, dtype=dtype)
+      width = self.nbCells*self.nbBeams*dtype.itemsize
+      # Only the bytes of the cells decoded are gathered
+      skipped = 2 + self.firstCell*self.nbBeams*dtype.itemsize
+      for first in range(0, len(self.offsets), BLOCKSIZE):
+         positions = getDataTypePositions(data, self.offsets[first:first+BLOCKSIZE], dataType)
+         found = positions >= 0
+         raw = _gatherBytes(data, positions[found] + skipped, width)
+         out[first:first+BLOCKSIZE][found] = raw.view(dtype).reshape(-1, self.nbCells, self.nbBeams)
+      return(out)
+
+   # Return the ensembles <key> (slice) as WHEnsembleArrays, views of these arrays
+   def getEnsembles(self, key):
+      arrays = type(self)()
+      arrays.offsets = self.offsets[key]
+      arrays.nbCells = self.nbCells
+      arrays.firstCell = self.firstCell
+      arrays.nbBeams = self.nbBeams
+      arrays.dataTypes = self.dataTypes
+      arrays.nbDataTypes = self.nbDataTypes[key]
+      arrays.fixedLeader = self.fixedLeader[key]
+      arrays.variableLeader = self.variableLeader[key]
+      for name in ('velocity', 'correlation', 'intensity', 'percentGood'):
+         values = getattr(self, name)
+         setattr(arrays, name, None if values is None else values[key])
+      return(arrays)
+
+   # Return the configuration (SEGMENTFIELDS of the fixed leader) of the first ensemble
+   def getConfiguration(self):
+      if self.getNumberOfEnsembles() == 0:
+         return(None)
+      return(dict((name, int(self.fixedLeader[name][0])) for name in SEGMENTFIELDS))
+
+   def getNumberOfEnsembles(self):
+      return(len(self.offsets))
+
+   def getNumberOfCells(self):
+      return(self.nbCells)
+
+   def getNumberOfBeams(self):
+      return(self.nbBeams)
+
+   def getElementNumber(self):
+      return(65535 * self.variableLeader['EnsembleMSB'].astype(np.int64) + self.variableLeader['EnsembleNumber'])
+
+   def getHeading(self):
+      return(self.variableLeader['Heading']*0.01)
+
+   def getPitch(self):
+      return(self.variableLeader['Pitch']*0.01)
+
+   def getRoll(self):
+      return(self.variableLeader['Roll']*0.01)
+
+   def getTemperature(self):
+      return(self.variableLeader['Temperature']*0.01)
+
+   def getDepthSensor(self):
+      # Depth is store in decimeter, it is output in meter here
+      return(self.variableLeader['DepthOfTransducer']*0.1)
+
+   def getSpeedOfSound(self):
+      return(self.variableLeader['SpeedOfSound'])
+
+   def getSalinity(self):
+      return(self.variableLeader['Salinity'])
+
+   def getPressure(self):
+      return(self.variableLeader['Pressure'])
+
+   # Start of the ensembles (RTC) as datetime64[ms], NaT if the RTC is not valid
+   def getStartDateTime(self):
+      vl = self.variableLeader
+      years = getFullYears(vl['RTCYear'])
+      times = getDateTimeArray(years, vl['RTCMonth'], vl['RTCDay'],
+                               vl['RTCHour'], vl['RTCMinute'], vl['RTCSecond'], vl['RTCHundreds'])
+      times[years < 0] = np.datetime64('NaT')
+      return(times)
+
+   # Date and time of the ensembles from the Y2K RTC as datetime64[ms], NaT if it is not valid
+   def getDateTime(self):
+      vl = self.variableLeader
+      years = vl['Y2KRTCentury'].astype(np.int64)*100 + vl['Y2KRTCYear']
+      return(getDateTimeArray(years, vl['Y2KRTCMonth'], vl['Y2KRTCDay'],
+                              vl['Y2KRTCHour'], vl['Y2KRTCMinute'], vl['Y2KRTCSecond'], vl['Y2KRTCHundreds']))
+
+   # Velocities in m.s-1, NaN where the beam velocity is bad
+   def getCellVelocity(self):
+      vels = self.velocity*0.001
+      vels[self.velocity == BADVELOCITY] = np.nan
+      return(vels)
+
+   def getVerticalSize(self):
+      return(self.fixedLeader['DepthCellLength']*0.01) # in meter
+
+   def getDis1(self):
+      return(self.fixedLeader['Bin1Distance']*0.01) # in meter
+
+   # Distance of the center of the cells from the transducer [ensemble, cell], in meter
+   def getBinDepths(self):
+      cells = np.arange(self.firstCell, self.firstCell + self.nbCells)
+      return(self.getDis1()[:,None] + cells*self.getVerticalSize()[:,None])
+
+   # Fixed leader values used by the coordinate transformations (see WHFixedLeader)
+   def getBeamAngle(self):
+      theByte = self.fixedLeader['SystemConfiguration'] & 0xff
+      return(np.select([theByte & 0b01 != 0, theByte & 0b10 != 0, theByte & 0b111 != 0],
+                       [20, 30, 25],
+                       self.fixedLeader['BeamAngle'].astype(np.int64)))
+
+   def getFacingBeam(self):
+      return(np.where((self.fixedLeader['SystemConfiguration'] >> 8) & 0b1, 180, 0))
+
+   def getUsePitchSensor(self):
+      return((self.fixedLeader['SensorSource'] & 0b00010000) != 0)
+
+   def getHeadingAlignment(self):
+      return(self.fixedLeader['HeadingAlignement']*0.01)
+
+   def getCorrelationThrehold(self):
+      return(self.fixedLeader['LowCorrThreshold'])
+
+   # Correlation test of all the ensembles at once
+   # Return the velocities corrected from the speed of sound [ensemble, cell, beam]
+   # and the mask of the valid beams velocities
+   def correlationTestArray(self):
+      C = getSpeedOfSound(self.getTemperature(), self.getSalinity(), self.getDepthSensor())
+      CA = self.getSpeedOfSound()
+      vels = self.velocity*0.001*(C/CA)[:,None,None]
+      valid = (self.correlation >= self.getCorrelationThrehold()[:,None,None]) & (self.velocity != BADVELOCITY)
+      return(vels, valid)
+
+   # Transform beam coordinates to XYZ coordinates [ensemble, cell, 4]
+   def BeamToXYZ(self):
+      vels, valid = self.correlationTestArray()
+      return(beamToXYZ(vels, valid, self.getBeamAngle(), 1)) # convex beams, see WHFixedLeader.getConcaveOrConvex
+
+   # Transform beam coordinates to East, North and Up coordinates [ensemble, cell, 4]
+   def BeamToENU(self):
+      M = getRotationMatrices(self.getHeading(), self.getPitch(), self.getRoll(),
+                              self.getHeadingAlignment(), self.getFacingBeam(),
+                              self.getUsePitchSensor())
+      return(XYZToENU(self.BeamToXYZ(), M))
+
+   # Return the velocities in the required coordinate system
+   def getVelocity(self, coordinates='BEAM'):
+      if coordinates == COORDSYSTEM[8]: # Instrument
+         return(self.BeamToXYZ())
+      elif coordinates == COORDSYSTEM[24]: # Earth
+         return(self.BeamToENU())
+      return(self.getCellVelocity())
+
+   # Depth of the cells corrected by the speed of sound [ensemble, cell], in
+   # meter (see readEnsemble.getCorrectedCellDepth): the speed of sound is
+   # averaged from the transducer down to each cell, one cell at a time for
+   # all the ensembles, from the first cell of the configuration
+   def getCorrectedCellDepth(self):
+      lastCell = self.firstCell + self.nbCells
+      temperature, salinity, depth = self.getTemperature(), self.getSalinity(), self.getDepthSensor()
+      dis1, size = self.getDis1(), self.getVerticalSize()
+      direction = np.where(self.getFacingBeam() == 180, -1, 1)
+      tan2 = np.square(np.tan(np.deg2rad(self.getBeamAngle())))
+      CA = self.getSpeedOfSound() # Stored speed of sound
+      C0 = C = getSpeedOfSound(temperature, salinity, depth) # at the transducer
+      depths = np.zeros((self.getNumberOfEnsembles(), lastCell))
+      for n in range(lastCell):
+         k = np.sqrt(1 + (1 - np.square(C/C0)*tan2))
+         if n == 0:
+            depths[:,n] = dis1*k*(C/CA)
+         else:
+            depths[:,n] = k*(C/CA)*size + depths[:,n-1]
+         centerCellDepth = depth + direction*(dis1 + n*size)
+         C = (getSpeedOfSound(temperature, salinity, centerCellDepth) + C) * 0.5
+      return(depths[:,self.firstCell:])
+
+   # Return the leaders as a pandas DataFrame indexed by the ensemble start
+   # time, one column per field of the variable leader (and of the fixed
+   # leader with <fixedLeader>), as decoded. The columns wrap the leader
+   # arrays, they are not copied.
+   def toDataFrame(self, fixedLeader=False):
+      if pd is None:
+         raise ImportError('pandas is needed to build a DataFrame')
+      columns = dict((name, self.variableLeader[name]) for name in self.variableLeader.dtype.names)
+      if fixedLeader:
+         columns.update((name, self.fixedLeader[name]) for name in self.fixedLeader.dtype.names)
+      index = pd.DatetimeIndex(self.getStartDateTime(), name='time')
+      return(pd.DataFrame(columns, index=index, copy=False))
+
+   # Return the profiles as a xarray Dataset of dimensions time, cell and
+   # beam, with the corrected depth of the cells as coordinate (see
+   # getProfileVariables). The profile arrays are wrapped, not copied.
+   def toXarray(self, coordinates='BEAM'):
+      if xr is None:
+         raise ImportError('xarray is needed to build a Dataset')
+      variables = dict((name, xr.Variable(PROFILEDIMS, values, attrs)) \
+                       for name, (values, attrs) in getProfileVariables(self, coordinates).items())
+      return(xr.Dataset(variables, coords=getDatasetCoords(self), attrs=getDatasetAttributes(self, coordinates)))
+
+# Return the decoded profiles of <arrays> (WHEnsembleArrays): name -> (array
+# [ensemble, cell, beam], attributes). They are the decoded arrays (views),
+# velocities in mm.s-1 with their bad value as _FillValue (xr.decode_cf
+# gives them as float with NaN), except the velocities in INSTRUMENT or
+# EARTH <coordinates> computed in m.s-1
+def getProfileVariables(arrays, coordinates='BEAM'):
+   variables = {}
+   if arrays.velocity is not None:
+      if coordinates == COORDSYSTEM[0]:
+         variables['velocity'] = (arrays.velocity, {'units': 'mm s-1', '_FillValue': BADVELOCITY})
+      else:
+         variables['velocity'] = (arrays.getVelocity(coordinates), {'units': 'm s-1'})
+   if arrays.correlation is not None:
+      variables['correlation'] = (arrays.correlation, {'units': 'count'})
+   if arrays.intensity is not None:
+      variables['intensity'] = (arrays.intensity, {'units': 'count', 'scale_factor_dB': INTENSITYSCALE*10})
+   if arrays.percentGood is not None:
+      variables['percentGood'] = (arrays.percentGood.view(np.int8), {'units': 'percent'})
+   return(variables)
+
+# Return the coordinates of the profiles of <arrays> (WHEnsembleArrays)
+def getDatasetCoords(arrays):
+   return({
+      'time': ('time', arrays.getStartDateTime()),
+      'ensemble': ('time', arrays.getElementNumber()),
+      'cell': ('cell', np.arange(arrays.firstCell+1, arrays.firstCell+arrays.nbCells+1)),
+      'beam': ('beam', np.arange(1, arrays.nbBeams+1)),
+      'depth': (('time', 'cell'), arrays.getCorrectedCellDepth(),
+                {'units': 'm', 'long_name': 'distance of the cell center from the transducer corrected by the speed of sound'}),
+      })
+
+# Return the global attributes of the profiles of <arrays> (WHEnsembleArrays),
+# the coordinate metadata of the first ensemble (see WHHdf5Writer)
+def getDatasetAttributes(arrays, coordinates='BEAM'):
+   attrs = {
+      'coordinateSystem': coordinates,
+      'nbCells': arrays.getNumberOfCells(),
+      'nbBeams': arrays.getNumberOfBeams(),
+      }
+   if arrays.getNumberOfEnsembles() > 0:
+      attrs['bin1Distance'] = arrays.getDis1()[0]
+      attrs['cellSize'] = arrays.getVerticalSize()[0]
+      attrs['beamAngle'] = arrays.getBeamAngle()[0]
+      attrs['orientation'] = 'up' if arrays.getFacingBeam()[0] == 180 else 'down'
+   return(attrs)
@@ -0,0 +1,143 @@
+#!/usr/bin/python
+#-*- coding: utf-8 -*-
+
+import time
+import asyncio
+
+from utils.pyArrayClass import *
+from utils.pyReaderClass import TCPPREFIX, STREAMBLOCKSIZE, openLiveSource, readChunk
+from utils.pyScanClass import WHStreamFramer
+
+# Number of batches of ensembles waiting for their writing, per source
+QUEUESIZE = 16
+# Seconds between two reports of the sources lag (0: no report)
+REPORTINTERVAL = 10
+
+#----------------------------------------
+#---  Class statistics of a source    ---
+#----------------------------------------
+class WHSourceStats():
+   def __init__(self, name):
+      self.name = name
+      self.nbReceived = 0  # ensembles framed
+      self.nbWritten = 0   # ensembles written
+      self.queue = None    # batches waiting for their writing
+      self.lag = 0.0       # seconds between the reception and the writing of the last batch
+      self.maxLag = 0.0
+      self.scanner = None  # scanner of the framer, for the corrupted data report
+
+   def getQueued(self):
+      return(0 if self.queue is None else self.queue.qsize())
+
+   def write(self):
+      return('{}: {} ensembles received, {} written, {} batches queued, lag {:.3f} s (max {:.3f} s)'.format(
+                      self.name, self.nbReceived, self.nbWritten, self.getQueued(), self.lag, self.maxLag))
+
+#----------------------------------------
+#---  Class asyncio ingest pipeline   ---
+#----------------------------------------
+# Read several live sources (see openLiveSource) in one process, each one
+# written to its own writer (WHTextWriter or a binary writer). Every
+# source has a reader task framing its chunks and a sink task decoding
+# and writing them, linked by a queue of at most <queueSize> batches: a
+# slow writer stops the reading of its source instead of growing the
+# memory (the sender is then slowed down by the TCP flow control). The
+# blocking reads (stdin, pipes, serial lines), the decoding and the
+# writing run in the default executor.
+class WHAsyncPipeline():
+   def __init__(self, queueSize=QUEUESIZE, reportInterval=REPORTINTERVAL, chunkSize=STREAMBLOCKSIZE):
+      self.queueSize = queueSize
+      self.reportInterval = reportInterval
+      self.chunkSize = chunkSize
+      self.sources = []  # (name, writer, dataTypes, stats)
+
+   # Add the source <name> written by <writer>, only the profiles listed in
+   # <dataTypes> are decoded (default: all), return its statistics
+   def addSource(self, name, writer, dataTypes=None):
+      stats = WHSourceStats(name)
+      self.sources.append((name, writer, dataTypes, stats))
+      return(stats)
+
+   def getStats(self):
+      return([stats for name, writer, dataTypes, stats in self.sources])
+
+   # Read and convert all the sources up to their end
+   async def run(self):
+      tasks = []
+      for name, writer, dataTypes, stats in self.sources:
+         queue = asyncio.Queue(maxsize=self.queueSize)
+         stats.queue = queue
+         tasks.append(asyncio.ensure_future(self._readSource(name, queue, stats)))
+         tasks.append(asyncio.ensure_future(self._writeSink(queue, writer, dataTypes, stats)))
+      reporter = None
+      if self.reportInterval > 0:
+         reporter = asyncio.ensure_future(self._report())
+      try:
+         await asyncio.gather(*tasks)
+      finally:
+         for task in tasks:
+            task.cancel()
+         if reporter is not None:
+            reporter.cancel()
+
+   async def _readSource(self, name, queue, stats):
+      loop = asyncio.get_running_loop()
+      framer = WHStreamFramer()
+      stats.scanner = framer.scanner
+      source = None
+      try:
+         if name.startswith(TCPPREFIX):
+            host, port = name[len(TCPPREFIX):].rsplit(':', 1)
+            reader, source = await asyncio.open_connection(host, int(port))
+            read = reader.read
+         else:
+            source = await loop.run_in_executor(None, openLiveSource, name)
+            read = lambda size: loop.run_in_executor(None, readChunk, source, size)
+         while True:
+            chunk = await read(self.chunkSize)
+            if not chunk:
+               break
+            await self._put(queue, framer.feed(chunk), stats)
+         await self._put(queue, framer.close(), stats)
+      finally:
+         if source is not None:
+            source.close()
+         # End of the source, even if it could not be opened
+         await queue.put(None)
+
+   async def _put(self, queue, ensembles, stats):
+      if len(ensembles) == 0:
+         return
+      stats.nbReceived += len(ensembles)
+      # Wait here while the queue is full (backpressure)
+      await queue.put((time.monotonic(), [rawEnsemble for offset, rawEnsemble in ensembles]))
+
+   async def _writeSink(self, queue, writer, dataTypes, stats):
+      loop = asyncio.get_running_loop()
+      try:
+         while True:
+            batch = await queue.get()
+            if batch is None:
+               break
+            received, rawEnsembles = batch
+            await loop.run_in_executor(None, writeRawEnsembles, writer, rawEnsembles, dataTypes)
+            stats.nbWritten += len(rawEnsembles)
+            stats.lag = time.monotonic() - received
+            stats.maxLag = max(stats.maxLag, stats.lag)
+      finally:
+         await loop.run_in_executor(None, writer.close)
+
+   async def _report(self):
+      while True:
+         await asyncio.sleep(self.reportInterval)
+         self.printReport()
+
+   def printReport(self):
+      for stats in self.getStats():
+         print(stats.write())
+
+# Decode the raw ensembles and write them with <writer>, by configuration segment
+def writeRawEnsembles(writer, rawEnsembles, dataTypes=None):
+   for arrays in decodeRawSegments(rawEnsembles, dataTypes):
+      writer.writeArrays(arrays)
+   writer.flush()
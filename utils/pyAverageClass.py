@@ -0,0 +1,269 @@
+#!/usr/bin/python
+#-*- coding: utf-8 -*-
+
+import numpy as np
+
+from utils.pyArrayClass import *
+from utils.pyExportClass import WHTextWriter
+
+# Units of the averaged fields
+AVERAGEUNITS = {
+      'heading': 'degree',
+      'pitch': 'degree',
+      'roll': 'degree',
+      'salinity': 'ppt',
+      'temperature': 'degree_Celsius',
+      'pressure': 'decapascal',
+      'velocity': 'm s-1',
+      'correlation': 'count',
+      'intensity': 'dB',
+      'percentGood': 'percent',
+      }
+
+#----------------------------------------
+#---  Class averaged ensembles        ---
+#----------------------------------------
+# Bins of ensembles reduced by WHEnsembleAverager, one row per bin. The
+# leaders (configuration and metadata, see WHEnsembleArrays) are the ones
+# of the first ensemble of the bin. The sums, sums of squares and counts
+# of the valid values of each bin are in <sums>, the averages exported by
+# the writers in <fields>: name -> (array, units).
+class WHAverageArrays(WHEnsembleArrays):
+   def __init__(self):
+      WHEnsembleArrays.__init__(self)
+      self.bins = np.zeros(0, dtype=np.int64)            # bin of each row
+      self.dateTimes = np.zeros(0, dtype='M8[ms]')       # date and time of each bin
+      self.sums = {}   # name -> (sum, sum of squares, count)
+      self.fields = {} # name -> (average, units)
+
+   # Return the bins <key> (slice), views of these arrays
+   def getEnsembles(self, key):
+      arrays = WHEnsembleArrays.getEnsembles(self, key)
+      arrays.bins = self.bins[key]
+      arrays.dateTimes = self.dateTimes[key]
+      arrays.sums = dict((name, tuple(values[key] for values in sums)) for name, sums in self.sums.items())
+      arrays.fields = dict((name, (values[key], units)) for name, (values, units) in self.fields.items())
+      return(arrays)
+
+   # Add the sums of the bin <other> (WHAverageArrays of one row) to the first bin
+   def addFirstBin(self, other):
+      self.fixedLeader[0] = other.fixedLeader[0]
+      self.variableLeader[0] = other.variableLeader[0]
+      self.offsets[0] = other.offsets[0]
+      self.dateTimes[0] = other.dateTimes[0]
+      for name, sums in self.sums.items():
+         for values, others in zip(sums, other.sums[name]):
+            values[0] += others[0]
+
+   # Compute the averages of the sums
+   def setFields(self):
+      count = self.sums['pitch'][2]
+      sinSum = self.sums['headingSin'][0]
+      cosSum = self.sums['headingCos'][0]
+      self.fields = {
+         'ensembleNumber': (self.getElementNumber(), ''),
+         'dateTime': (self.dateTimes, ''),
+         'nbEnsembles': (count.astype(np.int32), 'count'),
+         'heading': (np.degrees(np.arctan2(sinSum, cosSum)) % 360.0, 'degree'),
+         }
+      for name in ('pitch', 'roll', 'salinity', 'temperature', 'pressure'):
+         self.fields[name] = (self.sums[name][0] / count, AVERAGEUNITS[name])
+      for name in ('velocity', 'correlation', 'intensity', 'percentGood'):
+         if name not in self.sums:
+            continue
+         total, squares, valid = self.sums[name]
+         with np.errstate(invalid='ignore', divide='ignore'):
+            mean = total / valid
+            std = np.sqrt(np.maximum(squares / valid - mean*mean, 0.0))
+         self.fields[name] = (mean.astype(np.float32), AVERAGEUNITS[name])
+         if name == 'velocity':
+            self.fields['velocityStd'] = (std.astype(np.float32), AVERAGEUNITS[name])
+            self.fields['velocityCount'] = (valid.astype(np.int32), 'count')
+      self.fields['fixedLeader'] = (self.fixedLeader, '')
+
+   # Averaged fields, exported as they are (see getExportFields)
+   def getExportFields(self, coordinates='BEAM'):
+      return(self.fields)
+
+#----------------------------------------
+#---  Class streaming averager         ---
+#----------------------------------------
+# Average the decoded ensembles by bins of <interval> seconds (from the
+# ensemble start time) or of <size> ensembles before writing them to
+# <outfile> (a binary writer or a WHAverageTextWriter). It is used as a
+# writer: blocks of ensembles (WHEnsembleArrays) are reduced at once, the
+# complete bins are written and only the sums of the last bin, which may
+# continue in the next block, are kept. A bin is closed when the
+# configuration changes (see getConfigurationSegments), the bins of <size>
+# ensembles are counted from the start of each configuration. Velocities are
+# averaged in the <coordinates> system: in EARTH coordinates the east,
+# north and up components are averaged (vector average). Bad velocities,
+# and in INSTRUMENT or EARTH coordinates the cells with less than 3 valid
+# beams (4 for the error velocity), are not counted.
+class WHEnsembleAverager():
+   def __init__(self, outfile, coordinates='BEAM', interval=None, size=None, dataTypes=None):
+      if (interval == None) == (size == None):
+         raise ValueError('Either an interval or a number of ensembles is needed to average')
+      if (interval != None and interval <= 0) or (size != None and size < 1):
+         raise ValueError('Invalid averaging interval ({}) or number of ensembles ({})'.format(interval, size))
+      self.outfile = outfile
+      self.coordinates = coordinates
+      self.interval = interval
+      self.size = size
+      self.dataTypes = dataTypes if dataTypes != None else list(DATATYPES.values())
+      self.nbEnsembles = 0 # ensembles averaged
+      self.nbBins = 0      # bins written
+      self._open = None    # last bin, not complete (WHAverageArrays)
+      self._configuration = None # configuration of the current segment
+      self._position = 0   # ensembles averaged since the start of the configuration
+
+   # Average the ensembles of <arrays> (WHEnsembleArrays)
+   def writeArrays(self, arrays):
+      for segment in getConfigurationSegments(arrays.fixedLeader):
+         self._reduceSegment(arrays.getEnsembles(segment))
+
+   def _reduceSegment(self, arrays):
+      configuration = arrays.getConfiguration()
+      if configuration != self._configuration:
+         self._configuration = configuration
+         self._position = 0
+      bins = self._reduce(arrays)
+      if self._open is not None:
+         if self._open.getConfiguration() == bins.getConfiguration() and self._open.bins[0] == bins.bins[0]:
+            bins.addFirstBin(self._open)
+         else:
+            self._write(self._open)
+         self._open = None
+      nbBins = bins.getNumberOfEnsembles()
+      if nbBins > 1:
+         self._write(bins.getEnsembles(slice(0, nbBins-1)))
+      self._open = bins.getEnsembles(slice(nbBins-1, nbBins))
+      self.nbEnsembles += arrays.getNumberOfEnsembles()
+      self._position += arrays.getNumberOfEnsembles()
+
+   # Return the sums of the runs of consecutive ensembles of the same bin
+   def _reduce(self, arrays):
+      nbEnsembles = arrays.getNumberOfEnsembles()
+      dateTimes = arrays.getStartDateTime()
+      if self.interval != None:
+         if np.isnat(dateTimes).any():
+            raise IOError('Invalid date time in ensemble {}'.format(arrays.getElementNumber()[np.isnat(dateTimes)][0]))
+         intervalMs = int(round(self.interval*1000))
+         ids = dateTimes.astype(np.int64) // intervalMs
+         dateTimes = (ids*intervalMs).astype('M8[ms]')
+      else:
+         ids = (self._position + np.arange(nbEnsembles)) // self.size
+      starts = np.concatenate([[0], np.flatnonzero(ids[1:] != ids[:-1]) + 1])
+
+      bins = WHAverageArrays()
+      first = arrays.getEnsembles(starts)
+      bins.offsets = first.offsets
+      bins.nbCells = first.nbCells
+      bins.firstCell = first.firstCell
+      bins.nbBeams = first.nbBeams
+      bins.dataTypes = first.dataTypes
+      bins.nbDataTypes = first.nbDataTypes
+      bins.fixedLeader = first.fixedLeader
+      bins.variableLeader = first.variableLeader
+      bins.bins = ids[starts]
+      bins.dateTimes = dateTimes[starts]
+      for name, values in self._getValues(arrays).items():
+         valid = ~np.isnan(values)
+         values = np.where(valid, values, 0.0)
+         bins.sums[name] = (np.add.reduceat(values, starts, axis=0),
+                            np.add.reduceat(values*values, starts, axis=0),
+                            np.add.reduceat(valid.astype(np.int64), starts, axis=0))
+      return(bins)
+
+   # Return the values to average of each ensemble, NaN where they are not valid
+   def _getValues(self, arrays):
+      heading = np.radians(arrays.getHeading())
+      values = {
+         'headingSin': np.sin(heading),
+         'headingCos': np.cos(heading),
+         'pitch': arrays.getPitch(),
+         'roll': arrays.getRoll(),
+         'salinity': arrays.getSalinity().astype(np.float64),
+         'temperature': arrays.getTemperature(),
+         'pressure': arrays.getPressure().astype(np.float64),
+         }
+      if arrays.velocity is not None and VELOCITYPROFILE in self.dataTypes:
+         values['velocity'] = self._getVelocity(arrays)
+      if arrays.correlation is not None and CORRELATIONPROFILE in self.dataTypes:
+         values['correlation'] = arrays.correlation.astype(np.float64)
+      if arrays.intensity is not None and INTENSITYPROFILE in self.dataTypes:
+         values['intensity'] = INTENSITYDB[arrays.intensity]
+      if arrays.percentGood is not None and PERCENTGOODPROFILE in self.dataTypes:
+         values['percentGood'] = arrays.percentGood.view(np.int8).astype(np.float64)
+      return(values)
+
+   # Velocities in the coordinate system, NaN where they are not valid
+   def _getVelocity(self, arrays):
+      vels = arrays.getVelocity(self.coordinates)
+      if self.coordinates == COORDSYSTEM[0]:
+         return(vels)
+      vels, valid = vels.copy(), arrays.correlationTestArray()[1]
+      nbValid = valid.sum(axis=-1)
+      vels[nbValid < 3] = np.nan
+      vels[...,3][nbValid < 4] = np.nan
+      return(vels)
+
+   def _write(self, bins):
+      bins.setFields()
+      self.outfile.writeArrays(bins)
+      self.nbBins += bins.getNumberOfEnsembles()
+
+   # The last bin may continue with the next ensembles, it is written on close
+   def flush(self):
+      self.outfile.flush()
+
+   def close(self):
+      if self._open is not None:
+         self._write(self._open)
+         self._open = None
+      self.outfile.close()
+
+   # The last bin is counted even if it is not written yet
+   def printReport(self):
+      nbBins = self.nbBins + (0 if self._open is None else self._open.getNumberOfEnsembles())
+      print('Averaged: {} ensembles in {} bins'.format(self.nbEnsembles, nbBins))
+
+#----------------------------------------
+#---  Class averages text export      ---
+#----------------------------------------
+# Write the averaged bins (WHAverageArrays) as text, one line per bin with
+# the averaged fields in the order of WHAverageArrays.setFields, after a
+# header line (starting with #) naming them with the size of the profiles,
+# written again when this size changes
+class WHAverageTextWriter(WHTextWriter):
+   def __init__(self, filename, coordinates='BEAM', dataTypes=None, size=0):
+      WHTextWriter.__init__(self, filename, coordinates, dataTypes, size)
+      self._header = None # last header written
+
+   # Return the lines of the bins of <arrays> (WHAverageArrays)
+   def formatArrays(self, arrays):
+      if arrays.getNumberOfEnsembles() == 0:
+         return([])
+      names = []
+      columns = []
+      for name, (values, units) in arrays.getExportFields(self.coordinates).items():
+         if values.dtype.names is not None:
+            continue
+         if values.ndim > 1:
+            names.append('{}[{}]'.format(name, 'x'.join([str(n) for n in values.shape[1:]])))
+         else:
+            names.append(name)
+         if name == 'dateTime':
+            columns.append([str(dt) for dt in values.astype(object).tolist()])
+         elif values.dtype.kind in 'iu':
+            columns.append(self._formatProfile(values, '{:d},', ''))
+         elif name.startswith('velocity'):
+            columns.append([line.replace('nan', 'Nan') for line in self._formatProfile(values, '{:.5f},', '')])
+         else:
+            columns.append([line.replace('nan', 'Nan') for line in self._formatProfile(values, '{:.2f},', '')])
+      lines = ['{}\n'.format(','.join(items)) for items in zip(*columns)]
+      header = '# {}\n'.format(','.join(names))
+      if header != self._header:
+         lines.insert(0, header)
+         self._header = header
+      return(lines)
@@ -0,0 +1,481 @@
+#!/usr/bin/python
+#-*- coding: utf-8 -*-
+
+import os
+import json
+import shutil
+import zipfile
+import struct as st
+import numpy as np
+try:
+   import h5py
+except ImportError:
+   h5py = None
+try:
+   import pyarrow as pa
+   import pyarrow.parquet as pq
+except ImportError:
+   pa = None
+
+from utils.pyGeneralClass import *
+from utils.pyArrayClass import getConfigurationSegments
+
+# Intensity in dB of the 256 internal values for the binary outputs
+INTENSITYDB32 = INTENSITYDB.astype(np.float32)
+# Buffer of the text output files
+TEXTBUFFERSIZE = 1 << 20
+# Number of ensembles of the chunks of the HDF5/NetCDF variables
+HDF5CHUNKSIZE = 1024
+# Compression level (gzip) of the HDF5/NetCDF variables
+HDF5COMPRESSION = 4
+HDF5EXTENSIONS = ('.h5', '.hdf5', '.nc')
+PARQUETEXTENSIONS = ('.parquet',)
+ARROWEXTENSIONS = ('.arrow', '.feather')
+# Units of the dateTime field in HDF5/NetCDF files (CF convention)
+TIMEUNITS = 'milliseconds since 1970-01-01 00:00:00'
+
+# Return the description of the exported fields of <arrays> (WHEnsembleArrays):
+# name -> (array, units). Arrays with their own fields (averaged ensembles,
+# see WHAverageArrays) give them with their getExportFields method.
+def getExportFields(arrays, coordinates='BEAM'):
+   if hasattr(arrays, 'getExportFields'):
+      return(arrays.getExportFields(coordinates))
+   fields = {
+      'ensembleNumber': (arrays.getElementNumber(), ''),
+      'dateTime': (arrays.getStartDateTime(), ''),
+      'heading': (arrays.getHeading(), 'degree'),
+      'pitch': (arrays.getPitch(), 'degree'),
+      'roll': (arrays.getRoll(), 'degree'),
+      'salinity': (arrays.getSalinity(), 'ppt'),
+      'temperature': (arrays.getTemperature(), 'degree_Celsius'),
+      'pressure': (arrays.getPressure(), 'decapascal'),
+      'fixedLeader': (arrays.fixedLeader, ''),
+      'variableLeader': (arrays.variableLeader, ''),
+      }
+   if arrays.velocity is not None:
+      fields['velocity'] = (arrays.getVelocity(coordinates).astype(np.float32), 'm s-1')
+   if arrays.correlation is not None:
+      fields['correlation'] = (arrays.correlation, 'count')
+   if arrays.intensity is not None:
+      fields['intensity'] = (INTENSITYDB32[arrays.intensity], 'dB')
+   if arrays.percentGood is not None:
+      fields['percentGood'] = (arrays.percentGood, 'percent')
+   return(fields)
+
+#----------------------------------------
+#---  Class text formatter            ---
+#----------------------------------------
+# Format blocks of ensembles from their arrays, one line per ensemble, in
+# the format of readEnsemble.write. Each profile is formatted for a whole
+# block with one format string per line (the one byte profiles with the
+# text of their 256 values), bad velocities are found by mask.
+class WHTextFormatter():
+   def __init__(self, coordinates='BEAM', dataTypes=None):
+      self.coordinates = coordinates
+      self.dataTypes = dataTypes
+
+   # Return the lines of the ensembles of <arrays> (WHEnsembleArrays)
+   def formatArrays(self, arrays):
+      nbEnsembles = arrays.getNumberOfEnsembles()
+      if nbEnsembles == 0:
+         return([])
+      columns = []
+      for dataType in arrays.dataTypes:
+         if self.dataTypes != None and dataType in DATATYPES.values() and dataType not in self.dataTypes:
+            continue
+         if dataType == FIXEDLEADER:
+            columns.append(self._formatFixedLeader(arrays))
+         elif dataType == VARIABLELEADER:
+            columns.append(self._formatVariableLeader(arrays))
+         elif dataType == VELOCITYPROFILE and arrays.velocity is not None:
+            if self.coordinates == COORDSYSTEM[0]:
+               lines = self._formatProfile(arrays.getCellVelocity(), '{:.3f},')
+               columns.append([line.replace('nan', 'Nan') for line in lines])
+            else:
+               columns.append(self._formatProfile(arrays.getVelocity(self.coordinates), '{:.5f},', ''))
+         elif dataType == CORRELATIONPROFILE and arrays.correlation is not None:
+            columns.append(self._formatTable(arrays.correlation, CORRELATIONTEXT))
+         elif dataType == INTENSITYPROFILE and arrays.intensity is not None:
+            columns.append(self._formatTable(arrays.intensity, INTENSITYTEXT))
+         elif dataType == PERCENTGOODPROFILE and arrays.percentGood is not None:
+            columns.append(self._formatTable(arrays.percentGood, PERCENTGOODTEXT))
+      return(['{}\n'.format(','.join(items)) for items in zip(*columns)])
+
+   # The number of cells is the one of the cells decoded
+   def _formatFixedLeader(self, arrays):
+      fl = arrays.fixedLeader
+      return(['{:d},{:d},{:d},{}'.format(nbBeams, nbCells, pings, COORDSYSTEM[cs]) \
+              for nbBeams, nbCells, pings, cs in zip(fl['NumberOfBeams'].tolist(),
+                                                     [arrays.getNumberOfCells()]*len(fl),
+                                                     fl['PingsPerEnsemble'].tolist(),
+                                                     fl['CoordinatesTransformation'].tolist())])
+
+   def _formatVariableLeader(self, arrays):
+      dateTimes = arrays.getStartDateTime()
+      if np.isnat(dateTimes).any():
+         raise IOError('Invalid date time in ensemble {}'.format(arrays.getElementNumber()[np.isnat(dateTimes)][0]))
+      return(['{:d},{},{:.2f},{:.2f},{:.2f},{:.2f},{:.2f},{:.2f},'.format(*values) \
+              for values in zip(arrays.getElementNumber().tolist(),
+                                dateTimes.astype(object).tolist(),
+                                arrays.getHeading().tolist(),
+                                arrays.getPitch().tolist(),
+                                arrays.getRoll().tolist(),
+                                arrays.getSalinity().tolist(),
+                                arrays.getTemperature().tolist(),
+                                arrays.getPressure().tolist())])
+
+   # Format a profile [ensemble, cell, beam], each value with <fmt>
+   def _formatProfile(self, values, fmt, end=','):
+      values = values.reshape(len(values), -1)
+      template = fmt * values.shape[1]
+      template = template[:len(template)-1] + end
+      return([template.format(*row) for row in values.tolist()])
+
+   # Format a one byte profile [ensemble, cell, beam] with the text of its 256 values
+   def _formatTable(self, values, table):
+      return([''.join(row) for row in table[values.reshape(len(values), -1)].tolist()])
+
+#----------------------------------------
+#---  Class text export               ---
+#----------------------------------------
+# Write the formatted ensembles through a large buffer, the output file
+# is split every <size> kilo bytes (0: not split)
+class WHTextWriter(WHTextFormatter):
+   def __init__(self, filename, coordinates='BEAM', dataTypes=None, size=0):
+      WHTextFormatter.__init__(self, coordinates, dataTypes)
+      self.filename = filename
+      self.size = size
+      self.fileCount = 0
+      self.fileSize = 0
+      self._file = open(filename, 'w', buffering=TEXTBUFFERSIZE)
+
+   # Write the ensembles of <arrays> (WHEnsembleArrays)
+   def writeArrays(self, arrays):
+      self.writeLines(self.formatArrays(arrays))
+
+   # Write lines formatted by formatArrays
+   def writeLines(self, lines):
+      if self.size <= 0:
+         self._file.write(''.join(lines))
+         return
+      for line in lines:
+         self._file.write(line)
+         self.fileSize += len(line)
+         if self.fileSize >= self.size*1000:
+            self._nextFile()
+
+   def _nextFile(self):
+      self._file.close()
+      try:
+         self._file = open('{}{}.{}'.format(self.filename.split('.')[0],self.fileCount+1,self.filename.split('.')[1]),'w', buffering=TEXTBUFFERSIZE)
+         self.fileCount += 1
+      except:
+         raise IOError('Unable to create file {}{}'.format(self.filename,self.fileCount+1))
+      self.fileSize = 0
+
+   def flush(self):
+      self._file.flush()
+
+   def close(self):
+      self._file.close()
+
+#----------------------------------------
+#---  Class growable .npy file        ---
+#----------------------------------------
+# A .npy file whose first dimension grows as arrays are appended, the
+# header is written with room for the final shape and updated on close
+class WHNpyFile():
+   def __init__(self, filename, dtype, shape):
+      self.filename = filename
+      self.dtype = np.dtype(dtype)
+      self.shape = tuple(shape) # shape of one element (ensemble)
+      self.count = 0
+      # Header large enough for any number of elements
+      self._headerSize = len(self._header(10**18))
+      self._file = open(filename, 'wb')
+      self._file.write(self._header(0, self._headerSize))
+
+   def _header(self, count, size=None):
+      header = "{{'descr': {!r}, 'fortran_order': False, 'shape': {!r}, }}".format(
+                      np.lib.format.dtype_to_descr(self.dtype), (count,) + self.shape)
+      if size == None:
+         size = ((10 + len(header) + 1 + 63) // 64) * 64
+      header = header.ljust(size - 10 - 1) + '\n'
+      return(b'\x93NUMPY\x01\x00' + st.pack('<H', len(header)) + header.encode('latin1'))
+
+   def append(self, values):
+      values = np.ascontiguousarray(values, dtype=self.dtype)
+      if values.shape[1:] != self.shape:
+         raise IOError('Shape of {} changes within the data ({} instead of {})'.format(self.filename, values.shape[1:], self.shape))
+      self._file.write(values.tobytes())
+      self.count += len(values)
+
+   # Write the current shape in the header, the file can be loaded while growing
+   def flush(self):
+      self._file.seek(0)
+      self._file.write(self._header(self.count, self._headerSize))
+      self._file.seek(0, 2)
+      self._file.flush()
+
+   def close(self):
+      self.flush()
+      self._file.close()
+
+#----------------------------------------
+#---  Class NumPy binary export       ---
+#----------------------------------------
+# Stream the decoded ensembles in one .npy file per field in a directory,
+# bundled in a .npz file on close when <filename> ends with .npz. A
+# header.json file records the cells, beams, coordinate system and bin
+# depths. A directory can be opened with np.load(..., mmap_mode='r').
+class WHNpyWriter():
+   def __init__(self, filename, coordinates='BEAM'):
+      self.filename = filename
+      self.coordinates = coordinates
+      self.bundle = filename.endswith('.npz')
+      self.directory = filename + '.tmp' if self.bundle else filename
+      if not os.path.isdir(self.directory):
+         os.makedirs(self.directory)
+      self.header = None
+      self._files = {}
+
+   # Append the ensembles of <arrays> (WHEnsembleArrays)
+   def writeArrays(self, arrays):
+      if arrays.getNumberOfEnsembles() == 0:
+         return
+      fields = getExportFields(arrays, self.coordinates)
+      if self.header == None:
+         self.header = {
+            'nbCells': arrays.getNumberOfCells(),
+            'nbBeams': arrays.getNumberOfBeams(),
+            'coordinateSystem': self.coordinates,
+            'binDepths': [float(d) for d in arrays.getBinDepths()[0]],
+            'fields': {},
+            }
+      for name, (values, units) in fields.items():
+         if name not in self._files:
+            self._files[name] = WHNpyFile(os.path.join(self.directory, name + '.npy'), values.dtype, values.shape[1:])
+            self.header['fields'][name] = {'dtype': np.lib.format.dtype_to_descr(values.dtype), 'units': units}
+         self._files[name].append(values)
+
+   def flush(self):
+      for npyFile in self._files.values():
+         npyFile.flush()
+
+   def close(self):
+      for npyFile in self._files.values():
+         npyFile.close()
+      if self.header == None:
+         self.header = {'nbCells': 0, 'nbBeams': 0, 'coordinateSystem': self.coordinates, 'binDepths': [], 'fields': {}}
+      self.header['nbEnsembles'] = max([0] + [f.count for f in self._files.values()])
+      with open(os.path.join(self.directory, 'header.json'), 'w') as headerFile:
+         json.dump(self.header, headerFile, indent=1)
+      if self.bundle:
+         with zipfile.ZipFile(self.filename, 'w', zipfile.ZIP_STORED, allowZip64=True) as npz:
+            for name in sorted(os.listdir(self.directory)):
+               npz.write(os.path.join(self.directory, name), name)
+         shutil.rmtree(self.directory)
+
+#----------------------------------------
+#---  Class HDF5/NetCDF export        ---
+#----------------------------------------
+# Stream the decoded ensembles in a HDF5 file readable as NetCDF-4: the
+# time x cell x beam variables are chunked along the time axis, compressed
+# and grown chunk by chunk. The time, cell (distance of the cells from the
+# transducer) and beam dimensions are dimension scales, the fixed leader
+# coordinate metadata of the first ensemble are global attributes.
+class WHHdf5Writer():
+   def __init__(self, filename, coordinates='BEAM', chunkSize=HDF5CHUNKSIZE):
+      if h5py is None:
+         raise ImportError('h5py is needed to write HDF5/NetCDF files')
+      self.filename = filename
+      self.coordinates = coordinates
+      self.chunkSize = chunkSize
+      self.count = 0
+      self._file = h5py.File(filename, 'w')
+      self._file.attrs['Conventions'] = 'CF-1.6'
+      self._file.attrs['coordinateSystem'] = coordinates
+
+   # Create the dimensions and global attributes from the first ensembles
+   def _createDimensions(self, arrays):
+      nbCells = arrays.getNumberOfCells()
+      nbBeams = arrays.getNumberOfBeams()
+      time = self._file.create_dataset('time', shape=(0,), maxshape=(None,), dtype=np.int64,
+                                       chunks=(self.chunkSize,), fillvalue=np.iinfo(np.int64).min)
+      time.attrs['units'] = TIMEUNITS
+      time.attrs['standard_name'] = 'time'
+      time.make_scale('time')
+      cell = self._file.create_dataset('cell', data=arrays.getBinDepths()[0])
+      cell.attrs['units'] = 'm'
+      cell.attrs['long_name'] = 'distance of the cell center from the transducer'
+      cell.make_scale('cell')
+      beam = self._file.create_dataset('beam', data=np.arange(1, nbBeams+1, dtype=np.int32))
+      beam.make_scale('beam')
+      self._file.attrs['nbCells'] = nbCells
+      self._file.attrs['nbBeams'] = nbBeams
+      self._file.attrs['bin1Distance'] = arrays.getDis1()[0]
+      self._file.attrs['cellSize'] = arrays.getVerticalSize()[0]
+      self._file.attrs['beamAngle'] = arrays.getBeamAngle()[0]
+      self._file.attrs['orientation'] = 'up' if arrays.getFacingBeam()[0] == 180 else 'down'
+
+   def _createVariable(self, name, values, units):
+      dims = ['time', 'cell', 'beam'][:values.ndim]
+      variable = self._file.create_dataset(name, shape=(0,) + values.shape[1:],
+                                           maxshape=(None,) + values.shape[1:],
+                                           dtype=values.dtype,
+                                           chunks=(self.chunkSize,) + values.shape[1:],
+                                           compression='gzip', compression_opts=HDF5COMPRESSION,
+                                           shuffle=True)
+      if units != '':
+         variable.attrs['units'] = units
+      for i, dim in enumerate(dims):
+         variable.dims[i].attach_scale(self._file[dim])
+      return(variable)
+
+   # Append the ensembles of <arrays> (WHEnsembleArrays)
+   def writeArrays(self, arrays):
+      nbEnsembles = arrays.getNumberOfEnsembles()
+      if nbEnsembles == 0:
+         return
+      if 'time' not in self._file:
+         self._createDimensions(arrays)
+      elif arrays.getNumberOfCells() != self._file.attrs['nbCells'] or arrays.getNumberOfBeams() != self._file.attrs['nbBeams']:
+         raise IOError('Number of cells or beams changes within the data ({} x {} instead of {} x {})'.format(
+                          arrays.getNumberOfCells(), arrays.getNumberOfBeams(),
+                          self._file.attrs['nbCells'], self._file.attrs['nbBeams']))
+      end = self.count + nbEnsembles
+      for name, (values, units) in getExportFields(arrays, self.coordinates).items():
+         if name == 'dateTime':
+            name, values = 'time', values.astype(np.int64) # NaT is the fill value
+         elif name not in self._file:
+            self._createVariable(name, values, units)
+         variable = self._file[name]
+         variable.resize(end, axis=0)
+         variable[self.count:end] = values
+      self.count = end
+
+   def flush(self):
+      self._file.flush()
+
+   def close(self):
+      self._file.close()
+
+#----------------------------------------
+#---  Class Parquet/Arrow export      ---
+#----------------------------------------
+# Stream the decoded ensembles in a columnar Parquet (or Arrow IPC) file,
+# one row per ensemble and one row group per block of ensembles. Leaders
+# are scalar columns (the fixedLeader and variableLeader fields are
+# flattened to "fixedLeader.<field>" columns), profiles are fixed size
+# list columns of nbCells*nbBeams values (cell major). The number of
+# cells and beams, the coordinate system and the bin depths are stored in
+# the schema metadata.
+class WHParquetWriter():
+   def __init__(self, filename, coordinates='BEAM'):
+      if pa is None:
+         raise ImportError('pyarrow is needed to write Parquet/Arrow files')
+      self.filename = filename
+      self.coordinates = coordinates
+      self.arrow = os.path.splitext(filename)[1].lower() in ARROWEXTENSIONS
+      self.schema = None
+      self._writer = None
+      self._sink = None
+
+   # Return the columns (name -> Arrow array) of <arrays> (WHEnsembleArrays)
+   def _getColumns(self, arrays):
+      columns = {}
+      for name, (values, units) in getExportFields(arrays, self.coordinates).items():
+         if values.dtype.names is not None:
+            for field in values.dtype.names:
+               columns['{}.{}'.format(name, field)] = pa.array(values[field])
+         elif values.ndim == 1:
+            columns[name] = pa.array(values)
+         else:
+            size = values[0].size
+            columns[name] = pa.FixedSizeListArray.from_arrays(pa.array(np.ascontiguousarray(values).reshape(-1)), size)
+      return(columns)
+
+   def _open(self, arrays, columns):
+      metadata = {
+         'nbCells': str(arrays.getNumberOfCells()),
+         'nbBeams': str(arrays.getNumberOfBeams()),
+         'coordinateSystem': self.coordinates,
+         'binDepths': json.dumps([float(d) for d in arrays.getBinDepths()[0]]),
+         }
+      self.schema = pa.schema([pa.field(name, column.type) for name, column in columns.items()], metadata=metadata)
+      if self.arrow:
+         self._sink = pa.OSFile(self.filename, 'wb')
+         self._writer = pa.ipc.new_file(self._sink, self.schema)
+      else:
+         self._writer = pq.ParquetWriter(self.filename, self.schema)
+
+   # Append the ensembles of <arrays> (WHEnsembleArrays) as one row group
+   def writeArrays(self, arrays):
+      if arrays.getNumberOfEnsembles() == 0:
+         return
+      columns = self._getColumns(arrays)
+      if self._writer is None:
+         self._open(arrays, columns)
+      table = pa.Table.from_arrays(list(columns.values()), schema=self.schema)
+      if self.arrow:
+         self._writer.write_table(table)
+      else:
+         self._writer.write_table(table, row_group_size=len(table))
+
+   # Row groups are complete once written
+   def flush(self):
+      pass
+
+   def close(self):
+      if self._writer is not None:
+         self._writer.close()
+      if self._sink is not None:
+         self._sink.close()
+
+# Return the binary writer for <filename> from its extension: HDF5/NetCDF,
+# Parquet or Arrow, NumPy (directory or .npz) otherwise
+def openBinaryWriter(filename, coordinates='BEAM'):
+   extension = os.path.splitext(filename)[1].lower()
+   if extension in HDF5EXTENSIONS:
+      return(WHHdf5Writer(filename, coordinates))
+   if extension in PARQUETEXTENSIONS + ARROWEXTENSIONS:
+      return(WHParquetWriter(filename, coordinates))
+   return(WHNpyWriter(filename, coordinates))
+
+#----------------------------------------
+#---  Class segmented binary export   ---
+#----------------------------------------
+# Binary export of ensembles whose configuration changes (number of cells,
+# of beams or cell length, see getConfigurationSegments): each segment is
+# written by its own binary writer (see openBinaryWriter), with the fixed
+# shape and the metadata of the segment. The first segment is written in
+# <filename>, the next ones in <filename> with the number of the segment
+# before the extension (export.nc, export-2.nc, ...).
+class WHSegmentedWriter():
+   def __init__(self, filename, coordinates='BEAM'):
+      self.filename = filename
+      self.coordinates = coordinates
+      self.filenames = [filename]
+      self.configuration = None # configuration of the current segment
+      self._writer = openBinaryWriter(filename, coordinates)
+
+   # Append the ensembles of <arrays> (WHEnsembleArrays)
+   def writeArrays(self, arrays):
+      for segment in getConfigurationSegments(arrays.fixedLeader):
+         self._writeSegment(arrays.getEnsembles(segment))
+
+   def _writeSegment(self, arrays):
+      configuration = arrays.getConfiguration()
+      if self.configuration != None and configuration != self.configuration:
+         self._writer.close()
+         root, extension = os.path.splitext(self.filename)
+         self.filenames.append('{}-{}{}'.format(root, len(self.filenames)+1, extension))
+         self._writer = openBinaryWriter(self.filenames[-1], self.coordinates)
+      self.configuration = configuration
+      self._writer.writeArrays(arrays)
+
+   def flush(self):
+      self._writer.flush()
+
+   def close(self):
+      self._writer.close()
@@ -2,10 +2,13 @@
 #-*- coding: utf-8 -*-
 
 import struct as st
+import collections
 import datetime
 import numpy as np
 import math
 
+from utils.pyAnalysisClass import *
+
 # header IDs
 PD0HEADERID=0x7f7f
 FIXEDLEADER=0x0000
@@ -21,10 +24,22 @@ WAVEPARAMETERSID=0x000B
 WAVEPARAMETERSID=0x000C
 MICROCAT=0x0800
 
+# Profile data types selectable for output
+DATATYPES = {
+      'VEL'  : VELOCITYPROFILE,
+      'CORR' : CORRELATIONPROFILE,
+      'INT'  : INTENSITYPROFILE,
+      'PG'   : PERCENTGOODPROFILE,
+      }
+
 # Constante value definition
 BADVALUE=-9999
 BADVELOCITY=-32768
 USESINTERNALSENSORS = 15 
+# Number of distinct fixed leaders kept decoded by WHFixedLeaderCache
+FIXEDLEADERCACHESIZE = 64
+# Number of configuration changes detailed by WHFixedLeaderCache.printReport
+MAXREPORTEDCHANGES = 100
 
 # Coordinate system
 COORDSYSTEM = {
@@ -38,6 +53,124 @@ COORDSYSTEM = {
       31 : 'Unknown', 
       }
 
+# Conversion tables of the 256 values of the one byte profile fields
+# Conversion of the stored intensity internal value to dB 
+# K is a factor dependant on electronic component, it is estimated by ration of a
+# scale factor given by RDI (0.45 dB) and temperature, here fixed at 10°c (for convenience)
+INTENSITYSCALE = 0.045  # 0.45 / 10.0
+INTENSITYDB = np.array([10 * np.log10(10**(INTENSITYSCALE*x/10)) for x in range(256)])
+# Text of the values as written in the output files (with the separator)
+INTENSITYTEXT = np.array(['{:.2f},'.format(x) for x in INTENSITYDB], dtype=object)
+CORRELATIONTEXT = np.array(['{:.2f},'.format(x) for x in range(256)], dtype=object)
+PERCENTGOODTEXT = np.array(['{:3.1f},'.format(x) for x in np.arange(256, dtype=np.uint8).view(np.int8).tolist()], dtype=object)
+
+# Binary layout of the fixed leader, decoded by WHFixedLeader.readWHFixedLeader
+FIXEDLEADERDTYPE = np.dtype([
+      ('FixedLeaderID','<u2'),
+      ('CPUVersion','u1'),
+      ('CPURevision','u1'),
+      ('SystemConfiguration','<u2'),
+      ('SystemFlag','u1'),
+      ('LagLength','u1'),
+      ('NumberOfBeams','u1'),
+      ('NumberOfCells','u1'),
+      ('PingsPerEnsemble','<u2'),
+      ('DepthCellLength','<i2'),
+      ('BlanckAfterTransmit','<u2'),
+      ('SignalProcessingMode','u1'),
+      ('LowCorrThreshold','u1'),
+      ('NumbersCodeRepetition','u1'),
+      ('PercentMinimumGood','u1'),
+      ('ErrorVelocityThreshold','<u2'),
+      ('Minutes','u1'),
+      ('Seconds','u1'),
+      ('Hundreds','u1'),
+      ('CoordinatesTransformation','u1'),
+      ('HeadingAlignement','<i2'),
+      ('HeadingBias','<i2'),
+      ('SensorSource','u1'),
+      ('SensorAvailable','u1'),
+      ('Bin1Distance','<i2'),
+      ('XmitPulseLength','<u2'),
+      ('StartEndDepthCell','<u2'),
+      ('FalseTargetThreshold','u1'),
+      ('Spare1','u1'),
+      ('TransmitLagDistance','<u2'),
+      ('CPUBoardSerialNumber','<u2'),
+      ('SystemBandwidth','<u2'),
+      ('SystemPower','u1'),
+      ('Spare2','u1'),
+      ('InstrumentSerialNumber','<u2'),
+      ('BeamAngle','u1'),])
+
+# Binary layout of the variable leader, decoded by WHVariableLeader.readWHVariableLeader
+VARIABLELEADERDTYPE = np.dtype([
+      ('VariableLeaderID','<u2'),
+      ('EnsembleNumber','<u2'),
+      ('RTCYear','u1'),
+      ('RTCMonth','u1'),
+      ('RTCDay','u1'),
+      ('RTCHour','u1'),
+      ('RTCMinute','u1'),
+      ('RTCSecond','u1'),
+      ('RTCHundreds','u1'),
+      ('EnsembleMSB','u1'),
+      ('BitResult','<u2'),
+      ('SpeedOfSound','<i2'),
+      ('DepthOfTransducer','<i2'),
+      ('Heading','<u2'),
+      ('Pitch','<i2'),
+      ('Roll','<i2'),
+      ('Salinity','<i2'),
+      ('Temperature','<i2'),
+      ('MPTMinute','u1'),
+      ('MPTSecond','u1'),
+      ('MPTHundreds','u1'),
+      ('HeadingStdev','u1'),
+      ('PithStdev','u1'),
+      ('RollStdev','u1'),
+      ('ADCChannel0','u1'),
+      ('ADCChannel1','u1'),
+      ('ADCChannel2','u1'),
+      ('ADCChannel3','u1'),
+      ('ADCChannel4','u1'),
+      ('ADCChannel5','u1'),
+      ('ADCChannel6','u1'),
+      ('ADCChannel7','u1'),
+      ('ErrorStatus','<u4'),
+      ('Reserved','<u2'),
+      ('Pressure','<u4'),
+      ('PressureVariance','<u4'),
+      ('Spare','u1'),
+      ('Y2KRTCentury','u1'),
+      ('Y2KRTCYear','u1'),
+      ('Y2KRTCMonth','u1'),
+      ('Y2KRTCDay','u1'),
+      ('Y2KRTCHour','u1'),
+      ('Y2KRTCMinute','u1'),
+      ('Y2KRTCSecond','u1'),
+      ('Y2KRTCHundreds','u1'),])
+
+# Leaders are unpacked at once by a precompiled structure into a record
+# (namedtuple) of the decoded fields, read by attribute
+def _getLeaderStruct(dtype):
+   return(st.Struct('<' + ''.join(dtype[name].char for name in dtype.names)))
+
+FIXEDLEADERSTRUCT = _getLeaderStruct(FIXEDLEADERDTYPE)
+VARIABLELEADERSTRUCT = _getLeaderStruct(VARIABLELEADERDTYPE)
+WHFixedLeaderRecord = collections.namedtuple('WHFixedLeaderRecord', FIXEDLEADERDTYPE.names)
+WHVariableLeaderRecord = collections.namedtuple('WHVariableLeaderRecord', VARIABLELEADERDTYPE.names)
+
+# Return the first and last (excluded) cells of the range <cells> (slice,
+# default: all the cells) among <nbCells> cells
+def getCellRange(cells, nbCells):
+   if cells is None:
+      return(0, nbCells)
+   first, last, step = cells.indices(nbCells)
+   if step != 1:
+      raise ValueError('Cell range must be contiguous ({})'.format(cells))
+   return(first, max(first, last))
+
 # convenience function reused for header, length, and checksum
 def __nextLittleEndianUnsignedShort(file):
    """Get next little endian unsigned short from file"""
@@ -99,43 +232,8 @@ class WHHeader():
 class WHFixedLeader():
    def __init__(self):
       self._rawdata = ''
-      self.whFixedLeader = {
-      'FixedLeaderID':'',
-      'CPUVersion':'',
-      'CPURevision':'',
-      'SystemConfiguration':'',
-      'SystemFlag':'',
-      'LagLength':'',
-      'NumberOfBeams':'',
-      'NumberOfCells':'',
-      'PingsPerEnsemble':'',
-      'DepthCellLength':'',
-      'BlanckAfterTransmit':'',
-      'SignalProcessingMode':'',
-      'LowCorrThreshold':'',
-      'NumbersCodeRepetition':'',
-      'PercentMinimumGood':'',
-      'ErrorVelocityThreshold':'',
-      'Minutes':'',
-      'Seconds':'',
-      'Hundreds':'',
-      'CoordinatesTransformation':'',
-      'HeadingAlignement':'',
-      'HeadingBias':'',
-      'SensorSource':'',
-      'SensorAvailable':'',
-      'Bin1Distance':'',
-      'XmitPulseLength':'',
-      'StartEndDepthCell':'',
-      'FalseTargetThreshold':'',
-      'Spare1':'',
-      'TransmitLagDistance':'',
-      'CPUBoardSerialNumber':'',
-      'SystemBandwidth':'',
-      'SystemPower':'',
-      'Spare2':'',
-      'InstrumentSerialNumber':'',
-      'BeamAngle':'',}
+      self.whFixedLeader = WHFixedLeaderRecord._make([0]*len(WHFixedLeaderRecord._fields))
+      self._beamConstants = None
    
    # Return raw data ensemble
    def getRawEnsemble(self):
@@ -143,113 +241,45 @@ class WHFixedLeader():
 
    def readWHFixedLeader(self, index, rawEnsemble):
       self._rawdata = rawEnsemble
-      cpt = index
-      self.whFixedLeader['FixedLeaderID']=rawEnsemble[cpt:cpt+2]
-      cpt = cpt + 2
-      self.whFixedLeader['CPUVersion']=rawEnsemble[cpt:cpt+1]
-      cpt = cpt + 1
-      self.whFixedLeader['CPURevision']=rawEnsemble[cpt:cpt+1]
-      cpt = cpt + 1
-      self.whFixedLeader['SystemConfiguration']=rawEnsemble[cpt:cpt+2]
-      cpt = cpt + 2
-      self.whFixedLeader['SystemFlag']=rawEnsemble[cpt:cpt+1]
-      cpt = cpt + 1
-      self.whFixedLeader['LagLength']=rawEnsemble[cpt:cpt+1]
-      cpt = cpt + 1
-      self.whFixedLeader['NumberOfBeams']=rawEnsemble[cpt:cpt+1]
-      cpt = cpt + 1
-      self.whFixedLeader['NumberOfCells']=rawEnsemble[cpt:cpt+1]
-      cpt = cpt + 1
-      self.whFixedLeader['PingsPerEnsemble']=rawEnsemble[cpt:cpt+2]
-      cpt = cpt + 2
-      self.whFixedLeader['DepthCellLength']=rawEnsemble[cpt:cpt+2]
-      cpt = cpt + 2
-      self.whFixedLeader['BlanckAfterTransmit']=rawEnsemble[cpt:cpt+2]
-      cpt = cpt + 2
-      self.whFixedLeader['SignalProcessingMode']=rawEnsemble[cpt:cpt+1]
-      cpt = cpt + 1
-      self.whFixedLeader['LowCorrThreshold']=rawEnsemble[cpt:cpt+1]
-      cpt = cpt + 1
-      self.whFixedLeader['NumbersCodeRepetition']=rawEnsemble[cpt:cpt+1]
-      cpt = cpt + 1
-      self.whFixedLeader['PercentMinimumGood']=rawEnsemble[cpt:cpt+1]
-      cpt = cpt + 1
-      self.whFixedLeader['ErrorVelocityThreshold']=rawEnsemble[cpt:cpt+2]
-      cpt = cpt + 2
-      self.whFixedLeader['Minutes']=rawEnsemble[cpt:cpt+1]
-      cpt = cpt + 1
-      self.whFixedLeader['Seconds']=rawEnsemble[cpt:cpt+1]
-      cpt = cpt + 1
-      self.whFixedLeader['Hundreds']=rawEnsemble[cpt:cpt+1]
-      cpt = cpt + 1
-      self.whFixedLeader['CoordinatesTransformation']=rawEnsemble[cpt:cpt+1]
-      cpt = cpt + 1
-      self.whFixedLeader['HeadingAlignement']=rawEnsemble[cpt:cpt+2]
-      cpt = cpt + 2
-      self.whFixedLeader['HeadingBias']=rawEnsemble[cpt:cpt+2]
-      cpt = cpt + 2
-      self.whFixedLeader['SensorSource']=rawEnsemble[cpt:cpt+1]
-      cpt = cpt + 1
-      self.whFixedLeader['SensorAvailable']=rawEnsemble[cpt:cpt+1]
-      cpt = cpt + 1
-      self.whFixedLeader['Bin1Distance']=rawEnsemble[cpt:cpt+2]
-      cpt = cpt + 2
-      self.whFixedLeader['XmitPulseLength']=rawEnsemble[cpt:cpt+2]
-      cpt = cpt + 2
-      self.whFixedLeader['StartEndDepthCell']=rawEnsemble[cpt:cpt+2]
-      cpt = cpt + 2
-      self.whFixedLeader['FalseTargetThreshold']=rawEnsemble[cpt:cpt+1]
-      cpt = cpt + 1
-      self.whFixedLeader['Spare1']=rawEnsemble[cpt:cpt+1]
-      cpt = cpt + 1
-      self.whFixedLeader['TransmitLagDistance']=rawEnsemble[cpt:cpt+2]
-      cpt = cpt + 2
-      self.whFixedLeader['CPUBoardSerialNumber']=rawEnsemble[cpt:cpt+2]
-      cpt = cpt + 2
-      self.whFixedLeader['SystemBandwidth']=rawEnsemble[cpt:cpt+2]
-      cpt = cpt + 2
-      self.whFixedLeader['SystemPower']=rawEnsemble[cpt:cpt+1]
-      cpt = cpt + 1
-      self.whFixedLeader['Spare2']=rawEnsemble[cpt:cpt+1]
-      cpt = cpt + 1
-      self.whFixedLeader['InstrumentSerialNumber']=rawEnsemble[cpt:cpt+2]
-      cpt = cpt + 2
-      self.whFixedLeader['BeamAngle']=rawEnsemble[cpt:cpt+1]
-      cpt = cpt + 1
-      return(cpt)
+      try:
+         self.whFixedLeader = WHFixedLeaderRecord._make(FIXEDLEADERSTRUCT.unpack_from(rawEnsemble, index))
+      except st.error:
+         raise IOError('Truncated fixed leader.')
+      self._beamConstants = None
+      return(index + FIXEDLEADERSTRUCT.size)
   
    def getNumberOfCells(self):
-      return(st.unpack('B',self.whFixedLeader['NumberOfCells'])[0])
+      return(self.whFixedLeader.NumberOfCells)
 
    def getNumberOfBeams(self):
-      return(st.unpack('B',self.whFixedLeader['NumberOfBeams'])[0])
+      return(self.whFixedLeader.NumberOfBeams)
 
    def getUseDepthSensor(self):
-      theByte = st.unpack('B',self.whFixedLeader['SensorSource'])[0]
+      theByte = self.whFixedLeader.SensorSource
       return(self.check_bitL2R(theByte, 5))
 
    def getUsePitchSensor(self):
-      theByte = st.unpack('B',self.whFixedLeader['SensorSource'])[0]
+      theByte = self.whFixedLeader.SensorSource
       return(self.check_bitL2R(theByte, 3))
 
    def getCorrelationThrehold(self):
-      return(st.unpack('B',self.whFixedLeader['LowCorrThreshold'])[0])
+      return(self.whFixedLeader.LowCorrThreshold)
 
    def computedSpeedOfSound(self):
-      theByte = st.unpack('B',self.whFixedLeader['SensorSource'])[0]
+      theByte = self.whFixedLeader.SensorSource
       return(self.check_bitL2R(theByte, 6))
 
    def getVerticalSize(self):
-      return(st.unpack('h',self.whFixedLeader['DepthCellLength'])[0]*0.01) # in meter
+      return(self.whFixedLeader.DepthCellLength*0.01) # in meter
 
    def getDis1(self):
-      return(st.unpack('h',self.whFixedLeader['Bin1Distance'])[0]*0.01) # in meter
+      return(self.whFixedLeader.Bin1Distance*0.01) # in meter
 
    def check_bitL2R(self, byte, bit):
       return bool(byte & (0b10000000>>bit))
 
    def getRDIType(self):
-      theByte = st.unpack('B',self.whFixedLeader['SystemConfiguration'][1])[0]
+      theByte = self.whFixedLeader.SystemConfiguration >> 8
       if theByte & 0b000:
          return('75-kHz SYSTEM')
       elif theByte & 0b001:
@@ -266,7 +296,7 @@ class WHFixedLeader():
          return('Not used')
 
    def getBeamAngle(self):
-      theByte = st.unpack('B',self.whFixedLeader['SystemConfiguration'][0])[0]
+      theByte = self.whFixedLeader.SystemConfiguration & 0xff
       if theByte & 0b00:
          return(15)
       elif theByte & 0b01:
@@ -276,10 +306,10 @@ class WHFixedLeader():
       elif theByte & 0b111:
          return(25)
       else:
-         return(st.unpack('B',self.whFixedLeader['BeamAngle'])[0])
+         return(self.whFixedLeader.BeamAngle)
             
    def getConcaveOrConvex(self):
-      theByte = st.unpack('B',self.whFixedLeader['SystemConfiguration'][1])[0]
+      theByte = self.whFixedLeader.SystemConfiguration >> 8
       if self.check_bitL2R(theByte, 3):
          return(1) # Convex
       else:
@@ -287,39 +317,52 @@ class WHFixedLeader():
 
    # return correction angle based on beam facing sens (up or down)
    def getFacingBeam(self):
-      theByte = st.unpack('B',self.whFixedLeader['SystemConfiguration'][1])[0]
+      theByte = self.whFixedLeader.SystemConfiguration >> 8
       if self.check_bitL2R(theByte, 7):
          return(180) # up ward
       else:
          return(0) # down ward
 
+   # Return the transformation constants a, b, c, d of the beams (see
+   # getBeamConstants), computed once for this fixed leader
+   def getBeamConstants(self):
+      if self._beamConstants is None:
+         self._beamConstants = getBeamConstants([self.getBeamAngle()], self.getConcaveOrConvex())
+      return(self._beamConstants)
+
    def getHeadingAlignment(self):
-      return(st.unpack('h',self.whFixedLeader['HeadingAlignement'])[0]*0.01)
+      return(self.whFixedLeader.HeadingAlignement*0.01)
 
    def getHeadingBias(self):
-      return(st.unpack('h',self.whFixedLeader['HeadingBias'])[0]*0.01)
+      return(self.whFixedLeader.HeadingBias*0.01)
 
    def getCoordinateTransformation(self):
-      cs = st.unpack('B', self.whFixedLeader['CoordinatesTransformation'])[0]
+      cs = self.whFixedLeader.CoordinatesTransformation
       return(COORDSYSTEM[cs])
       
-   def write(self):
+   # <nbCells>: number of cells written (default: all)
+   def write(self, nbCells=None):
+      if nbCells == None:
+         nbCells = self.getNumberOfCells()
       return('{:d},{:d},{:d},{}'.format( \
                       self.getNumberOfBeams(), \
-                      self.getNumberOfCells(), \
-                      st.unpack('H',self.whFixedLeader['PingsPerEnsemble'])[0], \
+                      nbCells, \
+                      self.whFixedLeader.PingsPerEnsemble, \
                       self.getCoordinateTransformation()
                       ))
 
-   #TODO: deal here to save in numpy format
-   def writeBin(self):
-      return([self.whFixedLeader['NumberOfBeams'],
-              self.whFixedLeader['NumberOfCells'],
-              self.whFixedLeader['PingsPerEnsemble'],
-              self.whFixedLeader['CoordinatesTransformation']])
+   # Return the description of the configuration (beams and cells)
+   def writeConfiguration(self):
+      return('{:d} beams, {:d} cells of {:.2f} m, first at {:.2f} m, {}'.format( \
+                      self.getNumberOfBeams(), \
+                      self.getNumberOfCells(), \
+                      self.getVerticalSize(), \
+                      self.getDis1(), \
+                      self.getCoordinateTransformation()
+                      ))
 
    def printInfo(self):
-      print("Id: {}".format(st.unpack('H',self.whFixedLeader['FixedLeaderID'])[0]))
+      print("Id: {}".format(self.whFixedLeader.FixedLeaderID))
       print("Nb cells: {}".format(self.getNumberOfCells()))
       print("Nb beams: {}".format(self.getNumberOfBeams()))
       print("Coord. Syst.: {}".format(self.getCoordinateTransformation()))
@@ -327,6 +370,73 @@ class WHFixedLeader():
    def getType(self):
       return(FIXEDLEADER)
       
+#----------------------------------------
+#---   Cache of the fixed leaders     ---
+#----------------------------------------
+# The fixed leader (configuration of the instrument) is the same for all
+# the ensembles of a deployment: it is decoded once per distinct raw fixed
+# leader and the WHFixedLeader, with its derived constants, is shared by
+# the ensembles read through the cache (see readEnsemble). A fixed leader
+# different from the one of the previous ensemble checked is recorded as
+# a configuration change.
+class WHFixedLeaderCache():
+   def __init__(self, maxSize=FIXEDLEADERCACHESIZE):
+      self.maxSize = maxSize
+      self._fixedLeaders = {}  # raw fixed leader -> WHFixedLeader
+      self._current = None     # fixed leader of the previous ensemble checked
+      self.changes = []        # (ensemble number, previous, new fixed leader)
+
+   # Return the fixed leader starting at <index> in <rawEnsemble>
+   def getFixedLeader(self, index, rawEnsemble):
+      key = bytes(rawEnsemble[index:index+FIXEDLEADERSTRUCT.size])
+      fh = self._fixedLeaders.get(key)
+      if fh is None:
+         # Read from the key, the shared fixed leader does not keep the ensemble
+         fh = WHFixedLeader()
+         fh.readWHFixedLeader(0, key)
+         if len(self._fixedLeaders) >= self.maxSize:
+            self._fixedLeaders.clear()
+         self._fixedLeaders[key] = fh
+      return(fh)
+
+   # Record a configuration change if the fixed leader of the ensemble <re>
+   # (readEnsemble, leaders decoded) differs from the previous one checked,
+   # return True on a change
+   def checkConfiguration(self, re):
+      changed = self._current is not None and re.fh.getRawEnsemble() != self._current.getRawEnsemble()
+      if changed:
+         self.changes.append((re.vh.getElementNumber(), self._current, re.fh))
+      self._current = re.fh
+      return(changed)
+
+   # Record the configuration changes of the ensembles of <arrays>
+   # (WHEnsembleArrays, leaders decoded), return the positions of the
+   # ensembles changing the configuration
+   def checkConfigurationArrays(self, arrays):
+      positions = []
+      fixedLeader = arrays.fixedLeader
+      if len(fixedLeader) == 0:
+         return(positions)
+      numbers = arrays.getElementNumber()
+      # Only the first ensemble and the ones differing from the previous are checked
+      candidates = np.concatenate([[0], np.flatnonzero(fixedLeader[1:] != fixedLeader[:-1]) + 1])
+      for position in candidates:
+         # The fixed leader record is the raw fixed leader
+         fh = self.getFixedLeader(0, fixedLeader[position].tobytes())
+         if self._current is not None and fh.getRawEnsemble() != self._current.getRawEnsemble():
+            self.changes.append((int(numbers[position]), self._current, fh))
+            positions.append(int(position))
+         self._current = fh
+      return(positions)
+      
+   def printReport(self):
+      if len(self.changes) > 0:
+         print('Configuration changes: {}'.format(len(self.changes)))
+         for number, previous, fh in self.changes[:MAXREPORTEDCHANGES]:
+            print('\tEnsemble:{}\t{} -> {}'.format(number, previous.writeConfiguration(), fh.writeConfiguration()))
+         if len(self.changes) > MAXREPORTEDCHANGES:
+            print('\t...')
+
 #----------------------------------------
 #--- Class variable leader  data      ---
 #----------------------------------------
@@ -334,217 +444,94 @@ class WHVariableLeader():
    def __init__(self):
             # Return raw data ensemble
       self._rawdata = ''
-      self.whVariableLeader = {
-      'VariableLeaderID':'',
-      'EnsembleNumber':'',
-      'RTCYear':'',
-      'RTCMonth':'',
-      'RTCDay':'',
-      'RTCHour':'',
-      'RTCMinute':'',
-      'RTCSecond':'',
-      'RTCHundreds':'',
-      'EnsembleMSB':'',
-      'BitResult':'',
-      'SpeedOfSound':'',
-      'DepthOfTransducer':'',
-      'Heading':'',
-      'Pitch':'',
-      'Roll':'',
-      'Salinity':'',
-      'Temperature':'',
-      'MPTMinute':'',
-      'MPTSecond':'',
-      'MPTHundreds':'',
-      'HeadingStdev':'',
-      'PithStdev':'',
-      'RollStdev':'',
-      'ADCChannel0':'',
-      'ADCChannel1':'',
-      'ADCChannel2':'',
-      'ADCChannel3':'',
-      'ADCChannel4':'',
-      'ADCChannel5':'',
-      'ADCChannel6':'',
-      'ADCChannel7':'',
-      'ErrorStatus':'',
-      'Reserved':'',
-      'Pressure':'',
-      'PressureVariance':'',
-      'Spare':'',
-      'Y2KRTCentury':'',
-      'Y2KRTCYear':'',
-      'Y2KRTCMonth':'',
-      'Y2KRTCDay':'',
-      'Y2KRTCHour':'',
-      'Y2KRTCMinute':'',
-      'Y2KRTCSecond':'',
-      'Y2KRTCHundreds':'',}
+      self.whVariableLeader = WHVariableLeaderRecord._make([0]*len(WHVariableLeaderRecord._fields))
       
    def readWHVariableLeader(self, index, rawEnsemble):
       self._rawdata = rawEnsemble
-      cpt = index
-      self.whVariableLeader['VariableLeaderID']=rawEnsemble[cpt:cpt+2]
-      cpt = cpt + 2
-      self.whVariableLeader['EnsembleNumber']=rawEnsemble[cpt:cpt+2]
-      cpt = cpt + 2
-      self.whVariableLeader['RTCYear']=rawEnsemble[cpt:cpt+1]
-      cpt = cpt + 1
-      self.whVariableLeader['RTCMonth']=rawEnsemble[cpt:cpt+1]
-      cpt = cpt + 1
-      self.whVariableLeader['RTCDay']=rawEnsemble[cpt:cpt+1]
-      cpt = cpt + 1
-      self.whVariableLeader['RTCHour']=rawEnsemble[cpt:cpt+1]
-      cpt = cpt + 1
-      self.whVariableLeader['RTCMinute']=rawEnsemble[cpt:cpt+1]
-      cpt = cpt + 1
-      self.whVariableLeader['RTCSecond']=rawEnsemble[cpt:cpt+1]
-      cpt = cpt + 1
-      self.whVariableLeader['RTCHundreds']=rawEnsemble[cpt:cpt+1]
-      cpt = cpt + 1
-      self.whVariableLeader['EnsembleMSB']=rawEnsemble[cpt:cpt+1]
-      cpt = cpt + 1
-      self.whVariableLeader['BitResult']=rawEnsemble[cpt:cpt+2]
-      cpt = cpt + 2
-      self.whVariableLeader['SpeedOfSound']=rawEnsemble[cpt:cpt+2]
-      cpt = cpt + 2
-      self.whVariableLeader['DepthOfTransducer']=rawEnsemble[cpt:cpt+2]
-      cpt = cpt + 2
-      self.whVariableLeader['Heading']=rawEnsemble[cpt:cpt+2]
-      cpt = cpt + 2
-      self.whVariableLeader['Pitch']=rawEnsemble[cpt:cpt+2]
-      cpt = cpt + 2
-      self.whVariableLeader['Roll']=rawEnsemble[cpt:cpt+2]
-      cpt = cpt + 2
-      self.whVariableLeader['Salinity']=rawEnsemble[cpt:cpt+2]
-      cpt = cpt + 2
-      self.whVariableLeader['Temperature']=rawEnsemble[cpt:cpt+2]
-      cpt = cpt + 2
-      self.whVariableLeader['MPTMinute']=rawEnsemble[cpt:cpt+1]
-      cpt = cpt + 1
-      self.whVariableLeader['MPTSecond']=rawEnsemble[cpt:cpt+1]
-      cpt = cpt + 1
-      self.whVariableLeader['MPTHundreds']=rawEnsemble[cpt:cpt+1]
-      cpt = cpt + 1
-      self.whVariableLeader['HeadingStdev']=rawEnsemble[cpt:cpt+1]
-      cpt = cpt + 1
-      self.whVariableLeader['PithStdev']=rawEnsemble[cpt:cpt+1]
-      cpt = cpt + 1
-      self.whVariableLeader['RollStdev']=rawEnsemble[cpt:cpt+1]
-      cpt = cpt + 1
-      self.whVariableLeader['ADCChannel0']=rawEnsemble[cpt:cpt+1]
-      cpt = cpt + 1
-      self.whVariableLeader['ADCChannel1']=rawEnsemble[cpt:cpt+1]
-      cpt = cpt + 1
-      self.whVariableLeader['ADCChannel2']=rawEnsemble[cpt:cpt+1]
-      cpt = cpt + 1
-      self.whVariableLeader['ADCChannel3']=rawEnsemble[cpt:cpt+1]
-      cpt = cpt + 1
-      self.whVariableLeader['ADCChannel4']=rawEnsemble[cpt:cpt+1]
-      cpt = cpt + 1
-      self.whVariableLeader['ADCChannel5']=rawEnsemble[cpt:cpt+1]
-      cpt = cpt + 1
-      self.whVariableLeader['ADCChannel6']=rawEnsemble[cpt:cpt+1]
-      cpt = cpt + 1
-      self.whVariableLeader['ADCChannel7']=rawEnsemble[cpt:cpt+1]
-      cpt = cpt + 1
-      self.whVariableLeader['ErrorStatus']=rawEnsemble[cpt:cpt+4]
-      cpt = cpt + 4
-      self.whVariableLeader['Reserved']=rawEnsemble[cpt:cpt+2]
-      cpt = cpt + 2
-      self.whVariableLeader['Pressure']=rawEnsemble[cpt:cpt+4]
-      cpt = cpt + 4
-      self.whVariableLeader['PressureVariance']=rawEnsemble[cpt:cpt+4]
-      cpt = cpt + 4
-      self.whVariableLeader['Spare']=rawEnsemble[cpt:cpt+1]
-      cpt = cpt + 1
-      self.whVariableLeader['Y2KRTCentury']=rawEnsemble[cpt:cpt+1]
-      cpt = cpt + 1
-      self.whVariableLeader['Y2KRTCYear']=rawEnsemble[cpt:cpt+1]
-      cpt = cpt + 1
-      self.whVariableLeader['Y2KRTCMonth']=rawEnsemble[cpt:cpt+1]
-      cpt = cpt + 1
-      self.whVariableLeader['Y2KRTCDay']=rawEnsemble[cpt:cpt+1]
-      cpt = cpt + 1
-      self.whVariableLeader['Y2KRTCHour']=rawEnsemble[cpt:cpt+1]
-      cpt = cpt + 1
-      self.whVariableLeader['Y2KRTCMinute']=rawEnsemble[cpt:cpt+1]
-      cpt = cpt + 1
-      self.whVariableLeader['Y2KRTCSecond']=rawEnsemble[cpt:cpt+1]
-      cpt = cpt + 1
-      self.whVariableLeader['Y2KRTCHundreds']=rawEnsemble[cpt:cpt+1]
-      cpt = cpt + 1
-      return(cpt)
+      try:
+         self.whVariableLeader = WHVariableLeaderRecord._make(VARIABLELEADERSTRUCT.unpack_from(rawEnsemble, index))
+      except st.error:
+         raise IOError('Truncated variable leader.')
+      return(index + VARIABLELEADERSTRUCT.size)
    
    # Return raw data ensemble
    def getRawEnsemble(self):
       return(self._rawdata)
 
    def getElementNumber(self):
-      enb = st.unpack('H',self.whVariableLeader['EnsembleNumber'])[0]
-      msb = st.unpack('B',self.whVariableLeader['EnsembleMSB'])[0]
+      enb = self.whVariableLeader.EnsembleNumber
+      msb = self.whVariableLeader.EnsembleMSB
       return ((65535 * msb) + enb)
 
    def getHeading(self):
-      return(st.unpack('H',self.whVariableLeader['Heading'])[0]*0.01)
+      return(self.whVariableLeader.Heading*0.01)
 
    def getPitch(self):
-      return(st.unpack('h',self.whVariableLeader['Pitch'])[0]*0.01)
+      return(self.whVariableLeader.Pitch*0.01)
 
    def getRoll(self):
-      return(st.unpack('h',self.whVariableLeader['Roll'])[0]*0.01)
+      return(self.whVariableLeader.Roll*0.01)
 
    def getTemperature(self):
-      return(st.unpack('h',self.whVariableLeader['Temperature'])[0]*0.01)
+      return(self.whVariableLeader.Temperature*0.01)
 
    def getDepthSensor(self):
       # Depth is store in decimeter, it is output in meter here
-      return(st.unpack('h',self.whVariableLeader['DepthOfTransducer'])[0]*0.1)
+      return(self.whVariableLeader.DepthOfTransducer*0.1)
 
    def getSpeedOfSound(self):
-      return(st.unpack('h',self.whVariableLeader['SpeedOfSound'])[0])
+      return(self.whVariableLeader.SpeedOfSound)
 
    def getSalinity(self):
-      return(st.unpack('h',self.whVariableLeader['Salinity'])[0])
+      return(self.whVariableLeader.Salinity)
 
    def getStartTime(self):
-      hour = st.unpack('B',self.whVariableLeader['RTCHour'])[0]
-      minute = st.unpack('B',self.whVariableLeader['RTCMinute'])[0]
-      second = st.unpack('B',self.whVariableLeader['RTCSecond'])[0]
-      sdec = st.unpack('B',self.whVariableLeader['RTCHundreds'])[0]
+      hour = self.whVariableLeader.RTCHour
+      minute = self.whVariableLeader.RTCMinute
+      second = self.whVariableLeader.RTCSecond
+      sdec = self.whVariableLeader.RTCHundreds
       return('{:02d}:{:02d}:{:02d}.{:02d}'.format(hour,minute,second,sdec))
       
    def getTime(self):
-      hour = st.unpack('B',self.whVariableLeader['Y2KRTCHour'])[0]
-      minute = st.unpack('B',self.whVariableLeader['Y2KRTCMinute'])[0]
-      second = st.unpack('B',self.whVariableLeader['Y2KRTCSecond'])[0]
-      sdec = st.unpack('B',self.whVariableLeader['Y2KRTCHundreds'])[0]
+      hour = self.whVariableLeader.Y2KRTCHour
+      minute = self.whVariableLeader.Y2KRTCMinute
+      second = self.whVariableLeader.Y2KRTCSecond
+      sdec = self.whVariableLeader.Y2KRTCHundreds
       return('{:02d}:{:02d}:{:02d}.{:02d}'.format(hour,minute,second,sdec))
    
    def getStartDate(self):
-      year = st.unpack('B',self.whVariableLeader['RTCYear'])[0]
-      month = st.unpack('B',self.whVariableLeader['RTCMonth'])[0]
-      day = st.unpack('B',self.whVariableLeader['RTCDay'])[0]
+      year = self.whVariableLeader.RTCYear
+      month = self.whVariableLeader.RTCMonth
+      day = self.whVariableLeader.RTCDay
       return('{:02d}-{:02d}-{:02d}'.format(year,month,day))
          
    def getDate(self):
-      year = st.unpack('B',self.whVariableLeader['Y2KRTCYear'])[0]
-      month = st.unpack('B',self.whVariableLeader['Y2KRTCMonth'])[0]
-      day = st.unpack('B',self.whVariableLeader['Y2KRTCDay'])[0]
+      year = self.whVariableLeader.Y2KRTCYear
+      month = self.whVariableLeader.Y2KRTCMonth
+      day = self.whVariableLeader.Y2KRTCDay
       return('{:02d}-{:02d}-{:02d}'.format(year,month,day))
    
+   # Start of the ensemble (RTC), two digits year as read by strptime('%y')
    def getStartDateTime(self):
-      try:
-         datetime_str = '{} {}'.format(self.getStartDate(), self.getStartTime())
-         return datetime.datetime.strptime(datetime_str, "%y-%m-%d %H:%M:%S.%f")
-      except ValueError:
-         msg = "Given Datetime ({0}) not valid! Expected format, 'yy-mm-dd hh:mm:ss.ss'!".format(datetime_str)
-         raise IOError(msg)
+      vl = self.whVariableLeader
+      year = -1
+      if vl.RTCYear <= 99:
+         year = vl.RTCYear + (2000 if vl.RTCYear < 69 else 1900)
+      return(self._getDateTime(year, vl.RTCMonth, vl.RTCDay, vl.RTCHour, vl.RTCMinute, vl.RTCSecond, vl.RTCHundreds,
+                               '{} {}'.format(self.getStartDate(), self.getStartTime())))
          
+   # Date and time of the ensemble from the Y2K RTC
    def getDateTime(self):
+      vl = self.whVariableLeader
+      return(self._getDateTime(vl.Y2KRTCentury*100 + vl.Y2KRTCYear, vl.Y2KRTCMonth, vl.Y2KRTCDay,
+                               vl.Y2KRTCHour, vl.Y2KRTCMinute, vl.Y2KRTCSecond, vl.Y2KRTCHundreds,
+                               '{} {}'.format(self.getDate(), self.getTime())))
+
+   def _getDateTime(self, year, month, day, hour, minute, second, hundredths, datetime_str):
       try:
-         datetime_str = '{} {}'.format(self.getDate(), self.getTime())
-         return datetime.datetime.strptime(datetime_str, "%y-%m-%d %H:%M:%S.%f")
+         if year < 1 or hundredths > 99:
+            raise ValueError(datetime_str)
+         return(datetime.datetime(year, month, day, hour, minute, second, hundredths*10000))
       except ValueError:
          msg = "Given Datetime ({0}) not valid! Expected format, 'yy-mm-dd hh:mm:ss.ss'!".format(datetime_str)
          raise IOError(msg)
@@ -556,36 +543,17 @@ class WHVariableLeader():
                       self.getHeading(), \
                       self.getPitch(), \
                       self.getRoll(), \
-                      st.unpack('h',self.whVariableLeader['Salinity'])[0], \
+                      self.whVariableLeader.Salinity, \
                       self.getTemperature(), \
-                      st.unpack('I',self.whVariableLeader['Pressure'])[0]))
-
-   # TODO: deal here to save in numpy format
-   def writeBin(self):
-         return([self.whVariableLeader['EnsembleNumber'],
-         self.whVariableLeader['EnsembleMSB'],
-         self.whVariableLeader['RTCYear'],
-         self.whVariableLeader['RTCMonth'],
-         self.whVariableLeader['RTCDay'],
-         self.whVariableLeader['Y2KRTCHour'],
-         self.whVariableLeader['Y2KRTCMinute'],
-         self.whVariableLeader['Y2KRTCSecond'],
-         self.whVariableLeader['Y2KRTCHundreds'],
-         self.whVariableLeader['Heading'],
-         self.whVariableLeader['Pitch'],
-         self.whVariableLeader['Roll'],
-         self.whVariableLeader['Salinity'],
-         self.whVariableLeader['Temperature'],
-         self.whVariableLeader['Pressure']]
-         )
+                      self.whVariableLeader.Pressure))
 
    def printInfo(self):
-      print("Id: {}".format(st.unpack('H',self.whVariableLeader['VariableLeaderID'])[0]))
+      print("Id: {}".format(self.whVariableLeader.VariableLeaderID))
       print("Num: {}".format(self.getElementNumber()))
       print("Heading: {:.1f}".format(self.getHeading()))
-      print("Salinity: {:.1f}".format(st.unpack('H',self.whVariableLeader['Salinity'])[0]))
+      print("Salinity: {:.1f}".format(self.whVariableLeader.Salinity))
       print("Temperature: {:.2f}".format(self.getTemperature()))
-      print("Sound speed: {}".format(st.unpack('H',self.whVariableLeader['SpeedOfSound'])[0]))
+      print("Sound speed: {}".format(self.whVariableLeader.SpeedOfSound))
       print(self.getStartDateTime())
 #      print(self.getDateTime())
 
@@ -606,12 +574,16 @@ class WHVelocity():
       'VEL3':[],
       'VEL4':[],}
       
-   def readWHVelocity(self, nbCell, index, rawEnsemble):
+   def readWHVelocity(self, nbCell, index, rawEnsemble, cells=None):
       self._rawdata = rawEnsemble
       cpt = index
       self.velocityID = rawEnsemble[cpt:cpt+2]
       cpt = cpt + 2
-      for i in range(nbCell):
+      # Only the cells of the range <cells> are read
+      first, last = getCellRange(cells, nbCell)
+      cpt = cpt + first*8
+      self._index = cpt
+      for i in range(first, last):
          self.cellVelocity['ID'].append(i+1)
          self.cellVelocity['VEL1'].append(rawEnsemble[cpt:cpt+2])
          cpt = cpt + 2
@@ -636,30 +608,15 @@ class WHVelocity():
       except:
          raise('An error occured getting velocity value')
 
+   # Return the raw velocities as an array [cell, beam]
+   def getVelocityArray(self):
+      nbCells = len(self.cellVelocity['ID'])
+      return(np.frombuffer(self._rawdata, dtype='<i2', count=nbCells*4, offset=self._index).reshape(nbCells,4))
+
    def write(self):
-      retValue=''
-      for i in range(len(self.cellVelocity['ID'])):
-         if self.getCellVelocity(1,i) != BADVELOCITY:
-            retValue = retValue + '{:.3f},'.format(self.getCellVelocity(1,i))
-         else:
-            retValue = retValue + "Nan,"
-         if self.getCellVelocity(2,i) != BADVELOCITY:
-            retValue = retValue + '{:.3f},'.format(self.getCellVelocity(2,i))
-         else:
-            retValue = retValue + "Nan,"
-         if self.getCellVelocity(3,i) != BADVELOCITY:
-            retValue = retValue + '{:.3f},'.format(self.getCellVelocity(3,i))
-         else:
-            retValue = retValue + "Nan,"
-         if self.getCellVelocity(4,i) != BADVELOCITY:
-            retValue = retValue + '{:.3f},'.format(self.getCellVelocity(4,i))
-         else:
-            retValue = retValue + "Nan,"
-      return(retValue)
+      vels = self.getVelocityArray()
+      return(''.join(['{:.3f},'.format(v*0.001) if v != BADVELOCITY else "Nan," for v in vels.ravel().tolist()]))
 
-   def writeBin(self):
-      return(self._rawdata)
-      
    def getType(self):
       return(VELOCITYPROFILE)
 
@@ -677,12 +634,16 @@ class WHCorrelation():
       'COR3':[],
       'COR4':[],}
       
-   def readWHCorrelation(self, nbCell, index, rawEnsemble):
+   def readWHCorrelation(self, nbCell, index, rawEnsemble, cells=None):
       self._rawdata = rawEnsemble
       cpt = index
       self.correlationID = rawEnsemble[cpt:cpt+2]
       cpt = cpt + 2
-      for i in range(nbCell):
+      # Only the cells of the range <cells> are read
+      first, last = getCellRange(cells, nbCell)
+      cpt = cpt + first*4
+      self._index = cpt
+      for i in range(first, last):
          self.cellCorrelation['ID'].append(i+1)
          self.cellCorrelation['COR1'].append(rawEnsemble[cpt:cpt+1])
          cpt = cpt + 1
@@ -704,19 +665,13 @@ class WHCorrelation():
               st.unpack('B',self.cellCorrelation['COR3'][numCell])[0],
               st.unpack('B',self.cellCorrelation['COR4'][numCell])[0]])
 
+   # Return the correlations as an array [cell, beam]
+   def getCorrelationArray(self):
+      nbCells = len(self.cellCorrelation['ID'])
+      return(np.frombuffer(self._rawdata, dtype='u1', count=nbCells*4, offset=self._index).reshape(nbCells,4))
+
    def write(self):
-      retValue=''
-      for i in range(len(self.cellCorrelation['ID'])):
-         retValue = retValue + '{:.2f},{:.2f},{:.2f},{:.2f},'.format \
-                           (st.unpack('B',self.cellCorrelation['COR1'][i])[0], \
-                           st.unpack('B',self.cellCorrelation['COR2'][i])[0], \
-                           st.unpack('B',self.cellCorrelation['COR3'][i])[0], \
-                           st.unpack('B',self.cellCorrelation['COR4'][i])[0])
-      return(retValue)
-
-   # TODO: deal here to save in numpy format
-   def writeBin(self):
-      return(self._rawdata)
+      return(''.join(CORRELATIONTEXT[self.getCorrelationArray().ravel()].tolist()))
 
    def getType(self):
       return(CORRELATIONPROFILE)
@@ -735,12 +690,16 @@ class WHIntensity():
       'INT3':[],
       'INT4':[],}
       
-   def readWHIntensity(self, nbCell, index, rawEnsemble):
+   def readWHIntensity(self, nbCell, index, rawEnsemble, cells=None):
       self._rawdata = rawEnsemble
       cpt = index
       self.intensityID = rawEnsemble[cpt:cpt+2]
       cpt = cpt + 2
-      for i in range(nbCell):
+      # Only the cells of the range <cells> are read
+      first, last = getCellRange(cells, nbCell)
+      cpt = cpt + first*4
+      self._index = cpt
+      for i in range(first, last):
          self.cellIntensity['ID'].append(i+1)
          self.cellIntensity['INT1'].append(rawEnsemble[cpt:cpt+1])
          cpt = cpt + 1
@@ -756,24 +715,15 @@ class WHIntensity():
    def getRawEnsemble(self):
       return(self._rawdata)
 
+   # Return the intensities (internal values) as an array [cell, beam]
+   def getIntensityArray(self):
+      nbCells = len(self.cellIntensity['ID'])
+      return(np.frombuffer(self._rawdata, dtype='u1', count=nbCells*4, offset=self._index).reshape(nbCells,4))
+
+   # Intensities in dB, see INTENSITYDB
    def write(self):
-      retValue=''
-      # Conversion of the stored intensity internal value to dB 
-      # K is a factor dependant on electronic component, it is estimated by ration of a
-      # scale factor given by RDI (0.45 dB) and temperature, here fixed at 10°c (for convenience)
-      k = 0.045  # 0.45 / 10.0
-      for i in range(len(self.cellIntensity['ID'])):
-         retValue = retValue + '{:.2f},{:.2f},{:.2f},{:.2f},'.format \
-                           (10 * np.log10(10**(k*(st.unpack('B',self.cellIntensity['INT1'][i])[0])/10)), \
-                           10 * np.log10(10**(k*(st.unpack('B',self.cellIntensity['INT2'][i])[0])/10)), \
-                           10 * np.log10(10**(k*(st.unpack('B',self.cellIntensity['INT3'][i])[0])/10)), \
-                           10 * np.log10(10**(k*(st.unpack('B',self.cellIntensity['INT4'][i])[0])/10)) )
-      return(retValue)
-
-   # TODO: deal here to save in numpy format
-   def writeBin(self):
-      return(self._rawdata)
-      
+      return(''.join(INTENSITYTEXT[self.getIntensityArray().ravel()].tolist()))
+
    def getType(self):
       return(INTENSITYPROFILE)
 
@@ -791,12 +741,16 @@ class WHPercentGood():
       'PG3':[],
       'PG4':[],}
       
-   def readWHPercentGood(self, nbCell, index, rawEnsemble):
+   def readWHPercentGood(self, nbCell, index, rawEnsemble, cells=None):
       self._rawdata = rawEnsemble
       cpt = index
       self.percentGoodID = rawEnsemble[cpt:cpt+2]
       cpt = cpt + 2
-      for i in range(nbCell):
+      # Only the cells of the range <cells> are read
+      first, last = getCellRange(cells, nbCell)
+      cpt = cpt + first*4
+      self._index = cpt
+      for i in range(first, last):
          self.cellPercentGood['ID'].append(i+1)
          self.cellPercentGood['PG1'].append(rawEnsemble[cpt:cpt+1])
          cpt = cpt + 1
@@ -812,19 +766,13 @@ class WHPercentGood():
    def getRawEnsemble(self):
       return(self._rawdata)
 
+   # Return the percents good as an array [cell, beam]
+   def getPercentGoodArray(self):
+      nbCells = len(self.cellPercentGood['ID'])
+      return(np.frombuffer(self._rawdata, dtype='u1', count=nbCells*4, offset=self._index).reshape(nbCells,4))
+
    def write(self):
-      retValue=''
-      for i in range(len(self.cellPercentGood['ID'])):
-         retValue = retValue + '{:3.1f},{:3.1f},{:3.1f},{:3.1f},'.format \
-                           (st.unpack('b',self.cellPercentGood['PG1'][i])[0], \
-                           st.unpack('b',self.cellPercentGood['PG2'][i])[0], \
-                           st.unpack('b',self.cellPercentGood['PG3'][i])[0], \
-                           st.unpack('b',self.cellPercentGood['PG4'][i])[0])
-      return(retValue)
-
-   # TODO: deal here to save in numpy format
-   def writeBin(self):
-      return(self._rawdata)
+      return(''.join(PERCENTGOODTEXT[self.getPercentGoodArray().ravel()].tolist()))
 
    def getType(self):
       return(PERCENTGOODPROFILE)
@@ -834,8 +782,10 @@ class WHPercentGood():
 # return the different data types     ---
 #----------------------------------------
 class readEnsemble():
-   def __init__(self, _rawEnsemble):
+   def __init__(self, _rawEnsemble, coordinates=COORDSYSTEM[0], fixedLeaders=None):
       self.rawEnsemble = _rawEnsemble
+      self.coordinates = coordinates # default coordinate system of the velocities
+      self.fixedLeaders = fixedLeaders # WHFixedLeaderCache sharing the fixed leaders, if any
       self.h = WHHeader()
       self.fh = WHFixedLeader()
       self.vh = WHVariableLeader()
@@ -844,9 +794,14 @@ class readEnsemble():
       self.inty = WHIntensity()
       self.pg = WHPercentGood()
       self.ensembleList = []
+      self.cells = None # range of the cells read (slice), default: all
 
-   def readEnsembleData(self):
+   # Read the ensemble, only the profiles listed in <dataTypes> are decoded
+   # (default: all), the other ones are just located by the header offsets.
+   # Only the cells of the range <cells> (slice, default: all) are read.
+   def readEnsembleData(self, dataTypes=None, cells=None):
       index = 0
+      self.cells = cells
       self.ensembleList = []
       nbCells = 0
       # Read header part
@@ -855,31 +810,39 @@ class readEnsemble():
       # loop over number data types read in the header
       # and read the various ensemble
       for i in range(self.h.GetNbDataTypes()):
+         offset = self.h.getOffSetDataTypes(i)-4
+         dataType = st.unpack('<H', self.rawEnsemble[offset:offset+2])[0]
+         if dataTypes != None and dataType in DATATYPES.values() and dataType not in dataTypes:
+            continue
          # Read fixed header
-         if st.unpack('<H', self.rawEnsemble[self.h.getOffSetDataTypes(i)-4:self.h.getOffSetDataTypes(i)-2])[0] == FIXEDLEADER:
-            index = self.fh.readWHFixedLeader(self.h.getOffSetDataTypes(i)-4, self.rawEnsemble)
+         if dataType == FIXEDLEADER:
+            if self.fixedLeaders is None:
+               index = self.fh.readWHFixedLeader(offset, self.rawEnsemble)
+            else:
+               self.fh = self.fixedLeaders.getFixedLeader(offset, self.rawEnsemble)
+               index = offset + FIXEDLEADERSTRUCT.size
             # Get the number of cells for this ensemble
             nbCells = self.fh.getNumberOfCells()
             self.ensembleList.append(self.fh)
             # Read variable header
-         elif st.unpack('<H', self.rawEnsemble[self.h.getOffSetDataTypes(i)-4:self.h.getOffSetDataTypes(i)-2])[0] == VARIABLELEADER: 
-            index = self.vh.readWHVariableLeader(self.h.getOffSetDataTypes(i)-4, self.rawEnsemble)
+         elif dataType == VARIABLELEADER: 
+            index = self.vh.readWHVariableLeader(offset, self.rawEnsemble)
             self.ensembleList.append(self.vh)
          # Read velocity
-         elif st.unpack('<H', self.rawEnsemble[self.h.getOffSetDataTypes(i)-4:self.h.getOffSetDataTypes(i)-2])[0] == VELOCITYPROFILE:
-            index = self.v.readWHVelocity(nbCells, self.h.getOffSetDataTypes(i)-4, self.rawEnsemble)
+         elif dataType == VELOCITYPROFILE:
+            index = self.v.readWHVelocity(nbCells, offset, self.rawEnsemble, cells)
             self.ensembleList.append(self.v)
          # Read correlation data
-         elif st.unpack('<H', self.rawEnsemble[self.h.getOffSetDataTypes(i)-4:self.h.getOffSetDataTypes(i)-2])[0] == CORRELATIONPROFILE:
-            index = self.corr.readWHCorrelation(nbCells, self.h.getOffSetDataTypes(i)-4, self.rawEnsemble)
+         elif dataType == CORRELATIONPROFILE:
+            index = self.corr.readWHCorrelation(nbCells, offset, self.rawEnsemble, cells)
             self.ensembleList.append(self.corr)
          #Read Intensity data
-         elif st.unpack('<H', self.rawEnsemble[self.h.getOffSetDataTypes(i)-4:self.h.getOffSetDataTypes(i)-2])[0] == INTENSITYPROFILE:
-            index = self.inty.readWHIntensity(nbCells, self.h.getOffSetDataTypes(i)-4, self.rawEnsemble)
+         elif dataType == INTENSITYPROFILE:
+            index = self.inty.readWHIntensity(nbCells, offset, self.rawEnsemble, cells)
             self.ensembleList.append(self.inty)
          # Read Percent Good data
-         elif st.unpack('<H', self.rawEnsemble[self.h.getOffSetDataTypes(i)-4:self.h.getOffSetDataTypes(i)-2])[0] == PERCENTGOODPROFILE:
-            index = self.pg.readWHPercentGood(nbCells, self.h.getOffSetDataTypes(i)-4, self.rawEnsemble)
+         elif dataType == PERCENTGOODPROFILE:
+            index = self.pg.readWHPercentGood(nbCells, offset, self.rawEnsemble, cells)
             self.ensembleList.append(self.pg)
       return
 
@@ -978,107 +941,67 @@ class readEnsemble():
          newVels[3] = 0
          return(newVels)
 
-   # Transforme beam coordinates to XYZ coordinates
+   # Correlation test over all the cells at once
+   # Return the velocities corrected from the speed of sound [cell, beam]
+   # and the mask of the valid beams velocities
+   def correlationTestArray(self):
+      nbBeams = self.fh.getNumberOfBeams()
+      C = self.getSpeedOfSound(self.vh.getTemperature(),self.vh.getSalinity(),self.vh.getDepthSensor())
+      CA = self.vh.getSpeedOfSound()
+      rawVels = self.v.getVelocityArray()[:,:nbBeams]
+      valid = (self.corr.getCorrelationArray()[:,:nbBeams] >= self.fh.getCorrelationThrehold()) & (rawVels != BADVELOCITY)
+      return(rawVels*0.001*(C/CA), valid)
+
+   # Transforme beam coordinates to XYZ coordinates (4 beams and 3 beams solutions)
    def BeamToXYZ(self):
-      # TODO: we need to deal also with 3 beams solutions
-      theta = self.fh.getBeamAngle() # Get beam angle
-      c = self.fh.getConcaveOrConvex() # 1: convex beams; -1: concave beams
-      a = 1.0 / (2.0*np.sin(math.radians(theta)))
-      b = 1.0 / (4.0*np.cos(math.radians(theta)))
-      d = a / np.sqrt(2)
-      vels = np.zeros((self.fh.getNumberOfBeams(), self.fh.getNumberOfCells()))
-      for i in range(self.fh.getNumberOfCells()):
-         nValidVel, currentCellVels = self.correlationTest(i)
-         if nValidVel == 4:
-            """
-            vels[0,i] = c*a*(self.getCorrectedVelocity(1,i)-self.getCorrectedVelocity(2,i))
-            vels[1,i] = c*a*(self.getCorrectedVelocity(4,i)-self.getCorrectedVelocity(3,i))
-            vels[2,i] = b*(self.getCorrectedVelocity(1,i)+self.getCorrectedVelocity(2,i)+self.getCorrectedVelocity(3,i)+self.getCorrectedVelocity(4,i))
-            vels[3,i] = d*(self.getCorrectedVelocity(1,i)+self.getCorrectedVelocity(2,i)-self.getCorrectedVelocity(3,i)-self.getCorrectedVelocity(4,i))
-            """
-            newVels = self.getFourBeamSolution(a,b,c,d,currentCellVels)
-            vels[0,i] = newVels[0]
-            vels[1,i] = newVels[1]
-            vels[2,i] = newVels[2]
-            vels[3,i] = newVels[3]
-         if nValidVel == 3:
-            newVels = self.getThreeBeamSolution(a,b,c,d,currentCellVels)
-            vels[0,i] = newVels[0]
-            vels[1,i] = newVels[1]
-            vels[2,i] = newVels[2]
-            vels[3,i] = newVels[3]
-      return(vels)
+      vels, valid = self.correlationTestArray()
+      # Constants of the beam angle and convexity, computed once per fixed leader
+      constants = self.fh.getBeamConstants()
+      return(beamToXYZ(vels[None], valid[None], constants=constants)[0].transpose()) # array (4 x nbCells)
 
    # Transform beam coordinates to East, Noth and Up coordinates
    def BeamToENU(self):
       XYZVels = self.BeamToXYZ() # Get XYZ coords from beams
-      if self.fh.getUsePitchSensor(): # Internal sensors
-         P = np.arctan(np.tan(self.vh.getPitch())*np.cos(self.vh.getRoll()))
-      else:
-         P = self.vh.getPitch()
-      SH = np.sin(math.radians(self.vh.getHeading()+self.fh.getHeadingAlignment()))
-      CH = np.cos(math.radians(self.vh.getHeading()+self.fh.getHeadingAlignment()))
-      SP = np.sin(math.radians(P))
-      CP = np.cos(math.radians(P))
-      SR = np.sin(math.radians(self.vh.getRoll()+self.fh.getFacingBeam()))
-      CR = np.cos(math.radians(self.vh.getRoll()+self.fh.getFacingBeam()))
-      M = np.matrix([[(CH*CR)+(SH*SP*SR),  SH*CP, (CH*SR)-(SH*SP*CR), 0],
-                    [(-SH*CR)+(CH*SP*SR), CH*CP, (-SH*SR)-(CH*SP*CR), 0],
-                    [-CP*SR             , SP   , CP*CR  , 0],
-                    [0                  ,0     ,0       , 1]])
-      ENUVels = np.dot(XYZVels.transpose(), M)
-      return(ENUVels.transpose())
-
-   # Return the velocities based on the required coordinate system
-   def write(self,coordinates):
-      retValue = ""
-      l = len(self.ensembleList)
+      M = getRotationMatrices(self.vh.getHeading(), self.vh.getPitch(), self.vh.getRoll(),
+                              self.fh.getHeadingAlignment(), self.fh.getFacingBeam(),
+                              self.fh.getUsePitchSensor())
+      return(XYZToENU(XYZVels.transpose()[None], M[None])[0].transpose())
+
+   # Return the velocities [cell, 4] in the required coordinate system (default: the
+   # one of the ensemble), in m.s-1, NaN for the bad beam velocities in BEAM coordinates
+   def getVelocity(self, coordinates=None):
+      if coordinates == None:
+         coordinates = self.coordinates
+      if coordinates == COORDSYSTEM[8]: # Instrument
+         return(self.BeamToXYZ().transpose())
+      elif coordinates == COORDSYSTEM[24]: # Earth
+         return(self.BeamToENU().transpose())
+      rawVels = self.v.getVelocityArray()
+      return(np.where(rawVels != BADVELOCITY, rawVels*0.001, np.nan))
+
+   # Return the ensemble data, velocities in the required coordinate system (default: the
+   # one of the ensemble). Only the profiles listed in <dataTypes> are written (default:
+   # all the decoded ones)
+   def write(self,coordinates=None,dataTypes=None):
+      if coordinates == None:
+         coordinates = self.coordinates
+      items = []
       # Skip the header store at 0
-      retValue += '{}'.format(self.ensembleList[1].write())
-      for i in range(2,l-1):
-         if self.ensembleList[i].getType() == VELOCITYPROFILE:
-            if coordinates == COORDSYSTEM[8]: # Instrument
-               xyzCoords = self.BeamToXYZ() # array (4 x nbCells)
-               for j in range(self.fh.getNumberOfCells()):
-                  retValue += ',{:.5f},{:.5f},{:.5f},{:.5f}'.format(xyzCoords[0,j],xyzCoords[1,j],xyzCoords[2,j],xyzCoords[3,j])
-            elif coordinates == COORDSYSTEM[24]: # Earth
-               ENUCoords = self.BeamToENU() # array (nbCells x 4)
-               for j in range(self.fh.getNumberOfCells()):
-                  retValue += ',{:.5f},{:.5f},{:.5f},{:.5f}'.format(ENUCoords[0,j],ENUCoords[1,j],ENUCoords[2,j],ENUCoords[3,j])
-            else:
-               retValue += ',{}'.format(self.ensembleList[i].write()) # Beams
+      for item in self.ensembleList[1:]:
+         if dataTypes != None and item.getType() in DATATYPES.values() and item.getType() not in dataTypes:
+            continue
+         if item.getType() == FIXEDLEADER:
+            first, last = getCellRange(self.cells, self.fh.getNumberOfCells())
+            items.append(item.write(last - first))
+         elif item.getType() == VELOCITYPROFILE and coordinates == COORDSYSTEM[8]: # Instrument
+            items.append(self.writeCoordinates(self.BeamToXYZ()))
+         elif item.getType() == VELOCITYPROFILE and coordinates == COORDSYSTEM[24]: # Earth
+            items.append(self.writeCoordinates(self.BeamToENU()))
          else:
-            retValue += ',{}'.format(self.ensembleList[i].write())
-      retValue += ',{}\n'.format(self.ensembleList[l-1].write())
-      return(retValue)
-
-#----------------------------------------
-#---Return first occurence of elements---
-#----------------------------------------
-def getFirstWavesCurrentsID(infile):
-   firstWaves=-1
-   firstCurrents=-1
-   
-   # Try to find first occurence of waves element
-   while(True):
-      raw, value = __nextLittleEndianUnsignedShort(infile)
-      if raw == st.pack('<H',PD0HEADERID):
-         break
-   firstCurrents = infile.tell()
-      
-   infile.seek(0)
-   
-   # Try to find first occurence of waves element
-   while(infile.read(2) != WAVESID):
-      raw, value = __nextLittleEndianUnsignedShort(infile)
-      if raw == st.pack('<H',WAVESID):
-         break
-   firstWaves = infile.tell()
-         
-   # bail if neither waves nor currents found
-   if (firstWaves < 0) and (firstCurrents < 0):
-      raise IOError('Neither waves nor currents header found')
-         
-   return(firstCurrents,firstWaves)
+            items.append(item.write())
+      return('{}\n'.format(','.join(items)))
 
-            
\ No newline at end of file
+   # Format transformed velocities, array (4 x nbCells)
+   def writeCoordinates(self, vels):
+      return(','.join(['{:.5f},{:.5f},{:.5f},{:.5f}'.format(vels[0,j],vels[1,j],vels[2,j],vels[3,j]) \
+                       for j in range(vels.shape[1])]))
@@ -0,0 +1,79 @@
+#!/usr/bin/python
+#-*- coding: utf-8 -*-
+
+import collections
+import concurrent.futures as cf
+
+from utils.pyArrayClass import *
+from utils.pyReaderClass import WHMappedFile
+from utils.pyExportClass import WHTextFormatter
+
+# Number of blocks waiting for their writing, per process
+PENDINGBLOCKS = 2
+
+# ADCP files mapped by a worker process, mapped once for all its blocks
+_mappedFiles = {}
+
+def _getBuffer(filename):
+   if filename not in _mappedFiles:
+      _mappedFiles[filename] = WHMappedFile(filename)
+   return(_mappedFiles[filename].getBuffer())
+
+# Decode the block of ensembles starting at <offsets> in <filename> (only
+# the range of cells <cells>), return the arrays or, when <formatter>
+# (WHTextFormatter) is given, the text lines
+def convertBlock(filename, offsets, dataTypes, formatter=None, cells=None):
+   arrays = WHEnsembleArrays()
+   arrays.readEnsembleArrays(_getBuffer(filename), offsets, dataTypes, cells)
+   if formatter is None:
+      return(arrays)
+   return(formatter.formatArrays(arrays))
+
+#----------------------------------------
+#---  Class block converter           ---
+#----------------------------------------
+# Decode, transform and format blocks of ensembles of <filename> (only the
+# range of cells <cells>, default: all) and write them to <outfile> (a
+# WHTextWriter or a binary writer) in their order.
+# With more than one job the blocks are converted in a pool of <jobs>
+# processes, each one mapping the ADCP file, and written back in order as
+# soon as the oldest block is done; at most PENDINGBLOCKS blocks per
+# process are waiting so that the memory stays bounded.
+class WHBlockConverter():
+   def __init__(self, filename, outfile, dataTypes, jobs=1, cells=None):
+      self.filename = filename
+      self.outfile = outfile
+      self.dataTypes = dataTypes
+      self.cells = cells
+      self.jobs = jobs
+      self.formatter = None
+      if isinstance(outfile, WHTextFormatter):
+         self.formatter = WHTextFormatter(outfile.coordinates, outfile.dataTypes)
+      self._pool = None
+      self._pending = collections.deque()
+      if jobs > 1:
+         self._pool = cf.ProcessPoolExecutor(max_workers=jobs)
+
+   # Convert and write the ensembles starting at <offsets>
+   def convert(self, offsets):
+      if len(offsets) == 0:
+         return
+      if self._pool is None:
+         self._write(convertBlock(self.filename, offsets, self.dataTypes, self.formatter, self.cells))
+         return
+      self._pending.append(self._pool.submit(convertBlock, self.filename, offsets, self.dataTypes, self.formatter, self.cells))
+      while len(self._pending) > PENDINGBLOCKS*self.jobs:
+         self._write(self._pending.popleft().result())
+
+   def _write(self, block):
+      if self.formatter is None:
+         self.outfile.writeArrays(block)
+      else:
+         self.outfile.writeLines(block)
+
+   # Write the blocks still converted by the pool
+   def close(self):
+      while len(self._pending) > 0:
+         self._write(self._pending.popleft().result())
+      if self._pool is not None:
+         self._pool.shutdown()
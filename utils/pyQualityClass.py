@@ -0,0 +1,124 @@
+#!/usr/bin/python
+#-*- coding: utf-8 -*-
+
+import numpy as np
+
+from utils.pyArrayClass import *
+
+# Quality control tests, in the order they are applied
+# CORR: correlation below the threshold (default: LowCorrThreshold of the fixed leader)
+# PG: percent good below the minimum (default: PercentMinimumGood of the fixed leader)
+# INT: echo intensity below the minimum, in dB
+# TILT: tilt (from pitch and roll) above the limit, in degree
+# 4BEAM: cells without the four beams valid, the fourth component (error velocity) is not computed
+# EV: error velocity above the threshold, in mm.s-1 (default: ErrorVelocityThreshold of the fixed leader)
+QCTESTS = ('CORR', 'PG', 'INT', 'TILT', '4BEAM', 'EV')
+# Tests needing a value, the other ones use the fixed leader (or no) value by default
+QCREQUIREDVALUES = ('INT', 'TILT')
+# Profiles needed by the tests
+QCDATATYPES = {
+      'CORR': CORRELATIONPROFILE,
+      'PG': PERCENTGOODPROFILE,
+      'INT': INTENSITYPROFILE,
+      }
+
+#----------------------------------------
+#---  Class quality control           ---
+#----------------------------------------
+# Reject the bad beam velocities of the decoded ensembles before writing
+# them to <outfile> (a writer or a WHEnsembleAverager): the rejected
+# velocities are set to BADVELOCITY, so they are written as Nan in BEAM
+# coordinates and not used by the coordinate transformations. <tests> is a
+# dict test -> value (see QCTESTS), a None value for the default one. The
+# masks of each test are computed over the whole arrays, the beam tests
+# (CORR, PG, INT, TILT) first, then the cell tests (4BEAM, EV) from the
+# beams left (in INSTRUMENT or EARTH <coordinates>, the beams passing the
+# correlation test of the transformations too). The number of velocities
+# rejected by each test is counted, a velocity may be rejected by several
+# tests.
+class WHQualityControl():
+   def __init__(self, outfile, tests, coordinates='BEAM'):
+      for test, value in tests.items():
+         if test not in QCTESTS:
+            raise ValueError('Invalid quality control test ({}). Valid values: {}'.format(test, ', '.join(QCTESTS)))
+         if value == None and test in QCREQUIREDVALUES:
+            raise ValueError('A value is needed by the quality control test {}'.format(test))
+      self.outfile = outfile
+      self.tests = tests
+      self.coordinates = coordinates
+      self.nbValues = 0    # valid velocities tested
+      self.nbRejected = 0  # valid velocities rejected by at least one test
+      self.counts = dict((test, 0) for test in QCTESTS if test in tests)
+
+   # Return the masks of the velocities [ensemble, cell, beam] rejected by
+   # each test of <arrays> (WHEnsembleArrays), the profiles needed by the
+   # tests must be decoded (see QCDATATYPES)
+   def getMasks(self, arrays):
+      shape = arrays.velocity.shape
+      masks = {}
+      if 'CORR' in self.tests:
+         threshold = self._getValue('CORR', arrays.getCorrelationThrehold())
+         masks['CORR'] = arrays.correlation < np.asarray(threshold)[...,None,None]
+      if 'PG' in self.tests:
+         minimum = self._getValue('PG', arrays.fixedLeader['PercentMinimumGood'])
+         masks['PG'] = arrays.percentGood.view(np.int8) < np.asarray(minimum)[...,None,None]
+      if 'INT' in self.tests:
+         masks['INT'] = INTENSITYDB[arrays.intensity] < self.tests['INT']
+      if 'TILT' in self.tests:
+         tilt = np.degrees(np.arccos(np.cos(np.radians(arrays.getPitch()))*np.cos(np.radians(arrays.getRoll()))))
+         masks['TILT'] = np.broadcast_to((tilt > self.tests['TILT'])[:,None,None], shape)
+
+      # Cell tests, from the beams valid after the beam tests
+      if '4BEAM' in self.tests or 'EV' in self.tests:
+         if self.coordinates == COORDSYSTEM[0]:
+            vels, valid = arrays.velocity*0.001, arrays.velocity != BADVELOCITY
+         else:
+            vels, valid = arrays.correlationTestArray()
+         for mask in masks.values():
+            valid = valid & ~mask
+         nbValid = valid.sum(axis=-1)
+         if '4BEAM' in self.tests:
+            masks['4BEAM'] = np.broadcast_to((nbValid < 4)[...,None], shape)
+         if 'EV' in self.tests:
+            threshold = self._getValue('EV', arrays.fixedLeader['ErrorVelocityThreshold'])
+            error = beamToXYZ(vels, valid, arrays.getBeamAngle(), 1)[...,3]
+            bad = (nbValid == 4) & (np.abs(error)*1000 > np.asarray(threshold)[...,None])
+            masks['EV'] = np.broadcast_to(bad[...,None], shape)
+      return(masks)
+
+   # Value of the test, the fixed leader one <default> (one per ensemble) if not given
+   def _getValue(self, test, default):
+      return(default if self.tests[test] == None else self.tests[test])
+
+   # Return <arrays> with the rejected velocities set to BADVELOCITY (the
+   # velocities are copied, the other arrays are shared)
+   def applyTests(self, arrays):
+      if arrays.velocity is None or arrays.getNumberOfEnsembles() == 0:
+         return(arrays)
+      valid = arrays.velocity != BADVELOCITY
+      rejected = np.zeros(arrays.velocity.shape, dtype=bool)
+      for test, mask in self.getMasks(arrays).items():
+         self.counts[test] += int(np.count_nonzero(mask & valid))
+         rejected |= mask
+      rejected &= valid
+      self.nbValues += int(np.count_nonzero(valid))
+      self.nbRejected += int(np.count_nonzero(rejected))
+      arrays = arrays.getEnsembles(slice(None))
+      arrays.velocity = np.where(rejected, np.int16(BADVELOCITY), arrays.velocity)
+      return(arrays)
+
+   # Write the ensembles of <arrays> (WHEnsembleArrays) once tested
+   def writeArrays(self, arrays):
+      self.outfile.writeArrays(self.applyTests(arrays))
+
+   def flush(self):
+      self.outfile.flush()
+
+   def close(self):
+      self.outfile.close()
+
+   def printReport(self):
+      print('Quality control: {} of {} velocities rejected'.format(self.nbRejected, self.nbValues))
+      for test in QCTESTS:
+         if test in self.counts:
+            print('\t{}: {} rejected'.format(test, self.counts[test]))
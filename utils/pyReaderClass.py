@@ -0,0 +1,507 @@
+#!/usr/bin/python
+#-*- coding: utf-8 -*-
+
+import os
+import sys
+import stat
+import mmap
+import socket
+import collections
+import numpy as np
+try:
+   import xarray as xr
+except ImportError:
+   xr = None
+
+from utils.pyArrayClass import *
+from utils.pyScanClass import *
+
+# Sidecar index of the ensembles: one record per current ensemble
+INDEXDTYPE = np.dtype([
+      ('Offset','<i8'),
+      ('Length','<u2'),
+      ('EnsembleNumber','<i8'),
+      ('DateTime','<M8[ms]'),])
+INDEXEXTENSION = '.idx'
+# Prefix of the TCP live sources: tcp://host:port
+TCPPREFIX = 'tcp://'
+# Number of decoded ensembles kept by PD0File
+CACHESIZE = 128
+# Size of the blocks read from a binary file-like object
+STREAMBLOCKSIZE = 1 << 20
+# First xarray version with the backend API reading the profiles lazily
+# (see WHLazyProfileArray), the older ones load them at once
+LAZYXARRAYVERSION = (0, 18)
+
+# Return the (major, minor) numbers of a version string
+def _getVersion(version):
+   return(tuple(int(number) if number.isdigit() else 0 for number in version.split('.')[:2]))
+
+LAZYXARRAY = xr is not None and _getVersion(xr.__version__) >= LAZYXARRAYVERSION
+BackendArray = xr.backends.BackendArray if LAZYXARRAY else object
+
+#----------------------------------------
+#---  Class memory mapped ADCP file   ---
+#----------------------------------------
+# ADCP file mapped for reading: getBuffer() returns a memoryview of the
+# whole mapped file, so no ensemble byte is copied before decoding.
+class WHMappedFile():
+   def __init__(self, filename):
+      self.name = filename
+      self._file = open(filename, 'rb')
+      self._mmap = None
+      if os.fstat(self._file.fileno()).st_size > 0:
+         self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+         # Files are read from the beginning to the end
+         if hasattr(mmap, 'MADV_SEQUENTIAL'):
+            self._mmap.madvise(mmap.MADV_SEQUENTIAL)
+         self._view = memoryview(self._mmap)
+      else:
+         self._view = memoryview(b'')
+
+   def __len__(self):
+      return(len(self._view))
+
+   def __enter__(self):
+      return(self)
+
+   def __exit__(self, *args):
+      self.close()
+
+   # Return the whole mapped file (for the columnar decoder)
+   def getBuffer(self):
+      return(self._view)
+
+   def close(self):
+      self._view.release()
+      if self._mmap is not None:
+         try:
+            self._mmap.close()
+         except BufferError:
+            # Windows are still used by decoded ensembles, the mapping
+            # is released with the last of them
+            pass
+         self._mmap = None
+      self._file.close()
+
+#----------------------------------------
+#---  Class ensemble index (sidecar)  ---
+#----------------------------------------
+# Byte offset, length, ensemble number and start time of every ensemble
+# of an ADCP file, saved next to it in <file>.idx. The sidecar stores the
+# size and modification time of the ADCP file and is rebuilt when one
+# of them changes.
+class WHEnsembleIndex():
+   def __init__(self, filename):
+      self.filename = filename
+      self.indexname = filename + INDEXEXTENSION
+      self.index = np.zeros(0, dtype=INDEXDTYPE)
+
+   def __len__(self):
+      return(len(self.index))
+
+   # Load the sidecar if it is up to date, otherwise build and save it
+   def getIndex(self, buffer=None):
+      if not self.loadIndex():
+         self.buildIndex(buffer)
+         self.saveIndex()
+      return(self.index)
+
+   # Return the size and modification time identifying the ADCP file
+   def _getSourceStamp(self):
+      info = os.stat(self.filename)
+      return(np.array([info.st_size, info.st_mtime_ns], dtype=np.int64))
+
+   def loadIndex(self):
+      try:
+         with np.load(self.indexname) as sidecar:
+            if not np.array_equal(sidecar['source'], self._getSourceStamp()):
+               return(False)
+            self.index = sidecar['index']
+      except (IOError, OSError, KeyError, ValueError):
+         return(False)
+      return(self.index.dtype == INDEXDTYPE)
+
+   def saveIndex(self):
+      try:
+         with open(self.indexname, 'wb') as sidecar:
+            np.savez(sidecar, index=self.index, source=self._getSourceStamp())
+      except (IOError, OSError):
+         # Read only location, the index is only kept in memory
+         pass
+
+   # Scan the ADCP file (or <buffer> holding it) and decode the leaders only
+   def buildIndex(self, buffer=None):
+      if buffer is None:
+         with WHMappedFile(self.filename) as infile:
+            return(self.buildIndex(infile.getBuffer()))
+      arrays = WHEnsembleArrays()
+      arrays.readLeaderArrays(buffer)
+      data = np.frombuffer(buffer, dtype=np.uint8)
+      self.index = np.zeros(arrays.getNumberOfEnsembles(), dtype=INDEXDTYPE)
+      self.index['Offset'] = arrays.offsets
+      self.index['Length'] = data[arrays.offsets+2] | (data[arrays.offsets+3].astype(np.uint16) << 8)
+      self.index['EnsembleNumber'] = arrays.getElementNumber()
+      self.index['DateTime'] = arrays.getStartDateTime()
+      return(self.index)
+
+   # Return the position in the index of the first ensemble with <field> above
+   # (or equal to when <strict> is False) <value>, None if <field> is not sorted
+   def _search(self, field, value, strict):
+      values = self.index[field]
+      if not np.all(values[1:] >= values[:-1]):
+         return(None)
+      return(int(np.searchsorted(values, value, side='right' if strict else 'left')))
+
+   # First ensemble starting after <dt> (datetime)
+   def findDateTime(self, dt, strict=True):
+      return(self._search('DateTime', np.datetime64(dt, 'ms'), strict))
+
+   # First ensemble whose number is at least <number>
+   def findElementNumber(self, number, strict=False):
+      return(self._search('EnsembleNumber', number, strict))
+
+   # Byte offset of the <position>th ensemble (-1 past the last one)
+   def getOffset(self, position):
+      if position is None or position >= len(self.index):
+         return(-1)
+      return(int(self.index['Offset'][position]))
+
+# Return the offset of the first ensemble after <start> (datetime) and from
+# the number <first> found through the index of <filename> (built once,
+# then reused), 0 when the ensembles are not sorted (clock or counter reset)
+def getStartOffset(filename, buffer, start=None, first=None):
+   index = WHEnsembleIndex(filename)
+   index.getIndex(buffer)
+   positions = []
+   if start != None:
+      positions.append(index.findDateTime(start))
+   if first != None:
+      positions.append(index.findElementNumber(first))
+   if len(positions) == 0 or None in positions:
+      return(0)
+   startOffset = index.getOffset(max(positions))
+   if startOffset < 0:
+      return(len(buffer)) # nothing to read
+   return(startOffset)
+
+#----------------------------------------
+#---  Iterate over the ensembles      ---
+#----------------------------------------
+def iterStreamEnsembles(stream, framer=None, blockSize=STREAMBLOCKSIZE):
+   """Yield (offset, raw ensemble) of the valid current ensembles read by blocks from a binary stream"""
+   if framer is None:
+      framer = WHStreamFramer()
+   for ensembles in iterLiveEnsembles(stream, framer, blockSize):
+      for ensemble in ensembles:
+         yield(ensemble)
+
+#----------------------------------------
+#---  Live sources                    ---
+#----------------------------------------
+# Return true when <name> is a live source: "-" (stdin), "tcp://host:port",
+# a named pipe or a character device (serial line set up beforehand)
+def isLiveSource(name):
+   if name == '-' or name.startswith(TCPPREFIX):
+      return(True)
+   try:
+      mode = os.stat(name).st_mode
+   except OSError:
+      return(False)
+   return(stat.S_ISFIFO(mode) or stat.S_ISCHR(mode))
+
+# Open a live source (see isLiveSource), the returned object is read with readChunk
+def openLiveSource(name):
+   if name == '-':
+      return(sys.stdin.buffer)
+   if name.startswith(TCPPREFIX):
+      host, port = name[len(TCPPREFIX):].rsplit(':', 1)
+      return(socket.create_connection((host, int(port))))
+   # Unbuffered: a read returns the bytes available
+   return(open(name, 'rb', buffering=0))
+
+# Return the bytes available from <source> (socket or binary file-like
+# object), up to <size>, without waiting for more; empty at the end
+def readChunk(source, size):
+   if hasattr(source, 'recv'):
+      return(source.recv(size))
+   if hasattr(source, 'read1'):
+      return(source.read1(size))
+   return(source.read(size))
+
+def iterLiveEnsembles(source, framer=None, chunkSize=STREAMBLOCKSIZE):
+   """Yield the list of (offset, raw ensemble) completed by each chunk received from source"""
+   if framer is None:
+      framer = WHStreamFramer()
+   while True:
+      chunk = readChunk(source, chunkSize)
+      if not chunk:
+         break
+      ensembles = framer.feed(chunk)
+      if len(ensembles) > 0:
+         yield(ensembles)
+   ensembles = framer.close()
+   if len(ensembles) > 0:
+      yield(ensembles)
+
+# Return the data types to decode for the profiles <fields> (None: all) and
+# the velocities in <coordinates>
+def _getDecodedTypes(fields, coordinates):
+   if coordinates not in (COORDSYSTEM[0], COORDSYSTEM[8], COORDSYSTEM[24]):
+      raise ValueError('Invalid coordinate system ({}). Valid value: BEAM, INSTRUMENT, EARTH'.format(coordinates))
+   if fields == None:
+      return(None)
+   dataTypes = []
+   for field in fields:
+      if field.strip().upper() not in DATATYPES:
+         raise ValueError('Invalid field ({}). Valid values: VEL, INT, PG, CORR'.format(field))
+      dataTypes.append(DATATYPES[field.strip().upper()])
+   if VELOCITYPROFILE in dataTypes and coordinates != COORDSYSTEM[0]:
+      dataTypes.append(CORRELATIONPROFILE)
+   return(dataTypes)
+
+# Yield the raw ensembles of a file name (from the first ensemble of the
+# window found through the index) or of a binary file-like object
+def _iterRawEnsembles(source, start, first, useIndex):
+   if not isinstance(source, (str, bytes, os.PathLike)):
+      for offset, rawEnsemble in iterStreamEnsembles(source):
+         yield(rawEnsemble)
+      return
+   with WHMappedFile(source) as infile:
+      buffer = infile.getBuffer()
+      startOffset = 0
+      if useIndex and (start != None or first != None):
+         startOffset = getStartOffset(source, buffer, start, first)
+      for offset, length in WHEnsembleScanner().iterEnsembles(buffer, startOffset):
+         yield(buffer[offset:offset+length])
+
+def iterPD0Ensembles(source, start=None, end=None, first=None, last=None, fields=None,
+                     coordinates=COORDSYSTEM[0], useIndex=True, fixedLeaders=None, cells=None):
+   """Yield lazily the decoded ensembles (readEnsemble) of source, an ADCP file name
+   or a binary file-like object (only read forward).
+
+   start, end: datetime window, ensembles strictly after start and before end
+   first, last: ensemble number window (included)
+   fields: profiles to decode among VEL, CORR, INT, PG (default: all), the
+   correlation is decoded too for the velocities in INSTRUMENT or EARTH coordinates
+   coordinates: coordinate system of the velocities of the ensembles (see
+   readEnsemble.getVelocity and readEnsemble.write): BEAM, INSTRUMENT or EARTH
+   useIndex: reach the first ensemble of a file through its index (see WHEnsembleIndex)
+   fixedLeaders: WHFixedLeaderCache sharing the fixed leaders of the ensembles,
+   its changes list the configuration changes of the ensembles read
+   cells: range of the cells to decode (slice, default: all)
+   """
+   dataTypes = _getDecodedTypes(fields, coordinates)
+   if fixedLeaders is None:
+      fixedLeaders = WHFixedLeaderCache()
+   for rawEnsemble in _iterRawEnsembles(source, start, first, useIndex):
+      # Skip the header ID and the length as readEnsemble expects
+      re = readEnsemble(rawEnsemble[4:], coordinates, fixedLeaders)
+      re.readEnsembleData(dataTypes, cells)
+      fixedLeaders.checkConfiguration(re)
+      # Ensemble number window
+      number = re.vh.getElementNumber()
+      if last != None and number > last:
+         break
+      if first != None and number < first:
+         continue
+      # Time window
+      if start != None or end != None:
+         ensembleDateTime = re.vh.getStartDateTime()
+         if end != None and ensembleDateTime > end:
+            break
+         if start != None and not ensembleDateTime > start:
+            continue
+         if end != None and not ensembleDateTime < end:
+            continue
+      yield(re)
+
+#----------------------------------------
+#---  Class random access ADCP file   ---
+#----------------------------------------
+# Ensembles of an ADCP file reached through its index (see WHEnsembleIndex):
+# len(f) is the number of ensembles, f[i] the decoded ensemble (readEnsemble)
+# at position i and f[a:b] the ensembles from a to b decoded at once in
+# arrays (WHEnsembleArrays). The arrays have a fixed shape, so a slice
+# crossing a configuration change raises ValueError: such files are read
+# by segment, f[segment] for each slice of getSegments(). Only the requested
+# ensembles are decoded, and only their range of cells <cells> (slice,
+# default: all), the last <cacheSize> ensembles returned by f[i] are kept
+# decoded.
+class PD0File():
+   def __init__(self, filename, fields=None, coordinates=COORDSYSTEM[0], cacheSize=CACHESIZE, cells=None):
+      self.filename = filename
+      self.coordinates = coordinates
+      self.cells = cells
+      self.dataTypes = _getDecodedTypes(fields, coordinates)
+      self.cacheSize = cacheSize
+      self._cache = collections.OrderedDict()
+      self._fixedLeaders = WHFixedLeaderCache()
+      self._segments = None
+      self._file = WHMappedFile(filename)
+      self.index = WHEnsembleIndex(filename)
+      self.index.getIndex(self._file.getBuffer())
+
+   def __len__(self):
+      return(len(self.index))
+
+   def __enter__(self):
+      return(self)
+
+   def __exit__(self, *args):
+      self.close()
+
+   def __getitem__(self, key):
+      if isinstance(key, slice):
+         positions = np.arange(len(self))[key]
+         numbers = np.searchsorted([segment.start for segment in self.getSegments()], positions, side='right')
+         if len(positions) > 0 and numbers.min() != numbers.max():
+            raise ValueError('Ensembles {} to {} cross a configuration change, read them by segment (see getSegments)'.format(positions[0], positions[-1]))
+         arrays = WHEnsembleArrays()
+         arrays.readEnsembleArrays(self._file.getBuffer(), self.index.index['Offset'][key], self.dataTypes, self.cells)
+         return(arrays)
+      position = int(key)
+      if position < 0:
+         position = position + len(self)
+      if position < 0 or position >= len(self):
+         raise IndexError('Ensemble position {} out of range ({} ensembles)'.format(key, len(self)))
+      if position in self._cache:
+         self._cache.move_to_end(position)
+         return(self._cache[position])
+      ensemble = self._readEnsemble(position)
+      self._cache[position] = ensemble
+      if len(self._cache) > self.cacheSize:
+         self._cache.popitem(last=False)
+      return(ensemble)
+
+   def _readEnsemble(self, position):
+      offset = int(self.index.index['Offset'][position])
+      length = int(self.index.index['Length'][position])
+      # Skip the header ID and the length as readEnsemble expects
+      ensemble = readEnsemble(self._file.getBuffer()[offset+4:offset+length], self.coordinates, self._fixedLeaders)
+      ensemble.readEnsembleData(self.dataTypes, self.cells)
+      return(ensemble)
+
+   # Return the slices of the positions of the configuration segments (see
+   # getConfigurationSegments): f[segment] are arrays of a fixed shape
+   def getSegments(self):
+      if self._segments is None:
+         leaders = WHEnsembleArrays()
+         leaders.readLeaderArrays(self._file.getBuffer(), self.index.index['Offset'])
+         self._segments = getConfigurationSegments(leaders.fixedLeader)
+      return(self._segments)
+
+   # Return the leaders of all the ensembles as a pandas DataFrame (see
+   # WHEnsembleArrays.toDataFrame)
+   def toDataFrame(self, fixedLeader=False):
+      leaders = WHEnsembleArrays()
+      leaders.readLeaderArrays(self._file.getBuffer(), self.index.index['Offset'])
+      return(leaders.toDataFrame(fixedLeader))
+
+   # Return the profiles of the configuration segment <segment> (see
+   # getSegments) as a lazy xarray Dataset (see WHEnsembleArrays.toXarray):
+   # the leaders and coordinates are decoded at once, the profiles only
+   # when they are read, and only the ensembles of their selection. With
+   # xarray before LAZYXARRAYVERSION the profiles are decoded at once.
+   def toXarray(self, segment=0):
+      if xr is None:
+         raise ImportError('xarray is needed to build a Dataset')
+      positions = self.getSegments()[segment]
+      if not LAZYXARRAY:
+         return(self[positions].toXarray(self.coordinates))
+      leaders = WHEnsembleArrays()
+      leaders.readEnsembleArrays(self._file.getBuffer(), self.index.index['Offset'][positions], [], self.cells)
+      # Type and attributes of the profiles from the first ensemble
+      first = self[positions.start:positions.start+1]
+      variables = {}
+      for name, (values, attrs) in getProfileVariables(first, self.coordinates).items():
+         array = WHLazyProfileArray(self, positions, name, (leaders.getNumberOfEnsembles(),) + values.shape[1:], values.dtype)
+         variables[name] = xr.Variable(PROFILEDIMS, xr.core.indexing.LazilyIndexedArray(array), attrs)
+      return(xr.Dataset(variables, coords=getDatasetCoords(leaders), attrs=getDatasetAttributes(leaders, self.coordinates)))
+
+   # Return the ensemble in progress at <dt> (datetime): the last one starting at or before it
+   def atTime(self, dt):
+      position = self.index.findDateTime(dt, strict=True)
+      if position is None:
+         raise KeyError('Ensembles of {} are not sorted by time'.format(self.filename))
+      if position == 0:
+         raise KeyError('No ensemble at {}'.format(dt))
+      return(self[position-1])
+
+   # Return the ensemble numbered <number>
+   def atNumber(self, number):
+      position = self.index.findElementNumber(number)
+      if position is None:
+         raise KeyError('Ensembles of {} are not sorted by number'.format(self.filename))
+      if position >= len(self) or self.index.index['EnsembleNumber'][position] != number:
+         raise KeyError('No ensemble numbered {}'.format(number))
+      return(self[position])
+
+   def close(self):
+      self._cache.clear()
+      self._file.close()
+
+#----------------------------------------
+#---  Class lazy profile array        ---
+#----------------------------------------
+# Profile <name> [ensemble, cell, beam] of the ensembles <positions> (slice)
+# of a PD0File, read by xarray (see PD0File.toXarray): only the ensembles
+# of the selection are decoded from the mapped file, with their profile.
+class WHLazyProfileArray(BackendArray):
+   def __init__(self, pd0File, positions, name, shape, dtype):
+      self.pd0File = pd0File
+      self.positions = positions
+      self.name = name
+      self.shape = shape
+      self.dtype = np.dtype(dtype)
+      self.dataTypes = [PROFILEDATATYPES[name]]
+      if name == 'velocity' and pd0File.coordinates != COORDSYSTEM[0]:
+         self.dataTypes.append(CORRELATIONPROFILE)
+
+   def __getitem__(self, key):
+      indexing = xr.core.indexing
+      return(indexing.explicit_indexing_adapter(key, self.shape, indexing.IndexingSupport.BASIC, self._getItem))
+
+   # <key> is a tuple of integers and slices, one per dimension
+   def _getItem(self, key):
+      ensembles = key[0] if isinstance(key[0], slice) else slice(key[0], key[0]+1)
+      offsets = self.pd0File.index.index['Offset'][self.positions][ensembles]
+      if len(offsets) == 0:
+         return(np.zeros((0,) + self.shape[1:], dtype=self.dtype)[(slice(None),) + tuple(key[1:])])
+      arrays = WHEnsembleArrays()
+      arrays.readEnsembleArrays(self.pd0File._file.getBuffer(), offsets, self.dataTypes, self.pd0File.cells)
+      values = getProfileVariables(arrays, self.pd0File.coordinates)[self.name][0]
+      if isinstance(key[0], slice):
+         return(values[(slice(None),) + tuple(key[1:])])
+      return(values[0][tuple(key[1:])])
+
+#----------------------------------------
+#---  Verify framing and checksums    ---
+#----------------------------------------
+def verifyFile(filename):
+   """Check the framing and checksums of an ADCP file, return the scanner"""
+   scanner = WHEnsembleScanner()
+   with WHMappedFile(filename) as infile:
+      scanner.scanEnsembles(infile.getBuffer())
+   return(scanner)
+
+def verifyPath(path):
+   """Verify an ADCP file or every file of a directory, return the number of bad ensembles"""
+   if os.path.isdir(path):
+      filenames = [os.path.join(path, f) for f in sorted(os.listdir(path))]
+      filenames = [f for f in filenames if os.path.isfile(f) and not f.endswith(INDEXEXTENSION)]
+   else:
+      filenames = [path]
+   nbBadEnsembles = 0
+   for filename in filenames:
+      scanner = verifyFile(filename)
+      print('{}: {} ensembles, {} bad ensembles, {} bytes skipped'.format(filename,
+                      scanner.nbEnsembles,
+                      len(scanner.badEnsembles),
+                      scanner.getDroppedSize()))
+      for offset in scanner.badEnsembles[:MAXREPORTEDSPANS]:
+         print('\tBad ensemble at {}'.format(hex(offset)))
+      if len(scanner.badEnsembles) > MAXREPORTEDSPANS:
+         print('\t...')
+      nbBadEnsembles += len(scanner.badEnsembles)
+   return(nbBadEnsembles)
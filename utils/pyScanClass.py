@@ -0,0 +1,244 @@
+#!/usr/bin/python
+#-*- coding: utf-8 -*-
+
+import struct as st
+import numpy as np
+
+from utils.pyGeneralClass import *
+
+# Size of the blocks searched at once for candidate headers
+SCANBLOCKSIZE = 1 << 22
+# Smallest ensemble: header ID, length, spare and number of data types
+MINENSEMBLELENGTH = 6
+# Number of skipped spans detailed by printReport
+MAXREPORTEDSPANS = 100
+# Largest ensemble with its checksum
+MAXENSEMBLESIZE = 0xffff + 2
+# Buffer of the incremental framer
+FRAMERBUFFERSIZE = 1 << 20
+
+#----------------------------------------
+#---   Checksums of many ensembles    ---
+#----------------------------------------
+# Return the checksums computed over the <lengths> bytes starting at each
+# of the <offsets> (header, length and ensemble, i.e. up to the checksum).
+# The sums come from one cumulative sum of the bytes spanned by the ensembles.
+def computeChecksums(data, offsets, lengths):
+   offsets = np.asarray(offsets, dtype=np.int64)
+   lengths = np.asarray(lengths, dtype=np.int64)
+   if len(offsets) == 0:
+      return(np.zeros(0, dtype=np.uint16))
+   first = int(offsets.min())
+   last = int((offsets + lengths).max())
+   cumsum = np.zeros(last - first + 1, dtype=np.uint64)
+   np.cumsum(data[first:last], dtype=np.uint64, out=cumsum[1:])
+   sums = cumsum[offsets + lengths - first] - cumsum[offsets - first]
+   return((sums & 0xffff).astype(np.uint16))
+
+# Return the checksums stored after each ensemble
+def readChecksums(data, offsets, lengths):
+   positions = np.asarray(offsets, dtype=np.int64) + lengths
+   return(data[positions].astype(np.uint16) | (data[positions+1].astype(np.uint16) << 8))
+
+#----------------------------------------
+#---  Class ensemble framing scanner  ---
+#----------------------------------------
+# Walk the ensembles of a buffer following their length, a block of
+# ensembles at a time, and confirm them with their checksums computed in
+# bulk. When an ensemble is not valid the scanner resynchronizes on the
+# next 0x7f7f (or 0x797f) candidate header found in bulk over large
+# blocks, the skipped bytes are recorded in dropped.
+class WHEnsembleScanner():
+   def __init__(self, blockSize=SCANBLOCKSIZE):
+      self.blockSize = blockSize
+      self.dropped = []       # (offset, size) of the skipped spans
+      self.badEnsembles = []  # offsets of the ensembles failing length or checksum
+      self.waves = []         # offsets of the waves ensembles (not decoded)
+      self.nbEnsembles = 0
+      self.origin = 0         # position of the buffers in the stream (offset of the reported positions)
+      self.resume = 0
+      self._chained = False
+      self._continued = False
+      self._candidates = np.zeros(0, dtype=np.int64)
+      self._candidatesEnd = 0
+
+   # Return the position of the next candidate header from <pos>, -1 if none
+   def _nextCandidate(self, data, pos):
+      while pos < len(data) - 1:
+         if pos >= self._candidatesEnd:
+            block = data[pos:pos+self.blockSize+1]
+            self._candidates = pos + np.flatnonzero((block[:-1] == 0x7f) & ((block[1:] == 0x7f) | (block[1:] == 0x79)))
+            self._candidatesEnd = pos + len(block) - 1
+         i = np.searchsorted(self._candidates, pos)
+         if i < len(self._candidates):
+            return(int(self._candidates[i]))
+         pos = self._candidatesEnd
+      return(-1)
+
+   # Follow the ensemble lengths from <pos> over about a block, return the
+   # offsets, lengths and header IDs of the ensembles with a valid framing,
+   # whether the framing of the next one is broken and whether it is only
+   # cut by the end of the buffer
+   def _followLengths(self, view, pos):
+      offsets = []
+      lengths = []
+      headers = []
+      end = min(len(view), pos + self.blockSize)
+      while pos < end:
+         if pos + 4 > len(view):
+            return(offsets, lengths, headers, True, True)
+         header, length = st.unpack_from('<HH', view, pos)
+         if (header != PD0HEADERID and header != WAVESID) or length < MINENSEMBLELENGTH:
+            return(offsets, lengths, headers, True, False)
+         if pos + length + 2 > len(view):
+            return(offsets, lengths, headers, True, True)
+         offsets.append(pos)
+         lengths.append(length)
+         headers.append(header)
+         pos = pos + length + 2
+      return(offsets, lengths, headers, False, False)
+
+   def _drop(self, start, end):
+      if end > start:
+         start = int(self.origin + start)
+         # Span continued from the previous buffer
+         if len(self.dropped) > 0 and sum(self.dropped[-1]) == start:
+            start = self.dropped.pop()[0]
+         self.dropped.append((start, int(self.origin + end - start)))
+
+   # Yield (offset, length) of the valid current ensembles of <buffer> from <pos>
+   # When <final> is False more data will follow the buffer: the scan stops
+   # at an ensemble cut by the end of the buffer and resume is set to the
+   # position to scan again once the next data are appended
+   def iterEnsembles(self, buffer, pos=0, final=True):
+      view = memoryview(buffer)
+      data = np.frombuffer(buffer, dtype=np.uint8)
+      self._candidates = np.zeros(0, dtype=np.int64)
+      self._candidatesEnd = 0
+      dropStart = pos
+      # False when <pos> is a resync candidate rather than the expected
+      # position of an ensemble, its errors are not reported as bad ensembles
+      chained = pos + 2 <= len(view) and st.unpack_from('<H', view, pos)[0] in (PD0HEADERID, WAVESID)
+      if self._continued:
+         chained = self._chained
+      resume = len(view)
+      while pos + 4 <= len(view):
+         offsets, lengths, headers, broken, truncated = self._followLengths(view, pos)
+         offsets = np.array(offsets, dtype=np.int64)
+         lengths = np.array(lengths, dtype=np.int64)
+         valid = computeChecksums(data, offsets, lengths) == readChecksums(data, offsets, lengths)
+         nbValid = len(valid) if valid.all() else int(valid.argmin())
+         for i in range(nbValid):
+            self._drop(dropStart, offsets[i])
+            if headers[i] == PD0HEADERID:
+               self.nbEnsembles += 1
+               yield(int(offsets[i]), int(lengths[i]))
+            else:
+               # Waves ensemble, skipped (only counted in the report)
+               self.waves.append(int(self.origin + offsets[i]))
+            dropStart = int(offsets[i] + lengths[i] + 2)
+         chained = chained or nbValid > 0
+         if nbValid < len(valid):
+            # Checksum error
+            errorPos = int(offsets[nbValid])
+            if chained:
+               self.badEnsembles.append(self.origin + errorPos)
+         elif broken:
+            # Framing error (header ID or length)
+            errorPos = int(offsets[-1] + lengths[-1] + 2) if len(offsets) > 0 else pos
+            if truncated and not final:
+               # Wait for the end of the ensemble
+               resume = errorPos
+               break
+            if chained:
+               self.badEnsembles.append(self.origin + errorPos)
+         else:
+            pos = dropStart
+            continue
+         pos = self._nextCandidate(data, errorPos+1)
+         chained = False
+         if pos < 0:
+            # Keep the last byte, it may be the first byte of a header
+            resume = len(view) - 1
+            break
+      else:
+         resume = pos
+      if final:
+         resume = len(view)
+      self.resume = resume
+      self._chained = chained
+      self._continued = not final
+      self._drop(dropStart, resume)
+
+   # Return the offsets and lengths of all the valid current ensembles
+   def scanEnsembles(self, buffer, pos=0):
+      found = list(self.iterEnsembles(buffer, pos))
+      offsets = np.array([f[0] for f in found], dtype=np.int64)
+      lengths = np.array([f[1] for f in found], dtype=np.int64)
+      return(offsets, lengths)
+
+   def getDroppedSize(self):
+      return(sum([d[1] for d in self.dropped]))
+
+   def printReport(self):
+      if len(self.waves) > 0:
+         print('Wave data found: {} ensembles skipped'.format(len(self.waves)))
+      if len(self.dropped) > 0:
+         print('Corrupted data skipped: {} bytes in {} spans'.format(self.getDroppedSize(), len(self.dropped)))
+         for start, size in self.dropped[:MAXREPORTEDSPANS]:
+            print('\tPosition:{}\tSize:{}'.format(hex(start), size))
+         if len(self.dropped) > MAXREPORTEDSPANS:
+            print('\t...')
+
+#----------------------------------------
+#---  Class incremental framer        ---
+#----------------------------------------
+# Frame the ensembles of a stream received by chunks of any size (stdin,
+# pipe, socket, ...). The chunks are copied in a fixed size buffer, the
+# complete and valid ensembles are returned as soon as their last byte
+# (checksum) is received. Only the bytes of an ensemble not yet complete
+# are kept, they are moved back to the start of the buffer when its end
+# is reached.
+class WHStreamFramer():
+   def __init__(self, bufferSize=FRAMERBUFFERSIZE):
+      self.scanner = WHEnsembleScanner()
+      self._buffer = bytearray(max(bufferSize, 2*MAXENSEMBLESIZE))
+      self._start = 0  # first byte not yet framed
+      self._end = 0    # end of the received bytes
+      self.origin = 0  # position of _start in the stream
+
+   # Add <chunk> to the buffer, return the list of (offset in the stream, raw
+   # ensemble) of the completed ensembles, a raw ensemble goes from the
+   # header ID to the last data byte
+   def feed(self, chunk):
+      ensembles = []
+      chunk = memoryview(chunk)
+      while len(chunk) > 0:
+         if self._end == len(self._buffer):
+            self._compact()
+         size = min(len(chunk), len(self._buffer) - self._end)
+         self._buffer[self._end:self._end+size] = chunk[:size]
+         self._end = self._end + size
+         chunk = chunk[size:]
+         ensembles.extend(self._frame(False))
+      return(ensembles)
+
+   # End of the stream: return the last ensembles, the remaining bytes are dropped
+   def close(self):
+      return(self._frame(True))
+
+   def _compact(self):
+      size = self._end - self._start
+      self._buffer[0:size] = self._buffer[self._start:self._end]
+      self._start = 0
+      self._end = size
+
+   def _frame(self, final):
+      view = memoryview(self._buffer)[self._start:self._end]
+      self.scanner.origin = self.origin
+      ensembles = [(self.origin + offset, bytes(view[offset:offset+length])) \
+                   for offset, length in self.scanner.iterEnsembles(view, 0, final)]
+      view.release()
+      self._start = self._start + self.scanner.resume
+      self.origin = self.origin + self.scanner.resume
+      return(ensembles)